@@ -0,0 +1,103 @@
+"""
+Benchmark hires strategies against each other at the same output size.
+
+Runs each strategy for the same seeds against a live ComfyUI server and
+reports total job time. The default compares single-pass Deep Shrink with
+the two-pass model upscale path:
+
+    python benchmark_hires.py --model "sdxl/model.safetensors" --width 832 --height 1216 --scale 1.5
+
+Every (run, strategy) pair uses its own seed: strategies share the base
+pass, so a seed reused across strategies would let ComfyUI's node cache
+serve the base sampling to all but the first. A warm-up run per strategy
+loads models before timing starts.
+"""
+
+import time
+import argparse
+import statistics
+
+from comfyui import run_comfyui_dynamic
+from workflow.params import HIRES_STRATEGIES, get_hires_size
+
+
+def build_params(args, strategy: str, seed: int) -> dict:
+    return {
+        "server_address": args.server,
+        "model_name": args.model,
+        "positive_prompt": args.prompt,
+        "negative_prompt": args.negative,
+        "random_seed": seed,
+        "steps": args.steps,
+        "clipskip": -2,
+        "loops": 1,
+        "cfg": args.cfg,
+        "denoise": 1.0,
+        "width": args.width,
+        "height": args.height,
+        "sampler_name": args.sampler,
+        "scheduler": args.scheduler,
+        "hf_enable": True,
+        "hf_strategy": strategy,
+        "hf_scale": args.scale,
+        "hf_steps": args.hf_steps,
+    }
+
+
+def time_run(params: dict) -> float:
+    started = time.time()
+    image_bytes = run_comfyui_dynamic(**params)
+    elapsed = time.time() - started
+    if image_bytes is None:
+        raise RuntimeError(f"Generation failed for strategy '{params['hf_strategy']}'")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare hires strategies at the same output size")
+    parser.add_argument("--server", default="127.0.0.1:8188")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--prompt", default="a lighthouse on a cliff at sunset, highly detailed")
+    parser.add_argument("--negative", default="lowres, blurry")
+    parser.add_argument("--width", type=int, default=832)
+    parser.add_argument("--height", type=int, default=1216)
+    parser.add_argument("--scale", type=float, default=1.5)
+    parser.add_argument("--steps", type=int, default=25)
+    parser.add_argument("--hf-steps", type=int, default=15)
+    parser.add_argument("--cfg", type=float, default=7.0)
+    parser.add_argument("--sampler", default="euler_ancestral")
+    parser.add_argument("--scheduler", default="normal")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1000)
+    parser.add_argument("--strategies", nargs="+", default=["model", "deep_shrink"], choices=HIRES_STRATEGIES)
+    args = parser.parse_args()
+
+    out_width, out_height = get_hires_size({"width": args.width, "height": args.height, "hf_scale": args.scale})
+    print(f"Output size: {out_width}x{out_height}, {args.runs} run(s) per strategy")
+
+    timings = {strategy: [] for strategy in args.strategies}
+    for index, strategy in enumerate(args.strategies):
+        print(f"Warm-up: {strategy}")
+        time_run(build_params(args, strategy, args.seed - 1 - index))
+
+    # Interleave strategies so drift (thermals, other load) hits all of them alike
+    for run in range(args.runs):
+        for index, strategy in enumerate(args.strategies):
+            seed = args.seed + run * len(args.strategies) + index
+            elapsed = time_run(build_params(args, strategy, seed))
+            timings[strategy].append(elapsed)
+            print(f"  run {run + 1} seed {seed} {strategy}: {elapsed:.2f}s")
+
+    baseline = statistics.median(timings[args.strategies[0]])
+    print()
+    print(f"{'strategy':<14}{'median':>10}{'min':>10}{'max':>10}{'vs ' + args.strategies[0]:>14}")
+    for strategy, values in timings.items():
+        median = statistics.median(values)
+        print(
+            f"{strategy:<14}{median:>9.2f}s{min(values):>9.2f}s{max(values):>9.2f}s"
+            f"{median / baseline:>13.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Bulk ControlNet preprocessing - hint sets for many reference images.
+
+Reads every image in a directory (recursively) or a .zip archive and writes
+one hint per enabled preprocessor, grouped by preprocessor:
+
+    python bulk_preprocess.py refs/ hints/ --preprocessors depth openPose anyLine
+    python bulk_preprocess.py refs.zip hints.zip --backends 127.0.0.1:8188 10.0.0.5:8188 --concurrency 2
+
+    hints/depth/<relative path>.png
+    hints/openPose/<relative path>.png
+
+Each image is one ComfyUI prompt with a branch per missing hint. Up to
+--concurrency prompts are kept in flight per backend, so every backend's
+queue stays full while results are downloaded and written. Hints already in
+the hint cache (see hint_cache.py) are not recomputed.
+
+Finished images are appended to a manifest (hints/manifest.jsonl, or
+hints.zip.manifest.jsonl for archives); rerunning the same command skips
+them, so an interrupted run resumes where it stopped.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import zipfile
+import pathlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from comfyui import run_preprocessor_hints
+from workflow.modules import PREPROCESSOR_ORDER
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+
+
+def iter_source_images(source: pathlib.Path) -> Iterator[Tuple[str, Any]]:
+    """
+    Yields (relative_name, read) for every image in a directory or .zip,
+    in a stable order; read() returns the image bytes.
+    """
+    if source.is_dir():
+        for path in sorted(source.rglob("*")):
+            if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield path.relative_to(source).as_posix(), path.read_bytes
+    elif zipfile.is_zipfile(source):
+        archive = zipfile.ZipFile(source)
+        for name in sorted(archive.namelist()):
+            if not name.endswith("/") and pathlib.PurePosixPath(name).suffix.lower() in IMAGE_EXTENSIONS:
+                yield name, (lambda n=name: archive.read(n))
+    else:
+        raise ValueError(f"Source must be a directory or a .zip archive: {source}")
+
+
+class HintSink:
+    """Writes hints to a directory or a .zip archive and tracks finished images."""
+
+    def __init__(self, output: pathlib.Path):
+        self.is_archive = output.suffix.lower() == ".zip"
+        if self.is_archive:
+            output.parent.mkdir(parents=True, exist_ok=True)
+            self.manifest_path = output.with_name(output.name + ".manifest.jsonl")
+            if output.exists() and not zipfile.is_zipfile(output):
+                # A hard kill leaves no central directory; its hints cannot be trusted
+                print(f"WARN: [bulk] {output} is not a readable archive, starting it over")
+                output.replace(output.with_name(output.name + ".broken"))
+                self.manifest_path.unlink(missing_ok=True)
+            self.archive = zipfile.ZipFile(output, "a", compression=zipfile.ZIP_STORED)
+        else:
+            output.mkdir(parents=True, exist_ok=True)
+            self.archive = None
+            self.manifest_path = output / "manifest.jsonl"
+        self.output = output
+        self.done = self._load_manifest()
+        self.manifest = open(self.manifest_path, "a", encoding="utf-8")
+
+    def _load_manifest(self) -> set:
+        done = set()
+        if self.manifest_path.exists():
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line)["source"])
+                    except (ValueError, KeyError):
+                        continue  # Truncated last line of an interrupted run
+        return done
+
+    def write(self, source_name: str, hints: Dict[str, bytes]) -> None:
+        stem = str(pathlib.PurePosixPath(source_name).with_suffix(".png"))
+        for preprocessor, png_bytes in hints.items():
+            relative = f"{preprocessor}/{stem}"
+            if self.archive is not None:
+                self.archive.writestr(relative, png_bytes)
+            else:
+                path = self.output / relative
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(png_bytes)
+        # Recorded only after every hint of the image is written
+        self.manifest.write(json.dumps({"source": source_name, "hints": sorted(hints)}) + "\n")
+        self.manifest.flush()
+        self.done.add(source_name)
+
+    def close(self) -> None:
+        self.manifest.close()
+        if self.archive is not None:
+            self.archive.close()
+
+
+def run_bulk(
+    source: pathlib.Path,
+    output: pathlib.Path,
+    preprocessors: List[str],
+    backends: List[str],
+    concurrency_per_backend: int = 2,
+    params: Optional[Dict[str, Any]] = None,
+) -> Dict[str, int]:
+    """
+    Preprocesses every image from source into output.
+    Returns: Counts of processed, skipped (already done) and failed images.
+    """
+    params = dict(params or {})
+    params["controlnet_preprocessors"] = {name: True for name in preprocessors}
+
+    # One slot per in-flight prompt; a worker holds a backend's slot for the whole prompt
+    slots: "queue.Queue[str]" = queue.Queue()
+    for backend in backends:
+        for _ in range(max(1, concurrency_per_backend)):
+            slots.put(backend)
+    max_in_flight = slots.qsize()
+
+    sink = HintSink(output)
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+    cached_hints = 0
+    started = time.time()
+
+    def _process(name: str, read) -> Tuple[str, Optional[Dict[str, Any]]]:
+        backend = slots.get()
+        try:
+            return name, run_preprocessor_hints(read(), backend, **params)
+        except Exception as e:
+            print(f"ERROR: [bulk] {name} on {backend}: {e}")
+            return name, None
+        finally:
+            slots.put(backend)
+
+    def _collect(done_futures) -> None:
+        nonlocal cached_hints
+        for future in done_futures:
+            name, result = future.result()
+            if not result or len(result["images"]) < len(preprocessors):
+                counts["failed"] += 1
+                print(f"WARN: [bulk] Failed: {name}")
+                continue
+            sink.write(name, result["images"])
+            cached_hints += len(result["cached"])
+            counts["processed"] += 1
+            if counts["processed"] % 25 == 0:
+                rate = counts["processed"] / max(time.time() - started, 1e-6)
+                print(f"INFO: [bulk] {counts['processed']} image(s) done ({rate:.2f}/s)")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            pending = set()
+            for name, read in iter_source_images(source):
+                if name in sink.done:
+                    counts["skipped"] += 1
+                    continue
+                # Keep a short backlog ready so a slot never waits on submission
+                if len(pending) >= 2 * max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    _collect(done)
+                pending.add(executor.submit(_process, name, read))
+            done, _ = wait(pending)
+            _collect(done)
+    finally:
+        sink.close()
+
+    print(
+        f"INFO: [bulk] Finished in {time.time() - started:.1f}s: {counts['processed']} processed, "
+        f"{counts['skipped']} skipped, {counts['failed']} failed, {cached_hints} hint(s) from cache"
+    )
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk ControlNet preprocessing")
+    parser.add_argument("source", type=pathlib.Path, help="Directory or .zip of reference images")
+    parser.add_argument("output", type=pathlib.Path, help="Output directory or .zip")
+    parser.add_argument("--preprocessors", nargs="+", default=["depth", "openPose", "anyLine"], choices=PREPROCESSOR_ORDER)
+    parser.add_argument("--backends", nargs="+", default=[os.getenv("COMFYUI_SERVER_ADDRESS", "127.0.0.1:8188")])
+    parser.add_argument("--concurrency", type=int, default=2, help="Prompts in flight per backend")
+    parser.add_argument("--spec", type=pathlib.Path, help="JSON file of preprocessor params (resolutions, anyline style, depth model, upscale)")
+    args = parser.parse_args()
+
+    params = {}
+    if args.spec:
+        with open(args.spec, "r", encoding="utf-8") as f:
+            params = json.load(f)
+
+    counts = run_bulk(args.source, args.output, args.preprocessors, args.backends, args.concurrency, params)
+    sys.exit(1 if counts["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
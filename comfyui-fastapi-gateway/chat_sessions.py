@@ -0,0 +1,103 @@
+"""
+Chat Sessions - per-client Gemini chat sessions.
+
+Sessions are keyed by (session ID, model), so clients never see each other's
+conversation and comparing two models does not restart either chat. The
+store is bounded three ways:
+
+  - GEMINI_CHAT_MAX_SESSIONS: least recently used sessions are evicted first
+  - GEMINI_CHAT_IDLE_TTL_SECONDS: sessions idle longer than this are dropped
+  - GEMINI_CHAT_MAX_TURNS: only the last N user/model exchanges are re-sent,
+    so request size stops growing with conversation length
+"""
+
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+GEMINI_CHAT_MAX_SESSIONS = int(os.getenv("GEMINI_CHAT_MAX_SESSIONS", "200"))
+GEMINI_CHAT_IDLE_TTL_SECONDS = float(os.getenv("GEMINI_CHAT_IDLE_TTL_SECONDS", "1800"))
+GEMINI_CHAT_MAX_TURNS = int(os.getenv("GEMINI_CHAT_MAX_TURNS", "8"))
+
+DEFAULT_SESSION_ID = "default"
+
+
+class ChatSessionStore:
+    """LRU of chat sessions with idle expiry; entries are {"chat", "turns", "last_used"}."""
+
+    def __init__(self, max_sessions: int, idle_ttl: float, max_turns: int):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_turns = max_turns
+        self._sessions: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+    def lock(self, session_id: str, model: str) -> asyncio.Lock:
+        """Serialises turns within one session (a chat's history is not safe to interleave)."""
+        return self._locks.setdefault((session_id, model), asyncio.Lock())
+
+    def get(self, session_id: str, model: str, create_chat) -> Any:
+        """Returns the session's chat, creating it with create_chat(history) if missing or expired."""
+        self._expire()
+        key = (session_id, model)
+        entry = self._sessions.get(key)
+        if entry is None:
+            print(f"INFO: [ChatSessions] New chat session {session_id!r} with {model}")
+            entry = {"chat": create_chat(None), "turns": 0}
+            self._sessions[key] = entry
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                self._locks.pop(evicted, None)
+                print(f"INFO: [ChatSessions] Evicted least recently used session {evicted[0]!r} ({evicted[1]})")
+        else:
+            print(f"INFO: [ChatSessions] Continuing session {session_id!r} ({entry['turns']} turn(s))")
+        self._sessions.move_to_end(key)
+        entry["last_used"] = time.monotonic()
+        return entry["chat"]
+
+    def record_turn(self, session_id: str, model: str, create_chat) -> None:
+        """Counts a finished turn and trims the history to the last max_turns exchanges."""
+        entry = self._sessions.get((session_id, model))
+        if entry is None:
+            return
+        entry["turns"] += 1
+        history = entry["chat"].get_history(curated=True)
+        if len(history) <= 2 * self.max_turns:
+            return
+        trimmed = history[-2 * self.max_turns:]
+        # A history must open with a user turn
+        while trimmed and getattr(trimmed[0], "role", "user") != "user":
+            trimmed = trimmed[1:]
+        entry["chat"] = create_chat(trimmed)
+        print(f"DEBUG: [ChatSessions] Trimmed session {session_id!r} history to {len(trimmed)} message(s)")
+
+    def reset(self, session_id: str) -> int:
+        """Drops every model's chat for one session. Returns: Number of chats removed."""
+        keys = [key for key in self._sessions if key[0] == session_id]
+        for key in keys:
+            del self._sessions[key]
+            self._locks.pop(key, None)
+        return len(keys)
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.idle_ttl
+        # Ordered by last use, so expired sessions are at the front
+        while self._sessions:
+            key, entry = next(iter(self._sessions.items()))
+            if entry["last_used"] >= cutoff:
+                break
+            del self._sessions[key]
+            self._locks.pop(key, None)
+            print(f"INFO: [ChatSessions] Expired idle session {key[0]!r} ({key[1]})")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"sessions": len(self._sessions), "max_sessions": self.max_sessions}
+
+
+sessions = ChatSessionStore(GEMINI_CHAT_MAX_SESSIONS, GEMINI_CHAT_IDLE_TTL_SECONDS, GEMINI_CHAT_MAX_TURNS)
@@ -5,74 +5,185 @@ import urllib.request as request
 import urllib.parse as parse
 import os
 import time
-from typing import Dict, Any, Optional, List, Tuple
+from typing import Dict, Any, Optional, List, Tuple, Union
+import io
 import base64
 import socket
 from workflow import WorkflowBuilder # Import the new builder
+from workflow.params import SINGLE_PASS_HIRES_STRATEGIES, validate_params, get_sampled_size, get_controlnet_hints
+from workflow.params import get_hires_strategy
+from workflow.modules import PREPROCESSOR_PARAMS
+from memory_profiles import apply_memory_profile
+from media import MediaBlob, get_image_info, get_blob
+from reference_images import fit_reference, fit_blob, CLIPVISION_REFERENCE_SIDE
 
 # --- Configuration & Helper Functions ---
 COMFYUI_SERVER_ADDRESS = "127.0.0.1:8188" # Default, can be overridden
+DRAFT_LORA_NAME = os.getenv("DRAFT_LORA_NAME")  # LCM/Lightning LoRA used for draft previews
 
-def upload_image_to_comfyui(base64_string: str, prefix: str = "img_", server_address: str = COMFYUI_SERVER_ADDRESS) -> Optional[str]:
-    """Decodes a base64 string and uploads it to ComfyUI via API."""
-    if not base64_string: return None
+def upload_bytes_to_comfyui(data: bytes, filename: str, server_address: str = COMFYUI_SERVER_ADDRESS,
+                            mime_type: str = "application/octet-stream") -> Optional[str]:
+    """Uploads raw file bytes into ComfyUI's input directory. Returns the stored name."""
+    # Using requests for the multipart upload; the rest of this module sticks to urllib.
+    import requests
+
+    url = f"http://{server_address}/upload/image"
+    files = {'image': (filename, data, mime_type)}
+    form = {'overwrite': 'true', 'type': 'input'}
+
+    print(f"DEBUG: Uploading {filename} to {url}")
     try:
-        if "," in base64_string:
-            header, encoded = base64_string.split(",", 1)
-        else:
-            encoded = base64_string
+        response = requests.post(url, files=files, data=form)
+    except Exception as e:
+        print(f"ERROR: Failed to upload {filename}: {e}")
+        return None
 
-        image_data = base64.b64decode(encoded)
-        filename = f"{prefix}{uuid.uuid4()}.png"
-        
-        # Prepare multipart form data manually (since we stick to stdlib if possible, or use requests)
-        # Using requests is easier and already imported in server.py, but comfyui.py uses urllib/socket mostly.
-        # But wait, we can just use requests library. It's standard in this environment?
-        # Actually server.py imports fastAPI, not requests. Let's look at comfyui.py imports.
-        # It imports urllib.request.
-        
-        # Let's use requests if available, or multipart encoding with urllib.
-        # Easier to use 'requests' library which is commonly available in python environments for AI/web.
-        # If requests is not imported, let's import it.
-        import requests
-        
-        url = f"http://{server_address}/upload/image"
-        files = {'image': (filename, image_data, 'image/png')}
-        data = {'overwrite': 'true', 'type': 'input'}
-        
-        print(f"DEBUG: Uploading image {filename} to {url}")
-        response = requests.post(url, files=files, data=data)
-        
-        if response.status_code == 200:
-            resp_data = response.json()
-            # ComfyUI returns {"name": "filename.png", "subfolder": "", "type": "input"}
-            # We might handle subfolder if it exists, but for now assuming root input
-            return resp_data.get("name")
-        else:
-            print(f"ERROR: Failed to upload image. Status: {response.status_code}, Resp: {response.text}")
-            return None
+    if response.status_code == 200:
+        # ComfyUI returns {"name": "filename.png", "subfolder": "", "type": "input"}
+        # We might handle subfolder if it exists, but for now assuming root input
+        return response.json().get("name")
+    print(f"ERROR: Failed to upload {filename}. Status: {response.status_code}, Resp: {response.text}")
+    return None
+
+def upload_image_to_comfyui(base64_string: Union[str, MediaBlob], prefix: str = "img_", server_address: str = COMFYUI_SERVER_ADDRESS) -> Optional[str]:
+    """
+    Decodes a base64 string (or takes an already decoded blob) and uploads it to ComfyUI via API.
+    The filename is derived from the image content, so re-uploading the same
+    image keeps LoadImage (and everything downstream) cached in ComfyUI.
+    """
+    if not base64_string: return None
+    try:
+        blob = base64_string if isinstance(base64_string, MediaBlob) else get_blob(base64_string)
+        filename = f"{prefix}{blob.sha256[:32]}.png"
+        return upload_bytes_to_comfyui(blob.data, filename, server_address, blob.mime_type)
 
     except Exception as e:
         print(f"ERROR: Failed to upload base64 image: {e}")
         return None
 
+# Hires strategies built on custom nodes that stock ComfyUI does not ship: strategy -> (node class, node pack)
+HIRES_STRATEGY_NODES = {"tiled": ("UltimateSDUpscale", "ComfyUI_UltimateSDUpscale")}
+_available_nodes = set()  # (server_address, class_type) found in /object_info
+
+class MissingCustomNodeError(Exception):
+    """The request needs a ComfyUI custom node that the server does not have."""
+
+def comfyui_has_node(class_type: str, server_address: str = COMFYUI_SERVER_ADDRESS) -> Optional[bool]:
+    """
+    Whether ComfyUI knows a node class (GET /object_info/{class_type}); None if
+    ComfyUI could not be asked. Only positive answers are cached, so a node pack
+    installed later is picked up.
+    """
+    if (server_address, class_type) in _available_nodes:
+        return True
+    try:
+        with request.urlopen(f"http://{server_address}/object_info/{parse.quote(class_type)}", timeout=10) as response:
+            found = class_type in json.loads(response.read())
+    except Exception as e:
+        print(f"WARN: Could not check ComfyUI for node {class_type}: {e}")
+        return None
+    if found:
+        _available_nodes.add((server_address, class_type))
+    return found
+
+def require_custom_nodes(params: Dict[str, Any], server_address: str) -> None:
+    """
+    Checks the custom nodes the request's hires strategy needs before anything is queued.
+
+    Raises:
+        MissingCustomNodeError: if ComfyUI answered that a required node is missing
+    """
+    strategy = get_hires_strategy(params)
+    if strategy not in HIRES_STRATEGY_NODES:
+        return
+    class_type, node_pack = HIRES_STRATEGY_NODES[strategy]
+    if comfyui_has_node(class_type, server_address) is False:
+        raise MissingCustomNodeError(
+            f"hf_strategy '{strategy}' needs the {class_type} node ({node_pack}), "
+            f"which is not installed in ComfyUI at {server_address}"
+        )
+
+def controlnet_reference_side(params: Dict[str, Any]) -> Optional[int]:
+    """
+    Largest short side of the ControlNet reference that reaches the model.
+    Preprocessors resize the reference so its short side equals their
+    resolution; a unit without a preprocessor uses it as the hint directly,
+    which is resized to the sampled size. Returns None when the reference
+    chain model-upscales or rescales the original (its output depends on
+    the input size, so it must be kept).
+    """
+    upscale_model = params.get("controlnet_upscale_model")
+    if (upscale_model and upscale_model != "None") or (params.get("controlnet_upscale_factor") or 1.0) != 1.0:
+        return None
+
+    validated = validate_params(params)
+    # Per-unit resolution overrides the request-wide one
+    hints = get_controlnet_hints(params)
+    sides = [resolution or validated[PREPROCESSOR_PARAMS[name][0]] for name, resolution in hints if name in PREPROCESSOR_PARAMS]
+    if any(name not in PREPROCESSOR_PARAMS for name, _ in hints):
+        sides.append(max(get_sampled_size(validated)))
+    return max(sides)
+
+def upload_reference_images(params: Dict[str, Any], server_address: str) -> None:
+    """
+    Uploads enabled ClipVision/ControlNet references and records their filenames in params.
+    Each is first downsampled to the largest size its consumer uses (reference_images.fit_reference).
+    """
+    if params.get("clipvision_enabled") and params.get("clipvision_ref_image_base64"):
+        reference = params["clipvision_ref_image_base64"]
+        cv_file = upload_image_to_comfyui(
+            fit_reference(reference, max_short_side=CLIPVISION_REFERENCE_SIDE) or reference, "cv_ref_", server_address
+        )
+        if cv_file:
+            params["clipvision_ref_image_filename"] = cv_file
+
+    if params.get("controlnet_enabled") and params.get("controlnet_ref_image_base64"):
+        reference = params["controlnet_ref_image_base64"]
+        fitted = fit_reference(reference, max_short_side=controlnet_reference_side(params))
+        cn_file = upload_image_to_comfyui(fitted or reference, "cn_ref_", server_address)
+        if cn_file:
+            params["controlnet_ref_image_filename"] = cn_file
+        if params.get("cn_resolution_mode") == "auto":
+            # The auto planner skips the reference upscale when the image is already large enough
+            info = fitted.info if fitted else get_image_info(reference)
+            params["controlnet_ref_image_size"] = (info.width, info.height) if info else None
+
+# Inline references dropped once uploaded (see detach_reference_images)
+REFERENCE_IMAGE_PARAMS = ("clipvision_ref_image_base64", "controlnet_ref_image_base64")
+
+def detach_reference_images(params: Dict[str, Any], server_address: str) -> None:
+    """
+    Uploads the references and drops their base64 from params, leaving only
+    the uploaded filenames. For params kept between requests (pending drafts);
+    later runs with them skip the upload.
+    """
+    upload_reference_images(params, server_address)
+    for key in REFERENCE_IMAGE_PARAMS:
+        params.pop(key, None)
+
 # --- ComfyUI API Generator Class ---
 class ComfyUIAPIGenerator:
     def __init__(self, server_address: str = "127.0.0.1:8188", client_id="debug_client_id"):
         self.server_address = server_address
         self.client_id = client_id
         self.nodes: Dict[str, Any] = {}
+        self.last_history: Dict[str, Any] = {}
+        self.node_timings: Dict[str, float] = {}
         # Initialize the new WorkflowBuilder
         self.builder = WorkflowBuilder(client_id) 
         print(f"DEBUG: ComfyUIAPIGenerator initialized for client_id: {self.client_id} (Modular Workflow)")
 
+    def with_memory_profile(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Resolves this backend's memory profile (weight precision, split loaders) into params."""
+        return apply_memory_profile(params, self.server_address)
+
     def build_workflow(self, params: Dict[str, Any]) -> tuple[Dict[str, Any], Optional[str]]:
         """
         Builds the full generation workflow using WorkflowBuilder.
         Returns (nodes_dict, cn_preview_node_id)
         """
         try:
-            nodes, preview_id = self.builder.build(params)
+            nodes, preview_id = self.builder.build(self.with_memory_profile(params))
             self.nodes = nodes # Store for queue_prompt
             return nodes, preview_id
         except Exception as e:
@@ -80,6 +191,20 @@ class ComfyUIAPIGenerator:
             import traceback; traceback.print_exc()
             return {}, None
 
+    def build_workflow_for_refine(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Builds a hires-only workflow from a persisted base latent.
+        Returns nodes_dict.
+        """
+        try:
+            nodes = self.builder.build_refine(self.with_memory_profile(params))
+            self.nodes = nodes
+            return nodes
+        except Exception as e:
+            print(f"ERROR: [{self.client_id}] Failed to build refine workflow: {e}")
+            import traceback; traceback.print_exc()
+            return {}
+
     def build_workflow_for_preview(self, params: Dict[str, Any]) -> Dict[str, Any]:
         """
         Builds a preview-only workflow using WorkflowBuilder.
@@ -94,6 +219,20 @@ class ComfyUIAPIGenerator:
             import traceback; traceback.print_exc()
             return {}
 
+    def build_workflow_for_preview_branches(self, params: Dict[str, Any]) -> tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        Builds a branched preview workflow (one branch per preprocessor).
+        Returns (nodes_dict, {preprocessor_name: preview_node_id}).
+        """
+        try:
+            nodes, branch_ids = self.builder.build_preview_branches_workflow(params)
+            self.nodes = nodes
+            return nodes, branch_ids
+        except Exception as e:
+            print(f"ERROR: [{self.client_id}] Failed to build preview branches workflow: {e}")
+            import traceback; traceback.print_exc()
+            return {}, {}
+
     def get_image(self, filename, subfolder, folder_type):
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
         url_values = parse.urlencode(data)
@@ -104,6 +243,25 @@ class ComfyUIAPIGenerator:
         with request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
             return json.loads(response.read())
 
+    def wait_for_history(self, prompt_id: str, poll_interval: float = 0.2, timeout: float = 300) -> Dict[str, Any]:
+        """Polls /history until the prompt completes. Returns its history entry."""
+        start_time = time.time()
+        while (time.time() - start_time) < timeout:
+            history_data = self.get_history(prompt_id)
+            if prompt_id in history_data and history_data[prompt_id].get('status', {}).get('completed', False):
+                return history_data[prompt_id]
+            time.sleep(poll_interval)
+        raise TimeoutError(f"[{self.client_id}] Prompt {prompt_id} did not complete within {timeout}s")
+
+    @staticmethod
+    def get_cached_node_ids(history: Dict[str, Any]) -> List[str]:
+        """Node IDs ComfyUI served from its cache, from the history status messages."""
+        cached: List[str] = []
+        for message in history.get('status', {}).get('messages', []):
+            if len(message) == 2 and message[0] == 'execution_cached':
+                cached.extend(str(n) for n in message[1].get('nodes', []))
+        return cached
+
     def queue_prompt(self) -> str:
         if not self.nodes:
             raise ValueError(f"[{self.client_id}] Workflow nodes are empty, cannot queue prompt.")
@@ -131,6 +289,9 @@ class ComfyUIAPIGenerator:
         current_step_reported = 0
         execution_done = False
         expecting_cn_preprocessor_preview_from_node_id: Optional[str] = None
+        self.node_timings = {}
+        timed_node: Optional[str] = None
+        timed_node_start = 0.0
         
         try:
             ws_conn.settimeout(10.0) 
@@ -155,6 +316,11 @@ class ComfyUIAPIGenerator:
                     
                     if msg_type == 'executing':
                         node_being_executed = msg_data.get('node')
+                        # Wall time per node: a node runs until the next one starts
+                        now = time.time()
+                        if timed_node is not None:
+                            self.node_timings[timed_node] = self.node_timings.get(timed_node, 0.0) + (now - timed_node_start)
+                        timed_node, timed_node_start = node_being_executed, now
                         if node_being_executed is None and msg_data.get('prompt_id') == current_prompt_id:
                             execution_done = True; break
                         if node_being_executed == cn_preprocessor_preview_node_id:
@@ -192,6 +358,7 @@ class ComfyUIAPIGenerator:
 
         try:
             history = self.get_history(current_prompt_id).get(current_prompt_id, {})
+            self.last_history = history
             images_output = []
             final_saver_node_id_found = None
             
@@ -226,31 +393,134 @@ class ComfyUIAPIGenerator:
             print(f"ERROR: [{self.client_id}] History/final image ex: {e_hist}")
             return []
 
+    def stream_node_outputs(self, ws_conn: websocket.WebSocket, current_prompt_id: str,
+                            watched_node_ids: List[str], on_output, progress_callback=None,
+                            overall_timeout_seconds: float = 900) -> Dict[str, bytes]:
+        """
+        Waits for a prompt while forwarding each watched output node's first
+        image to on_output(node_id, image_bytes) as soon as it executes.
+        Outputs missed on the socket are recovered from history at the end.
+        Returns {node_id: image_bytes}.
+        """
+        watched = set(watched_node_ids)
+        results: Dict[str, bytes] = {}
+
+        def _collect(node_id: str, node_output: Dict[str, Any]) -> None:
+            if node_id not in watched or node_id in results:
+                return
+            for img_info in (node_output or {}).get('images', []):
+                results[node_id] = self.get_image(img_info['filename'], img_info['subfolder'], img_info['type'])
+                if on_output:
+                    on_output(node_id, results[node_id])
+                return
+
+        try:
+            ws_conn.settimeout(10.0)
+            start_time = time.time()
+            while (time.time() - start_time) < overall_timeout_seconds:
+                try: out = ws_conn.recv()
+                except (websocket.WebSocketTimeoutException, socket.timeout): continue
+                except websocket.WebSocketConnectionClosedException: break
+                if not isinstance(out, str):
+                    continue  # Binary step previews are not forwarded for matrix jobs
+                message = json.loads(out)
+                msg_type, msg_data = message.get('type'), message.get('data', {})
+                if msg_data.get('prompt_id') not in (None, current_prompt_id):
+                    continue
+                if msg_type == 'executed':
+                    _collect(str(msg_data.get('node')), msg_data.get('output'))
+                elif msg_type == 'progress' and progress_callback:
+                    if msg_data.get('value') is not None:
+                        progress_callback(msg_data.get('value'), msg_data.get('max'), None, preview_kind="step_progress_text")
+                elif msg_type == 'executing' and msg_data.get('node') is None and msg_data.get('prompt_id') == current_prompt_id:
+                    break
+                elif msg_type == 'execution_error':
+                    print(f"ERROR: [{self.client_id}] ComfyUI execution error: {msg_data.get('exception_message')}")
+                    break
+        except Exception as e_outer:
+            print(f"ERROR: [{self.client_id}] stream_node_outputs ex: {e_outer}")
+        finally:
+            if ws_conn and ws_conn.connected:
+                try: ws_conn.settimeout(None)
+                except: pass
+
+        if len(results) < len(watched):
+            history = self.get_history(current_prompt_id).get(current_prompt_id, {})
+            self.last_history = history
+            for node_id, node_output in history.get('outputs', {}).items():
+                _collect(str(node_id), node_output)
+        return results
+
     def pick_image(self, images: List[bytes]) -> Optional[bytes]:
         return images[0] if images else None
 
+    def seconds_in_nodes(self, title_prefix: str) -> float:
+        """Total execution time of the last prompt's nodes whose title starts with title_prefix."""
+        return sum(
+            seconds for node_id, seconds in self.node_timings.items()
+            if self.nodes.get(str(node_id), {}).get('_meta', {}).get('title', '').startswith(title_prefix)
+        )
+
+    def get_saved_latent(self) -> Optional[bytes]:
+        """Fetches the .latent file written by SaveLatent in the last completed prompt."""
+        latent_saver_node_id = None
+        for node_id, node_data in self.nodes.items():
+            if node_data.get('_meta', {}).get('title') == "PERSIST_BASE_LATENT":
+                latent_saver_node_id = node_id
+                break
+        if not latent_saver_node_id:
+            return None
+        node_output = self.last_history.get('outputs', {}).get(latent_saver_node_id, {})
+        for latent_info in node_output.get('latents', []):
+            return self.get_image(latent_info['filename'], latent_info['subfolder'], latent_info['type'])
+        return None
+
 # --- Main Entry Points ---
 
+def record_job_metrics(job_id: str, params: Dict[str, Any], generator: ComfyUIAPIGenerator,
+                       total_seconds: float, succeeded: bool) -> None:
+    """Records per-job timings, including hires time saved by non-default strategies."""
+    import metrics
+    from workflow.params import get_hires_strategy, get_hires_size, get_tome_ratios
+
+    record = {
+        "job_id": job_id,
+        "succeeded": succeeded,
+        "total_seconds": round(total_seconds, 3),
+    }
+    base_tome_ratio, hires_tome_ratio = get_tome_ratios(params)
+    if base_tome_ratio or hires_tome_ratio:
+        record["tome_ratio"] = base_tome_ratio
+        record["hf_tome_ratio"] = hires_tome_ratio
+    strategy = get_hires_strategy(params)
+    if strategy:
+        width, height = get_hires_size(params)
+        hires_seconds = generator.seconds_in_nodes("HF:")
+        record.update({
+            "hires_strategy": strategy,
+            "hires_seconds": round(hires_seconds, 3),
+            "output_size": f"{width}x{height}",
+        })
+        if succeeded:
+            record["hires_time_saved_seconds"] = metrics.record_hires_timing(
+                strategy, hires_seconds, width * height / 1_000_000
+            )
+    metrics.increment("jobs_succeeded" if succeeded else "jobs_failed")
+    metrics.record_job(record)
+
 def run_comfyui_dynamic(progress_callback=None, **kwargs) -> Optional[bytes]:
     server_address = kwargs.get("server_address", "127.0.0.1:8188")
-    job_client_id = str(uuid.uuid4())
+    job_client_id = kwargs.get("job_id") or str(uuid.uuid4())
     print(f"INFO: [run_comfyui_dynamic] Job {job_client_id} starting.")
 
     comfy_ws = None
     generated_image_bytes = None
     temp_files_to_clean = []
+    job_started_at = time.time()
     
     try:
         # Save reference images if present (Uploaded to ComfyUI)
-        if kwargs.get("clipvision_enabled") and kwargs.get("clipvision_ref_image_base64"):
-            cv_file = upload_image_to_comfyui(kwargs["clipvision_ref_image_base64"], "cv_ref_", server_address)
-            if cv_file: 
-                kwargs["clipvision_ref_image_filename"] = cv_file
-
-        if kwargs.get("controlnet_enabled") and kwargs.get("controlnet_ref_image_base64"):
-            cn_file = upload_image_to_comfyui(kwargs["controlnet_ref_image_base64"], "cn_ref_", server_address)
-            if cn_file: 
-                kwargs["controlnet_ref_image_filename"] = cn_file
+        upload_reference_images(kwargs, server_address)
         
         ws_url = f"ws://{server_address}/ws?clientId={job_client_id}"
         comfy_ws = websocket.create_connection(ws_url, timeout=30) 
@@ -263,7 +533,7 @@ def run_comfyui_dynamic(progress_callback=None, **kwargs) -> Optional[bytes]:
         prompt_id = generator.queue_prompt()
         
         total_steps_calc = kwargs.get("steps", 20)
-        if kwargs.get("hf_enable"):
+        if kwargs.get("hf_enable") and kwargs.get("hf_strategy") not in SINGLE_PASS_HIRES_STRATEGIES:
             hf_steps_param = kwargs.get("hf_steps")
             total_steps_calc += hf_steps_param if hf_steps_param is not None else 15
         
@@ -275,6 +545,15 @@ def run_comfyui_dynamic(progress_callback=None, **kwargs) -> Optional[bytes]:
             total_steps_calc
         )
         generated_image_bytes = generator.pick_image(final_images)
+        record_job_metrics(job_client_id, kwargs, generator, time.time() - job_started_at, generated_image_bytes is not None)
+
+        if kwargs.get("persist_latent") and kwargs.get("job_id"):
+            latent_bytes = generator.get_saved_latent()
+            if latent_bytes:
+                from latent_store import save_job_latent
+                save_job_latent(kwargs["job_id"], latent_bytes, kwargs)
+            else:
+                print(f"WARN: [run_comfyui_dynamic] Job {job_client_id} requested persist_latent but no latent was saved.")
 
     except Exception as e:
         print(f"ERROR: [run_comfyui_dynamic] Exception for job {job_client_id}: {e}")
@@ -291,7 +570,222 @@ def run_comfyui_dynamic(progress_callback=None, **kwargs) -> Optional[bytes]:
     return generated_image_bytes
 
 
+def run_comfyui_matrix(cells: List[Tuple[str, Dict[str, Any]]], progress_callback=None,
+                       cell_callback=None, **kwargs) -> Dict[str, bytes]:
+    """
+    Renders a parameter matrix as a single ComfyUI prompt.
+    cells is a list of (cell_key, param_overrides); cell_callback(cell_key, png_bytes)
+    is called as each cell finishes. Returns {cell_key: png_bytes}.
+    """
+    server_address = kwargs.get("server_address", "127.0.0.1:8188")
+    job_client_id = kwargs.get("job_id") or str(uuid.uuid4())
+    print(f"INFO: [run_comfyui_matrix] Job {job_client_id} starting with {len(cells)} cells.")
+
+    comfy_ws = None
+    cell_images: Dict[str, bytes] = {}
+    try:
+        # References are uploaded once and shared by every cell
+        upload_reference_images(kwargs, server_address)
+
+        ws_url = f"ws://{server_address}/ws?clientId={job_client_id}"
+        comfy_ws = websocket.create_connection(ws_url, timeout=30)
+
+        generator = ComfyUIAPIGenerator(server_address, job_client_id)
+        nodes, cell_output_ids = generator.builder.build_matrix(generator.with_memory_profile(kwargs), cells)
+        generator.nodes = nodes
+        node_to_cell = {node_id: cell_key for cell_key, node_id in cell_output_ids.items()}
+
+        def _on_output(node_id: str, image_bytes: bytes) -> None:
+            if cell_callback:
+                cell_callback(node_to_cell[node_id], image_bytes)
+
+        prompt_id = generator.queue_prompt()
+        outputs = generator.stream_node_outputs(
+            comfy_ws, prompt_id, list(node_to_cell), _on_output, progress_callback
+        )
+        cell_images = {node_to_cell[node_id]: img for node_id, img in outputs.items()}
+
+    except Exception as e:
+        print(f"ERROR: [run_comfyui_matrix] Exception for job {job_client_id}: {e}")
+        import traceback; traceback.print_exc()
+    finally:
+        if comfy_ws and comfy_ws.connected:
+            try: comfy_ws.close()
+            except: pass
+        print(f"INFO: [run_comfyui_matrix] Job {job_client_id} finished with {len(cell_images)}/{len(cells)} cells.")
+    return cell_images
+
+
+def run_comfyui_draft(progress_callback=None, **kwargs) -> Optional[bytes]:
+    """
+    Renders the fast draft of a generation (LCM LoRA, few steps, cfg ~1).
+    Uses the same seed, canvas and conditioning as the full job, which can
+    then be run with run_comfyui_dynamic and reuse the cached upstream nodes.
+
+    Raises:
+        ValueError: if no draft LoRA is configured
+    """
+    draft_lora = kwargs.get("draft_lora") or DRAFT_LORA_NAME
+    if not draft_lora:
+        raise ValueError("Draft mode needs a draft_lora or the DRAFT_LORA_NAME environment variable")
+
+    server_address = kwargs.get("server_address", "127.0.0.1:8188")
+    job_client_id = f"{kwargs.get('job_id') or uuid.uuid4().hex}_draft"
+    print(f"INFO: [run_comfyui_draft] Job {job_client_id} starting with {draft_lora}.")
+
+    comfy_ws = None
+    draft_bytes = None
+    try:
+        upload_reference_images(kwargs, server_address)
+
+        ws_url = f"ws://{server_address}/ws?clientId={job_client_id}"
+        comfy_ws = websocket.create_connection(ws_url, timeout=30)
+
+        generator = ComfyUIAPIGenerator(server_address, job_client_id)
+        nodes, draft_node_id = generator.builder.build_draft(generator.with_memory_profile(kwargs), draft_lora)
+        generator.nodes = nodes
+
+        prompt_id = generator.queue_prompt()
+        outputs = generator.stream_node_outputs(
+            comfy_ws, prompt_id, [draft_node_id], lambda node_id, image_bytes: None, progress_callback
+        )
+        draft_bytes = outputs.get(draft_node_id)
+
+    except Exception as e:
+        print(f"ERROR: [run_comfyui_draft] Exception for job {job_client_id}: {e}")
+        import traceback; traceback.print_exc()
+    finally:
+        if comfy_ws and comfy_ws.connected:
+            try: comfy_ws.close()
+            except: pass
+        print(f"INFO: [run_comfyui_draft] Job {job_client_id} finished.")
+    return draft_bytes
+
+
+def run_comfyui_template(template_name: str, values: Dict[str, Any], progress_callback=None,
+                         server_address: str = COMFYUI_SERVER_ADDRESS) -> Optional[bytes]:
+    """
+    Runs a registered workflow template (see workflow.templates) with the
+    given parameter values. Image parameters are base64 and get uploaded
+    exactly like generation references.
+    """
+    from workflow.templates import get_template
+
+    template = get_template(template_name)
+    if template is None:
+        raise KeyError(f"Unknown workflow template: {template_name}")
+
+    job_client_id = str(uuid.uuid4())
+    print(f"INFO: [run_comfyui_template] Job {job_client_id} running template '{template_name}'.")
+
+    values = dict(values)
+    for name in template.image_bindings():
+        if values.get(name):
+            uploaded = upload_image_to_comfyui(values[name], f"tpl_{name}_", server_address)
+            if not uploaded:
+                raise ValueError(f"Failed to upload image parameter '{name}'")
+            values[name] = uploaded
+
+    # Validation errors surface to the caller before anything is queued
+    nodes = template.instantiate(values)
+
+    comfy_ws = None
+    generated_image_bytes = None
+    try:
+        ws_url = f"ws://{server_address}/ws?clientId={job_client_id}"
+        comfy_ws = websocket.create_connection(ws_url, timeout=30)
+
+        generator = ComfyUIAPIGenerator(server_address, job_client_id)
+        generator.nodes = nodes
+        prompt_id = generator.queue_prompt()
+
+        total_steps = sum(
+            node["inputs"]["steps"] for node in nodes.values()
+            if node.get("class_type") == "KSampler" and isinstance(node["inputs"].get("steps"), int)
+        ) or 20
+        final_images = generator.get_images(comfy_ws, prompt_id, None, progress_callback, total_steps)
+        generated_image_bytes = generator.pick_image(final_images)
+
+    except Exception as e:
+        print(f"ERROR: [run_comfyui_template] Exception for job {job_client_id}: {e}")
+        import traceback; traceback.print_exc()
+    finally:
+        if comfy_ws and comfy_ws.connected:
+            try: comfy_ws.close()
+            except: pass
+        print(f"INFO: [run_comfyui_template] Job {job_client_id} finished.")
+    return generated_image_bytes
+
+
+def run_comfyui_refine(job_id: str, progress_callback=None, **overrides) -> Optional[bytes]:
+    """
+    Re-runs only the hires chain (plus optional color transfer) of a finished
+    job, starting from its persisted base latent. Non-None overrides replace
+    the job's original hires parameters.
+    """
+    from latent_store import load_job_latent
+
+    stored = load_job_latent(job_id)
+    if stored is None:
+        raise KeyError(f"No persisted latent for job {job_id}")
+    latent_bytes, params = stored
+    params.update({k: v for k, v in overrides.items() if v is not None})
+    if overrides.get("hf_denoising_strength") is not None and overrides.get("hf_latent_denoise") is None:
+        # A new denoise applies to the latent strategy too, not the job's old hf_latent_denoise
+        params.pop("hf_latent_denoise", None)
+    params["hf_enable"] = True
+    if (params.get("hf_strategy") or "model") in SINGLE_PASS_HIRES_STRATEGIES:
+        # The job was generated single-pass; there is no second pass to re-run
+        raise ValueError(f"Job {job_id} used hf_strategy '{params['hf_strategy']}'; pass a two-pass hf_strategy to refine it")
+
+    server_address = params.get("server_address", "127.0.0.1:8188")
+    require_custom_nodes(params, server_address)
+    refine_client_id = str(uuid.uuid4())
+    print(f"INFO: [run_comfyui_refine] Refining job {job_id} as {refine_client_id}.")
+
+    comfy_ws = None
+    generated_image_bytes = None
+    try:
+        latent_file = upload_bytes_to_comfyui(latent_bytes, f"gateway_latent_{job_id}.latent", server_address)
+        if not latent_file:
+            return None
+        params["base_latent_filename"] = latent_file
+
+        ws_url = f"ws://{server_address}/ws?clientId={refine_client_id}"
+        comfy_ws = websocket.create_connection(ws_url, timeout=30)
+
+        generator = ComfyUIAPIGenerator(server_address, refine_client_id)
+        if not generator.build_workflow_for_refine(params):
+            return None
+
+        prompt_id = generator.queue_prompt()
+        hf_steps_param = params.get("hf_steps")
+        final_images = generator.get_images(
+            comfy_ws,
+            prompt_id,
+            None,
+            progress_callback,
+            hf_steps_param if hf_steps_param is not None else 15
+        )
+        generated_image_bytes = generator.pick_image(final_images)
+
+    except Exception as e:
+        print(f"ERROR: [run_comfyui_refine] Exception for job {job_id}: {e}")
+        import traceback; traceback.print_exc()
+    finally:
+        if comfy_ws and comfy_ws.connected:
+            try: comfy_ws.close()
+            except: pass
+        print(f"INFO: [run_comfyui_refine] Refine of job {job_id} finished.")
+    return generated_image_bytes
+
+
 def run_controlnet_preview_only(**kwargs) -> Optional[bytes]:
+    """
+    Renders the chained preprocessor preview for the ControlNet reference.
+    Blocking (uploads, the ComfyUI queue, or a wait on the local preprocessor
+    pool for Canny alone): async callers run it in a worker thread.
+    """
     server_address = kwargs.get("server_address", "127.0.0.1:8188")
     job_client_id = str(uuid.uuid4())
     print(f"INFO: [run_controlnet_preview_only] Job {job_client_id} starting.")
@@ -301,12 +795,27 @@ def run_controlnet_preview_only(**kwargs) -> Optional[bytes]:
     temp_files_to_clean = []
 
     try:
+        # Canny alone needs no GPU: compute it in the gateway instead of queueing a prompt
+        enabled = [name for name, on in (kwargs.get("controlnet_preprocessors") or {}).items() if on]
+        if enabled == ["canny"] and kwargs.get("controlnet_ref_image_base64"):
+            import local_preprocessors
+            if local_preprocessors.supports_local("canny", kwargs):
+                reference = get_blob(kwargs["controlnet_ref_image_base64"])
+                preview_image_bytes = local_preprocessors.submit_local("canny", reference.data, kwargs).result()
+                print(f"INFO: [run_controlnet_preview_only] Job {job_client_id} computed Canny locally.")
+                return preview_image_bytes
+
         if kwargs.get("controlnet_ref_image_base64"):
-            cn_file = upload_image_to_comfyui(kwargs["controlnet_ref_image_base64"], "cn_prev_ref_", server_address)
+            reference = kwargs["controlnet_ref_image_base64"]
+            fitted = fit_reference(reference, max_short_side=controlnet_reference_side(kwargs))
+            cn_file = upload_image_to_comfyui(fitted or reference, "cn_prev_ref_", server_address)
             if cn_file:
                 kwargs["controlnet_ref_image_filename"] = cn_file
             else:
                 return None
+            if fitted and kwargs.get("cn_resolution_mode") == "auto":
+                # As in generation: the planner must see the downsampled size to skip the reference upscale
+                kwargs["controlnet_ref_image_size"] = fitted.size
         else:
             return None
 
@@ -354,4 +863,110 @@ def run_controlnet_preview_only(**kwargs) -> Optional[bytes]:
             try:
                 if os.path.exists(f_path): os.remove(f_path)
             except: pass
-    return preview_image_bytes
\ No newline at end of file
+    return preview_image_bytes
+
+
+def run_preprocessor_hints(image: Union[bytes, MediaBlob], server_address: str = COMFYUI_SERVER_ADDRESS,
+                           upload_prefix: str = "cn_hint_ref_", **params) -> Optional[Dict[str, Any]]:
+    """
+    Computes the enabled preprocessor hints for one reference image (raw bytes,
+    or an already decoded MediaBlob whose hash is reused), each as
+    an independent branch of one prompt. The image is first downsampled to the
+    largest preprocessor resolution (controlnet_reference_side). Hints in the
+    disk hint cache are not sent to ComfyUI at all; new hints are added to it.
+    Returns {"images": {preprocessor_name: png_bytes}, "cached": [preprocessor_name, ...]}
+    where "cached" lists hints served from the hint cache or ComfyUI's node cache.
+    """
+    import hint_cache
+
+    job_client_id = str(uuid.uuid4())
+    blob = image if isinstance(image, MediaBlob) else MediaBlob(image)
+    # Hint cache keys stay on the original bytes; ComfyUI and the local pool get the downsampled copy
+    image_sha = blob.sha256
+    side = controlnet_reference_side(params)
+    blob = (fit_blob(blob, max_short_side=side) if side else None) or blob
+    image_bytes = blob.data
+    enabled = [name for name, on in (params.get("controlnet_preprocessors") or {}).items() if on]
+
+    images: Dict[str, bytes] = {}
+    cached: List[str] = []
+    keys: Dict[str, str] = {}
+    for name in enabled:
+        if name not in PREPROCESSOR_PARAMS:
+            continue
+        keys[name] = hint_cache.hint_key(image_sha, name, params)
+        hint = hint_cache.get_hint(keys[name])
+        if hint is not None:
+            images[name] = hint
+            cached.append(name)
+
+    # Cheap CPU preprocessors run in the gateway's process pool, alongside the ComfyUI prompt
+    import local_preprocessors
+    local_futures = {
+        name: local_preprocessors.submit_local(name, image_bytes, params)
+        for name in keys
+        if name not in images and local_preprocessors.supports_local(name, params)
+    }
+
+    def _collect_local() -> None:
+        for name, future in local_futures.items():
+            images[name] = future.result()
+            hint_cache.put_hint(keys[name], images[name])
+
+    missing = [name for name in keys if name not in images and name not in local_futures]
+    if not missing:
+        _collect_local()
+        print(f"INFO: [run_preprocessor_hints] Hints for {image_sha[:12]} served without ComfyUI (local: {list(local_futures)}).")
+        return {"images": images, "cached": cached}
+
+    filename = f"{upload_prefix}{blob.sha256[:32]}.png"
+    if not upload_bytes_to_comfyui(image_bytes, filename, server_address, blob.mime_type):
+        return None
+
+    branch_params = dict(params)
+    branch_params["controlnet_ref_image_filename"] = filename
+    branch_params["controlnet_preprocessors"] = {name: True for name in missing}
+
+    generator = ComfyUIAPIGenerator(server_address, job_client_id)
+    nodes, branch_ids = generator.build_workflow_for_preview_branches(branch_params)
+    if not nodes:
+        return None
+
+    prompt_id = generator.queue_prompt()
+    history = generator.wait_for_history(prompt_id)
+
+    cached_node_ids = set(generator.get_cached_node_ids(history))
+    outputs = history.get('outputs', {})
+    for name, preview_id in branch_ids.items():
+        node_output = outputs.get(preview_id, {})
+        for img_info in node_output.get('images', []):
+            images[name] = generator.get_image(img_info['filename'], img_info['subfolder'], img_info['type'])
+            hint_cache.put_hint(keys[name], images[name])
+            break
+        if preview_id in cached_node_ids:
+            cached.append(name)
+    _collect_local()
+
+    print(f"INFO: [run_preprocessor_hints] Job {job_client_id} done. Hints: {list(images)}, cached: {cached}")
+    return {"images": images, "cached": cached}
+
+
+def run_controlnet_preview_branches(**kwargs) -> Optional[Dict[str, Any]]:
+    """
+    Runs each enabled preprocessor as an independent branch in one prompt.
+    Returns {"images": {preprocessor_name: png_bytes}, "cached": [preprocessor_name, ...]}
+    where "cached" lists the branches ComfyUI did not have to re-execute.
+    """
+    server_address = kwargs.pop("server_address", "127.0.0.1:8188")
+    print(f"INFO: [run_controlnet_preview_branches] Starting.")
+
+    try:
+        base64_string = kwargs.get("controlnet_ref_image_base64")
+        if not base64_string:
+            return None
+        return run_preprocessor_hints(get_blob(base64_string), server_address, "cn_prev_ref_", **kwargs)
+
+    except Exception as e:
+        print(f"ERROR: [run_controlnet_preview_branches] Exception: {e}")
+        import traceback; traceback.print_exc()
+        return None
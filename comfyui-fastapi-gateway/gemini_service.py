@@ -1,15 +1,19 @@
 import os
 import io
+import asyncio
 import base64
-import datetime
-import uuid
-import pathlib
 from PIL import Image
-from google import genai
 from google.genai import types
 from fastapi import HTTPException
 from dotenv import load_dotenv
 
+from provider_clients import get_gemini_client, get_http_session, provider_slot
+from media_store import new_output_path
+from media import decode_base64, get_blob
+from reference_images import fit_reference
+import output_writer
+from chat_sessions import sessions, DEFAULT_SESSION_ID
+
 # Load environment variables
 load_dotenv()
 
@@ -19,51 +23,39 @@ API_KEY = os.getenv("GOOGLE_API_KEY")
 MODEL_NANO_BANANA_PRO = "gemini-3-pro-image-preview" 
 MODEL_NANO_BANANA = "gemini-2.5-flash-image"
 
-# Global Chat Session State (for conversational continuity)
-chat_session = None
-current_chat_model = None
+def reset_gemini_chat(session_id: str = DEFAULT_SESSION_ID) -> int:
+    """Resets one client's chat history (every model). Returns: Number of chats removed."""
+    removed = sessions.reset(session_id)
+    print(f"INFO: Gemini Chat Session Reset ({session_id!r}, {removed} chat(s))")
+    return removed
+
+async def list_gemini_models() -> list:
+    """Model names visible to this API key (models.list; metadata only, nothing generated)."""
+    client = get_gemini_client()
+    names = []
+    async with provider_slot("gemini"):
+        pager = await client.aio.models.list(config={"page_size": 100})
+        async for model in pager:
+            names.append(model.name.removeprefix("models/"))
+    return names
 
-def reset_gemini_chat():
-    """Resets the current chat session history."""
-    global chat_session
-    chat_session = None
-    print("INFO: Gemini Chat Session Reset")
+async def describe_gemini_model(model_name: str) -> dict:
+    """Metadata for one model (models.get); raises if it does not exist or is not accessible."""
+    client = get_gemini_client()
+    async with provider_slot("gemini"):
+        model = await client.aio.models.get(model=model_name)
+    return {"name": model.name.removeprefix("models/"), "display_name": getattr(model, "display_name", None)}
 
-async def test_gemini_model(model_name: str) -> dict:
+# Longest reference side worth sending for each output size tier
+REFERENCE_LONG_SIDE = {"1K": 1024, "2K": 2048, "4K": 4096}
+
+def _process_images(image_inputs: list, image_size: str = "1K") -> list:
     """
-    Test if a Gemini model name is valid by making a minimal API call.
-    Returns: { success: bool, error?: str }
+    Helper to turn Base64/URL images into request Parts.
+    References larger than the output tier are downsampled first; others are
+    sent as-is (no PIL decode/re-encode). Each input is decoded once per
+    request via the shared media blobs.
     """
-    if not API_KEY:
-        return {"success": False, "error": "GOOGLE_API_KEY not configured"}
-    
-    try:
-        client = genai.Client(api_key=API_KEY)
-        
-        # Send a minimal text-only request to test model availability
-        config = types.GenerateContentConfig(
-            response_modalities=['TEXT'],
-        )
-        
-        response = client.models.generate_content(
-            model=model_name,
-            contents="Hello, respond with just 'OK'.",
-            config=config
-        )
-        
-        # If we got here without exception, model exists
-        return {"success": True, "message": f"Model '{model_name}' is accessible"}
-    
-    except Exception as e:
-        error_str = str(e)
-        if "404" in error_str:
-            return {"success": False, "error": f"Model '{model_name}' not found"}
-        if "403" in error_str:
-            return {"success": False, "error": f"Access denied for model '{model_name}'"}
-        return {"success": False, "error": error_str}
-
-def _process_images(image_inputs: list) -> list:
-    """Helper to process Base64/URL images into PIL Images."""
     images = []
     if not image_inputs:
         return images
@@ -71,32 +63,10 @@ def _process_images(image_inputs: list) -> list:
     print(f"DEBUG: Processing {len(image_inputs)} images")
     for idx, image_input in enumerate(image_inputs):
         try:
-            # Handle Image URL
-            if image_input.startswith("http"):
-                import requests
-                print(f"DEBUG: Fetching image {idx+1} from URL")
-                response = requests.get(image_input)
-                response.raise_for_status()
-                img = Image.open(io.BytesIO(response.content))
-                images.append(img)
-                print(f"DEBUG: Added image {idx+1} from URL, size: {img.size}")
-            
-            # Handle Base64
-            else:
-                if "," in image_input:
-                    image_input = image_input.split(",")[1]
-                
-                # Fix Base64 padding
-                image_input = "".join(image_input.split())
-                image_input = image_input.rstrip("=")
-                padding_needed = (4 - len(image_input) % 4) % 4
-                if padding_needed:
-                    image_input += "=" * padding_needed
-                
-                img_bytes = base64.b64decode(image_input)
-                img = Image.open(io.BytesIO(img_bytes))
-                images.append(img)
-                print(f"DEBUG: Added image {idx+1} from Base64, size: {img.size}")
+            source = "URL" if image_input.startswith("http") else "Base64"
+            blob = fit_reference(image_input, max_long_side=REFERENCE_LONG_SIDE.get(image_size)) or get_blob(image_input)
+            images.append(types.Part.from_bytes(data=blob.data, mime_type=blob.mime_type))
+            print(f"DEBUG: Added image {idx+1} from {source}, size: {blob.size}, sha256: {blob.sha256[:12]}")
                 
         except Exception as e:
             print(f"Error processing input image {idx+1}: {e}")
@@ -105,65 +75,51 @@ def _process_images(image_inputs: list) -> list:
     
     return images
 
+def _png_bytes(image: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
 def save_image_to_disk(image_data, model_name="gemini"):
     """
-    Saves image (Base64 string or PIL Image) to output_api/{date}/image/{model}_{time}_{uid}.png
-    Returns: Absolute path of saved file
+    Saves image (Base64 string, raw bytes or PIL Image) to output_api/{date}/image/{model}_{time}_{uid}.png
+    in the background (output_writer); the response does not wait on disk.
+    Returns: Absolute path the file is written to
     """
     try:
-        # 1. Prepare Directory
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        output_dir = pathlib.Path("output_api") / today / "image"
-        output_dir.mkdir(parents=True, exist_ok=True)  # Create if doesn't exist
+        clean_model = model_name.replace(":", "").replace("/", "-").split("-")[-1]  # Simplify model name
+        filepath = new_output_path("image", clean_model, ".png", create_dir=False)
 
-        # 2. Prepare Filename
-        timestamp = datetime.datetime.now().strftime("%H-%M-%S")
-        short_id = str(uuid.uuid4())[:8]
-        clean_model = model_name.replace(":", "").replace("/", "-").split("-")[-1] # Simplify model name
-        filename = f"{clean_model}_{timestamp}_{short_id}.png"
-        filepath = output_dir / filename
-
-        # 3. Save Image
+        # Decoding/encoding happens on the writer thread too
         if isinstance(image_data, Image.Image):
-            image_data.save(filepath, format="PNG")
+            data = lambda: _png_bytes(image_data)
         elif isinstance(image_data, str):
-            # Assumes Base64 string (with or without prefix)
-            if "," in image_data:
-                image_data = image_data.split(",")[1]
-            # Fix padding if needed (reuse logic or assume logic elsewhere, but good to be safe)
-            image_data = "".join(image_data.split())
-            image_data = image_data.rstrip("=")
-            padding_needed = (4 - len(image_data) % 4) % 4
-            if padding_needed:
-                image_data += "=" * padding_needed
-                
-            img_bytes = base64.b64decode(image_data)
-            with open(filepath, "wb") as f:
-                f.write(img_bytes)
-        
-        print(f"DEBUG: Saved image to: {filepath.absolute()}")
-        return str(filepath.absolute())
+            # Base64 string (with or without prefix)
+            data = lambda: decode_base64(image_data)
+        else:
+            data = bytes(image_data)
+
+        return output_writer.write(filepath, data)
     except Exception as e:
-        print(f"ERROR: Failed to save image to disk: {e}")
-        import traceback
-        traceback.print_exc()
+        print(f"ERROR: Failed to queue image for saving: {e}")
         return None
 
 async def generate_image_gemini(
     prompt: str,
     model_alias: str = "flash",
     image_inputs: list = None,
-    parameters: dict = None
+    parameters: dict = None,
+    session_id: str = DEFAULT_SESSION_ID
 ):
     """
     Generates content (image + text/reasoning) using specific Gemini models.
     
     Strategy:
-    - Multiple images (2+): Uses generate_content() for proper multi-image blending
-    - Single/no image: Uses chat mode for conversational continuity with thought signatures
+    - With images: Uses generate_content() for proper multi-image blending
+    - No image: Uses the client's chat session (session_id) for conversational
+      continuity with thought signatures
     """
-    global chat_session, current_chat_model
-    
     print(f"DEBUG: generate_image_gemini called with prompt length: {len(prompt)}")
     print(f"DEBUG: model_alias: {model_alias}")
     print(f"DEBUG: image_inputs count: {len(image_inputs) if image_inputs else 0}")
@@ -186,8 +142,8 @@ async def generate_image_gemini(
             target_model_name = model_alias
             print(f"DEBUG: Using custom model name: {target_model_name}")
         
-        # Initialize Client
-        client = genai.Client(api_key=API_KEY)
+        # Shared client (async interface via client.aio)
+        client = get_gemini_client()
 
         # Get aspect ratio and resolution from parameters
         aspect_ratio = parameters.get("aspectRatio", "1:1") if parameters else "1:1"
@@ -206,8 +162,8 @@ async def generate_image_gemini(
         
         print(f"DEBUG: Model: {target_model_name}, Aspect: {aspect_ratio} (auto={use_auto_aspect}), Size: {image_size}")
 
-        # Process images
-        images = _process_images(image_inputs)
+        # Process images (URL fetches and decoding off the event loop)
+        images = await asyncio.to_thread(_process_images, image_inputs, image_size)
         
         # Note: Explicitly removed safety_settings - passing BLOCK_NONE was causing MORE censorship.
         # Letting the API use its defaults is often more permissive for authorized accounts.
@@ -248,26 +204,29 @@ async def generate_image_gemini(
             # Build contents: [image1, image2, ..., prompt] - IMAGES FIRST!
             contents = images + [prompt]
             
-            response = client.models.generate_content(
-                model=target_model_name,
-                contents=contents,
-                config=config
-            )
+            async with provider_slot("gemini"):
+                response = await client.aio.models.generate_content(
+                    model=target_model_name,
+                    contents=contents,
+                    config=config
+                )
         else:
             # TEXT-ONLY MODE: Use chat for conversational continuity
             print("INFO: Using CHAT mode (no images, text-only)")
             
-            if chat_session is None or current_chat_model != target_model_name:
-                print(f"INFO: Starting new chat session with {target_model_name}")
-                chat_session = client.chats.create(
+            def _create_chat(history):
+                return client.aio.chats.create(
                     model=target_model_name,
-                    config=config
+                    config=config,
+                    history=history
                 )
-                current_chat_model = target_model_name
-            else:
-                print("INFO: Continuing existing chat session")
             
-            response = chat_session.send_message([prompt])
+            # One turn at a time per session; other sessions proceed in parallel
+            async with sessions.lock(session_id, target_model_name):
+                chat_session = sessions.get(session_id, target_model_name, _create_chat)
+                async with provider_slot("gemini"):
+                    response = await chat_session.send_message([prompt])
+                sessions.record_turn(session_id, target_model_name, _create_chat)
         
         # Process response - handle different response formats
         generated_image_b64 = None
@@ -0,0 +1,96 @@
+"""
+Hint Cache - ControlNet preprocessor outputs on disk, keyed by content.
+
+A hint is identified by the SHA-256 of the reference image bytes, the
+preprocessor, and every parameter that changes its output (resolution,
+style/model, reference upscale). Identical requests are served from disk
+without a ComfyUI round trip:
+
+    output_api/hint_cache/{key}.png
+
+The cache is bounded by file count; the oldest hints are pruned first.
+"""
+
+import os
+import json
+import hashlib
+import pathlib
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+from workflow.params import validate_params
+from workflow.modules import PREPROCESSOR_PARAMS
+
+# Load environment variables
+load_dotenv()
+
+HINT_CACHE_DIR = pathlib.Path(os.getenv("HINT_CACHE_DIR", "output_api/hint_cache"))
+HINT_CACHE_MAX_FILES = int(os.getenv("HINT_CACHE_MAX_FILES", "5000"))
+PRUNE_EVERY = 100  # Check the size limit once per this many writes
+
+# Reference chain params that change every hint
+REFERENCE_PARAMS = ("controlnet_upscale_model", "controlnet_upscale_factor", "controlnet_upscale_method")
+
+_writes_since_prune = 0
+
+
+def image_digest(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def hint_key(image_sha: str, preprocessor: str, params: Dict[str, Any]) -> str:
+    """Cache key for one preprocessor output of one reference image."""
+    validated = validate_params(params)
+    relevant = {name: validated.get(name) for name in (*REFERENCE_PARAMS, *PREPROCESSOR_PARAMS[preprocessor])}
+    payload = json.dumps([image_sha, preprocessor, relevant], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:40]
+
+
+def get_hint(key: str) -> Optional[bytes]:
+    path = HINT_CACHE_DIR / f"{key}.png"
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"WARN: Could not read cached hint {key}: {e}")
+        return None
+
+
+def put_hint(key: str, png_bytes: bytes) -> None:
+    """Stores a hint atomically (write to temp file, then rename)."""
+    global _writes_since_prune
+    try:
+        HINT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = HINT_CACHE_DIR / f"{key}.png"
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(png_bytes)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"WARN: Could not cache hint {key}: {e}")
+        return
+
+    _writes_since_prune += 1
+    if _writes_since_prune >= PRUNE_EVERY:
+        _writes_since_prune = 0
+        prune_hints()
+
+
+def prune_hints() -> int:
+    """
+    Deletes the oldest hints beyond HINT_CACHE_MAX_FILES.
+    Returns: Number of hints removed.
+    """
+    if not HINT_CACHE_DIR.exists():
+        return 0
+    files = sorted(HINT_CACHE_DIR.glob("*.png"), key=lambda p: p.stat().st_mtime, reverse=True)
+    removed = 0
+    for path in files[HINT_CACHE_MAX_FILES:]:
+        try:
+            path.unlink()
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        print(f"INFO: Pruned {removed} cached hint(s)")
+    return removed
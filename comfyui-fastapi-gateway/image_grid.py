@@ -0,0 +1,71 @@
+"""
+Image Grid - labelled X/Y comparison grids for matrix generations.
+"""
+
+import io
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+LABEL_BAND = 48          # Height of the column header band (px)
+LABEL_MAX_CHARS = 48
+BACKGROUND = 255         # White
+TEXT_COLOR = (0, 0, 0)
+
+
+def _shorten(label: str) -> str:
+    label = " ".join(str(label).split())
+    return label if len(label) <= LABEL_MAX_CHARS else label[:LABEL_MAX_CHARS - 3] + "..."
+
+
+def compose_grid(
+    cells: Dict[Tuple[int, int], bytes],
+    x_labels: List[str],
+    y_labels: Optional[List[str]] = None,
+) -> bytes:
+    """
+    Compose cell images into one labelled grid PNG.
+
+    Args:
+        cells: {(x, y): image_bytes}; missing cells are left blank
+        x_labels: Column labels
+        y_labels: Row labels (None for a single row)
+
+    Returns:
+        PNG bytes of the grid
+    """
+    rows = len(y_labels) if y_labels else 1
+    cols = len(x_labels)
+
+    arrays = {}
+    for key, image_bytes in cells.items():
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            arrays[key] = np.asarray(img.convert("RGB"))
+
+    if not arrays:
+        raise ValueError("No cell images to compose")
+
+    cell_h = max(a.shape[0] for a in arrays.values())
+    cell_w = max(a.shape[1] for a in arrays.values())
+    label_w = 0
+    if y_labels:
+        label_w = min(cell_w, max(160, 8 * max(len(_shorten(l)) for l in y_labels)))
+
+    grid = np.full((LABEL_BAND + rows * cell_h, label_w + cols * cell_w, 3), BACKGROUND, dtype=np.uint8)
+    for (x, y), arr in arrays.items():
+        top = LABEL_BAND + y * cell_h
+        left = label_w + x * cell_w
+        grid[top:top + arr.shape[0], left:left + arr.shape[1]] = arr
+
+    image = Image.fromarray(grid)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for x, label in enumerate(x_labels):
+        draw.text((label_w + x * cell_w + 8, LABEL_BAND // 3), _shorten(label), fill=TEXT_COLOR, font=font)
+    for y, label in enumerate(y_labels or []):
+        draw.text((8, LABEL_BAND + y * cell_h + cell_h // 2), _shorten(label), fill=TEXT_COLOR, font=font)
+
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
@@ -0,0 +1,169 @@
+"""
+Latent Store - persisted base latents for the refine API.
+
+Each job that opts into persist_latent keeps its base-pass latent (the
+.latent file written by ComfyUI's SaveLatent) plus the parameters needed to
+rebuild its model and conditioning chain:
+
+    output_api/latents/{job_id}.latent
+    output_api/latents/{job_id}.json
+
+Retention is bounded by job count and age, and is enforced on every save.
+
+ComfyUI keeps its own copies: SaveLatent writes
+output/gateway_latents/{job_id}_NNNNN_.latent and every refine uploads
+input/gateway_latent_{job_id}.latent. When ComfyUI's directories are
+visible to the gateway (COMFYUI_OUTPUT_DIR / COMFYUI_INPUT_DIR, e.g. same
+host or a shared volume), those copies are deleted together with the
+gateway's. Otherwise they need an external sweep; add_eviction_hook()
+registers a callback that is told every evicted job ID for that purpose.
+"""
+
+import os
+import re
+import json
+import time
+import pathlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+LATENT_STORE_DIR = pathlib.Path(os.getenv("LATENT_STORE_DIR", "output_api/latents"))
+LATENT_RETENTION_MAX_JOBS = int(os.getenv("LATENT_RETENTION_MAX_JOBS", "50"))
+LATENT_RETENTION_MAX_AGE_HOURS = float(os.getenv("LATENT_RETENTION_MAX_AGE_HOURS", "24"))
+
+# ComfyUI's output/ and input/ directories, if this process can reach them
+COMFYUI_OUTPUT_DIR = os.getenv("COMFYUI_OUTPUT_DIR")
+COMFYUI_INPUT_DIR = os.getenv("COMFYUI_INPUT_DIR")
+
+_JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_eviction_hooks: List[Callable[[str], None]] = []
+
+
+def add_eviction_hook(hook: Callable[[str], None]) -> None:
+    """Registers hook(job_id), called after a job's latent is evicted (e.g. to clean a remote ComfyUI)."""
+    _eviction_hooks.append(hook)
+
+
+def _is_valid_job_id(job_id: str) -> bool:
+    return bool(job_id) and bool(_JOB_ID_PATTERN.match(job_id))
+
+
+def _storable_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop inline image payloads and non-JSON values from the job params."""
+    stored = {}
+    for key, value in params.items():
+        if key.endswith("_base64") or callable(value):
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        stored[key] = value
+    return stored
+
+
+def save_job_latent(job_id: str, latent_bytes: bytes, params: Dict[str, Any]) -> Optional[str]:
+    """
+    Saves a job's base latent and its parameters, then applies retention.
+    Returns: Absolute path of the saved latent, or None on failure.
+    """
+    if not _is_valid_job_id(job_id):
+        print(f"ERROR: Refusing to store latent for invalid job id: {job_id!r}")
+        return None
+    try:
+        LATENT_STORE_DIR.mkdir(parents=True, exist_ok=True)
+        latent_path = LATENT_STORE_DIR / f"{job_id}.latent"
+        meta_path = LATENT_STORE_DIR / f"{job_id}.json"
+
+        with open(latent_path, "wb") as f:
+            f.write(latent_bytes)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"job_id": job_id, "created_at": time.time(), "params": _storable_params(params)}, f)
+
+        print(f"DEBUG: Stored base latent for job {job_id} ({len(latent_bytes)} bytes)")
+        prune_job_latents()
+        return str(latent_path.absolute())
+    except Exception as e:
+        print(f"ERROR: Failed to store latent for job {job_id}: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
+
+
+def load_job_latent(job_id: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+    """
+    Loads a job's base latent and stored parameters.
+    Returns: (latent_bytes, params) or None if unknown or expired.
+    """
+    if not _is_valid_job_id(job_id):
+        return None
+    latent_path = LATENT_STORE_DIR / f"{job_id}.latent"
+    meta_path = LATENT_STORE_DIR / f"{job_id}.json"
+    if not latent_path.exists() or not meta_path.exists():
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if _is_expired(meta.get("created_at", 0)):
+            _delete_job(job_id)
+            return None
+        return latent_path.read_bytes(), meta.get("params", {})
+    except Exception as e:
+        print(f"ERROR: Failed to load latent for job {job_id}: {e}")
+        return None
+
+
+def _is_expired(created_at: float) -> bool:
+    return (time.time() - created_at) > LATENT_RETENTION_MAX_AGE_HOURS * 3600
+
+
+def _comfyui_copies(job_id: str) -> List[pathlib.Path]:
+    """ComfyUI-side files for a job: SaveLatent outputs and uploaded refine inputs."""
+    paths: List[pathlib.Path] = []
+    if COMFYUI_OUTPUT_DIR:
+        paths.extend((pathlib.Path(COMFYUI_OUTPUT_DIR) / "gateway_latents").glob(f"{job_id}_*.latent"))
+    if COMFYUI_INPUT_DIR:
+        paths.append(pathlib.Path(COMFYUI_INPUT_DIR) / f"gateway_latent_{job_id}.latent")
+    return paths
+
+
+def _delete_job(job_id: str) -> None:
+    paths = [LATENT_STORE_DIR / f"{job_id}{suffix}" for suffix in (".latent", ".json")]
+    for path in paths + _comfyui_copies(job_id):
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as e:
+            print(f"WARN: Could not delete {path}: {e}")
+    for hook in _eviction_hooks:
+        try:
+            hook(job_id)
+        except Exception as e:
+            print(f"WARN: Latent eviction hook failed for {job_id}: {e}")
+
+
+def prune_job_latents() -> int:
+    """
+    Deletes expired latents and the oldest ones beyond the job limit.
+    Returns: Number of jobs removed.
+    """
+    if not LATENT_STORE_DIR.exists():
+        return 0
+
+    jobs = []
+    for meta_path in LATENT_STORE_DIR.glob("*.json"):
+        jobs.append((meta_path.stat().st_mtime, meta_path.stem))
+    jobs.sort(reverse=True)  # Newest first
+
+    removed = 0
+    for index, (mtime, job_id) in enumerate(jobs):
+        if index >= LATENT_RETENTION_MAX_JOBS or _is_expired(mtime):
+            _delete_job(job_id)
+            removed += 1
+
+    if removed:
+        print(f"INFO: Pruned {removed} stored latent(s)")
+    return removed
@@ -0,0 +1,113 @@
+"""
+Local Preprocessors - cheap CPU ControlNet preprocessors run in the gateway.
+
+Canny needs no model, so interactive previews compute it in a process pool
+here instead of queueing a ComfyUI prompt behind GPU jobs. Output matches
+ComfyUI's CannyEdgePreprocessor (comfyui_controlnet_aux):
+
+  - LoadImage: EXIF transpose, RGB, uint8 -> float32 -> uint8 round trip
+  - resize so the short side equals `resolution` (INTER_CUBIC up, INTER_AREA down),
+    edge-pad to a multiple of 64, run the detector, crop the padding
+  - 3-channel output at the resized size
+
+Only references that need no model upscale or rescale qualify; those still
+go through ComfyUI.
+"""
+
+import io
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from workflow.params import validate_params
+from workflow.modules import CANNY_LOW_THRESHOLD, CANNY_HIGH_THRESHOLD
+
+LOCAL_PREPROCESS_WORKERS = int(os.getenv("LOCAL_PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+LOCAL_PREPROCESS_ENABLED = os.getenv("LOCAL_PREPROCESS_ENABLED", "1") not in ("0", "false", "False")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _load_image(image_bytes: bytes) -> np.ndarray:
+    """Decode like ComfyUI's LoadImage and the annotator's tensor -> uint8 conversion."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        as_float = np.array(img).astype(np.float32) / 255.0
+    return np.asarray(as_float * 255.0, dtype=np.uint8)
+
+
+def _detect_resolution(resolution: Any) -> int:
+    # Same fallback as the annotator wrapper
+    return resolution if isinstance(resolution, int) and resolution >= 64 else 512
+
+
+def _resize_with_pad(img: np.ndarray, resolution: int):
+    height, width = img.shape[:2]
+    k = float(resolution) / float(min(height, width))
+    target_h = int(np.round(float(height) * k))
+    target_w = int(np.round(float(width) * k))
+    interpolation = cv2.INTER_CUBIC if k > 1 else cv2.INTER_AREA
+    img = cv2.resize(img, (target_w, target_h), interpolation=interpolation)
+    pad_h = int(np.ceil(target_h / 64.0) * 64 - target_h)
+    pad_w = int(np.ceil(target_w / 64.0) * 64 - target_w)
+    padded = np.pad(img, [[0, pad_h], [0, pad_w], [0, 0]], mode="edge")
+    return np.ascontiguousarray(padded), (target_h, target_w)
+
+
+def _canny_png(image_bytes: bytes, resolution: int, low_threshold: int, high_threshold: int) -> bytes:
+    """Process-pool worker: reference image bytes -> Canny hint PNG bytes."""
+    img = _load_image(image_bytes)
+    padded, (target_h, target_w) = _resize_with_pad(img, _detect_resolution(resolution))
+    edges = cv2.Canny(padded, low_threshold, high_threshold)
+    edges = np.ascontiguousarray(edges[:target_h, :target_w])
+    ok, encoded = cv2.imencode(".png", cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR))
+    if not ok:
+        raise RuntimeError("PNG encoding failed")
+    return encoded.tobytes()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=LOCAL_PREPROCESS_WORKERS)
+            print(f"INFO: Local preprocessor pool started ({LOCAL_PREPROCESS_WORKERS} workers)")
+        return _pool
+
+
+def supports_local(name: str, params: Dict[str, Any]) -> bool:
+    """True if the preprocessor can run in the gateway for this reference chain."""
+    if not LOCAL_PREPROCESS_ENABLED or name != "canny":
+        return False
+    upscale_model = params.get("controlnet_upscale_model")
+    if upscale_model and upscale_model != "None":
+        return False
+    return (params.get("controlnet_upscale_factor") or 1.0) == 1.0
+
+
+def submit_local(name: str, image_bytes: bytes, params: Dict[str, Any]) -> "Future[bytes]":
+    """Queue a local preprocessor run; the future resolves to hint PNG bytes."""
+    if name != "canny":
+        raise ValueError(f"No local implementation for preprocessor: {name}")
+    validated = validate_params(params)
+    return _get_pool().submit(
+        _canny_png,
+        image_bytes,
+        validated["cn_canny_resolution"],
+        CANNY_LOW_THRESHOLD,
+        CANNY_HIGH_THRESHOLD,
+    )
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
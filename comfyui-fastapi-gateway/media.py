@@ -0,0 +1,253 @@
+"""
+Media - shared helpers for reference images passed as base64/data URIs or URLs.
+
+Image dimensions are read from the file header only (PNG IHDR, JPEG SOFn,
+WebP VP8/VP8L/VP8X, GIF), so a base64 input is decoded a few hundred bytes
+at a time instead of whole, and a URL input is fetched only until its header
+has arrived. Results are cached by content hash (by URL for URL inputs).
+
+Inputs that are needed in full go through get_blob(), which decodes each one
+once into a MediaBlob (bytes, SHA-256, type, size). Inside media_scope() -
+one per API request - every service asking for the same input gets the same
+blob, so a large reference is decoded and hashed once per request rather
+than once per consumer.
+"""
+
+import base64
+import struct
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, NamedTuple, Optional, Tuple
+
+SNIFF_INITIAL_CHARS = 512             # First base64 window (384 bytes covers PNG/WebP/GIF)
+SNIFF_MAX_BYTES = 2 * 1024 * 1024     # JPEGs with large EXIF/ICC segments need more; give up after this
+SIZE_CACHE_LIMIT = 1024
+
+# SOF markers carry the frame size; C4 (DHT), C8 (JPG) and CC (DAC) share the range but do not
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class ImageInfo(NamedTuple):
+    mime_type: str
+    width: int
+    height: int
+
+
+_size_cache: "OrderedDict[str, Optional[ImageInfo]]" = OrderedDict()
+_size_cache_lock = threading.Lock()
+
+
+def _sniff_jpeg(data: bytes) -> Optional[ImageInfo]:
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None  # Not at a marker: corrupt or unsupported stream
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:  # Standalone markers
+            pos += 2
+            continue
+        if marker == 0xD9:  # EOI before any frame
+            return None
+        segment_length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return ImageInfo("image/jpeg", width, height)
+        pos += 2 + segment_length
+    return None
+
+
+def sniff_image(header: bytes) -> Optional[ImageInfo]:
+    """
+    Image type and size from the leading bytes of a file.
+    Returns None if the header is not recognised or more bytes are needed.
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24 and header[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", header[16:24])
+        return ImageInfo("image/png", width, height)
+
+    if header.startswith(b"\xff\xd8"):
+        return _sniff_jpeg(header)
+
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP" and len(header) >= 30:
+        chunk = header[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", header[26:30])
+            return ImageInfo("image/webp", width & 0x3FFF, height & 0x3FFF)
+        if chunk == b"VP8L" and header[20] == 0x2F:
+            b0, b1, b2, b3 = header[21:25]
+            width = 1 + (b0 | ((b1 & 0x3F) << 8))
+            height = 1 + ((b1 >> 6) | (b2 << 2) | ((b3 & 0x0F) << 10))
+            return ImageInfo("image/webp", width, height)
+        if chunk == b"VP8X":
+            width = 1 + int.from_bytes(header[24:27], "little")
+            height = 1 + int.from_bytes(header[27:30], "little")
+            return ImageInfo("image/webp", width, height)
+
+    if header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        width, height = struct.unpack("<HH", header[6:10])
+        return ImageInfo("image/gif", width, height)
+
+    return None
+
+
+def strip_data_uri(image_input: str) -> str:
+    """Base64 payload of a data URI (or the input unchanged if it has no header)."""
+    return image_input.split(",", 1)[1] if "," in image_input else image_input
+
+
+def _decode_prefix(encoded: str, chars: int) -> bytes:
+    """Decodes roughly the first `chars` base64 characters (whitespace skipped, padding tolerated)."""
+    window = "".join(encoded[:chars].split())
+    if chars < len(encoded):
+        window = window[:len(window) - len(window) % 4]
+    else:
+        window = window.rstrip("=")
+        window += "=" * ((4 - len(window) % 4) % 4)
+    return base64.b64decode(window)
+
+
+def _sniff_base64(encoded: str) -> Optional[ImageInfo]:
+    chars = SNIFF_INITIAL_CHARS
+    max_chars = SNIFF_MAX_BYTES * 4 // 3
+    while True:
+        info = sniff_image(_decode_prefix(encoded, chars))
+        if info is not None or chars >= len(encoded) or chars >= max_chars:
+            return info
+        chars *= 8
+
+
+def _sniff_url(url: str) -> Optional[ImageInfo]:
+    from provider_clients import get_http_session
+
+    header = b""
+    with get_http_session().get(url, stream=True, timeout=30, headers={"Range": f"bytes=0-{SNIFF_MAX_BYTES - 1}"}) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            header += chunk
+            info = sniff_image(header)
+            if info is not None or len(header) >= SNIFF_MAX_BYTES:
+                return info
+    return sniff_image(header)
+
+
+def _cached(key: str, compute) -> Optional[ImageInfo]:
+    with _size_cache_lock:
+        if key in _size_cache:
+            _size_cache.move_to_end(key)
+            return _size_cache[key]
+    info = compute()
+    with _size_cache_lock:
+        _size_cache[key] = info
+        while len(_size_cache) > SIZE_CACHE_LIMIT:
+            _size_cache.popitem(last=False)
+    return info
+
+
+def get_image_info(image_input: str) -> Optional[ImageInfo]:
+    """Type and size of a base64/data-URI or http(s) image, read from its header; None if unreadable."""
+    if not image_input:
+        return None
+    blob = _scope_blob(image_input)
+    if blob is not None:
+        return blob.info
+    try:
+        if image_input.startswith("http"):
+            return _cached(f"url:{image_input}", lambda: _sniff_url(image_input))
+        encoded = strip_data_uri(image_input)
+        digest = hashlib.sha1(encoded.encode("ascii", "ignore")).hexdigest()
+        return _cached(f"b64:{digest}", lambda: _sniff_base64(encoded))
+    except Exception as e:
+        print(f"WARN: [Media] Could not read image header: {e}")
+        return None
+
+
+def get_image_size(image_input: str) -> Tuple[Optional[int], Optional[int]]:
+    """(width, height) of a base64/data-URI or http(s) image, or (None, None)."""
+    info = get_image_info(image_input)
+    return (info.width, info.height) if info else (None, None)
+
+
+# --- Decoded blobs ---
+
+def decode_base64(image_input: str) -> bytes:
+    """Decodes base64 or a data URI, tolerating embedded whitespace and missing padding."""
+    encoded = "".join(strip_data_uri(image_input).split()).rstrip("=")
+    return base64.b64decode(encoded + "=" * ((4 - len(encoded) % 4) % 4))
+
+
+class MediaBlob:
+    """One decoded input: the raw bytes plus their SHA-256, type and size, computed once."""
+
+    __slots__ = ("data", "sha256", "info")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.info = sniff_image(data)
+
+    @property
+    def view(self) -> memoryview:
+        """Zero-copy view for slicing/writing without duplicating the bytes."""
+        return memoryview(self.data)
+
+    @property
+    def mime_type(self) -> str:
+        # Every input handled here is an image; PNG is the historical default
+        return self.info.mime_type if self.info else "image/png"
+
+    @property
+    def size(self) -> Tuple[Optional[int], Optional[int]]:
+        return (self.info.width, self.info.height) if self.info else (None, None)
+
+    def data_uri(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+
+_request_blobs: "contextvars.ContextVar[Optional[Dict[str, MediaBlob]]]" = contextvars.ContextVar("media_request_blobs", default=None)
+
+
+@contextmanager
+def media_scope():
+    """Shares decoded blobs for the duration of one request (nested scopes reuse the outer one)."""
+    if _request_blobs.get() is not None:
+        yield
+        return
+    token = _request_blobs.set({})
+    try:
+        yield
+    finally:
+        _request_blobs.reset(token)
+
+
+def _scope_blob(image_input: str) -> Optional[MediaBlob]:
+    blobs = _request_blobs.get()
+    return blobs.get(image_input) if blobs is not None else None
+
+
+def get_blob(image_input: str) -> MediaBlob:
+    """
+    Decodes a base64/data-URI input (or downloads an http(s) one) into a MediaBlob,
+    reusing the request's blob if this input was already decoded.
+    """
+    blob = _scope_blob(image_input)
+    if blob is not None:
+        return blob
+    if image_input.startswith("http"):
+        from provider_clients import get_http_session
+        response = get_http_session().get(image_input, timeout=60)
+        response.raise_for_status()
+        blob = MediaBlob(response.content)
+    else:
+        blob = MediaBlob(decode_base64(image_input))
+    blobs = _request_blobs.get()
+    if blobs is not None:
+        blobs[image_input] = blob
+    return blob
@@ -0,0 +1,147 @@
+"""
+Media Store - files under output_api/ addressed by a stable media ID.
+
+Saved outputs live at output_api/{date}/{kind}/{filename}; their media ID is
+"{date}_{kind}_{filename}" and they are served by GET /api/media/{media_id}
+with HTTP Range support, so clients get a URL instead of a base64 payload.
+
+Downloads are streamed to disk in chunks (never held in memory whole) and
+renamed into place only when complete.
+"""
+
+import os
+import re
+import uuid
+import pathlib
+import datetime
+import threading
+from typing import Iterator, Optional, Set, Tuple
+
+OUTPUT_ROOT = pathlib.Path("output_api")
+MEDIA_KINDS = ("video", "image")
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+MEDIA_TYPES = {
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+_known_dirs: Set[pathlib.Path] = set()  # Directories already created; mkdir is slow on network volumes
+_known_dirs_lock = threading.Lock()
+
+_MEDIA_ID_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})_(video|image)_([A-Za-z0-9][A-Za-z0-9_.-]*)$")
+
+
+def ensure_dir(directory: pathlib.Path) -> None:
+    """Creates a directory once per process; later calls are a set lookup."""
+    with _known_dirs_lock:
+        if directory in _known_dirs:
+            return
+    directory.mkdir(parents=True, exist_ok=True)
+    with _known_dirs_lock:
+        _known_dirs.add(directory)
+
+
+def forget_dir(directory: pathlib.Path) -> None:
+    """Drops a directory from the cache (it was removed behind our back)."""
+    with _known_dirs_lock:
+        _known_dirs.discard(directory)
+
+
+def new_output_path(kind: str, stem: str, extension: str, create_dir: bool = True) -> pathlib.Path:
+    """
+    output_api/{date}/{kind}/{stem}_{time}_{uid}{extension}.
+    The directory is created unless create_dir is False (the output writer creates it off the request path).
+    """
+    now = datetime.datetime.now()
+    output_dir = OUTPUT_ROOT / now.strftime("%Y-%m-%d") / kind
+    if create_dir:
+        ensure_dir(output_dir)
+    short_id = str(uuid.uuid4())[:8]
+    return output_dir / f"{stem}_{now.strftime('%H-%M-%S')}_{short_id}{extension}"
+
+
+def media_id_for(path: str) -> Optional[str]:
+    """Media ID of a file saved under OUTPUT_ROOT, or None if it is elsewhere."""
+    parts = pathlib.Path(path).resolve().parts[-3:]
+    media_id = "_".join(parts) if len(parts) == 3 else ""
+    resolved = resolve_media(media_id)
+    return media_id if resolved is not None and resolved == pathlib.Path(path).resolve() else None
+
+
+def resolve_media(media_id: str) -> Optional[pathlib.Path]:
+    """Path of an existing media file, or None (unknown ID or not on disk)."""
+    match = _MEDIA_ID_PATTERN.match(media_id)
+    if not match or ".." in media_id:
+        return None
+    date, kind, filename = match.groups()
+    path = (OUTPUT_ROOT / date / kind / filename).resolve()
+    return path if path.is_file() else None
+
+
+def media_type(path: pathlib.Path) -> str:
+    return MEDIA_TYPES.get(path.suffix.lower(), "application/octet-stream")
+
+
+def stream_to_file(chunks: Iterator[bytes], path: pathlib.Path) -> int:
+    """
+    Writes chunks to path via a temp file, renamed into place when complete.
+    Returns: Bytes written
+    """
+    tmp_path = path.with_suffix(path.suffix + ".part")
+    written = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return written
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single-range "bytes=start-end" header into inclusive (start, end).
+    Returns None for no/unsupported ranges (serve the whole file);
+    raises ValueError if the range cannot be satisfied (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_str, _, end_str = header[len("bytes="):].strip().partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+        else:
+            # Suffix range: the last N bytes
+            length = int(end_str)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            start, end = max(0, size - length), size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {header}")
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError(f"Range not satisfiable: {header}")
+    return start, end
+
+
+def iter_file(path: pathlib.Path, start: int, end: int, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yields bytes start..end (inclusive) of a file in chunks."""
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
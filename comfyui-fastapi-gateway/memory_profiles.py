@@ -0,0 +1,114 @@
+"""
+Memory Profiles - per-backend weight loading settings.
+
+Each ComfyUI backend (server address) can be assigned a memory profile. The
+"low_vram" profile loads UNet weights in fp8 through the split UNet / CLIP /
+VAE loaders, which needs the checkpoint's components as separate files; a
+checkpoint without a split entry keeps the regular loader. Configuration
+lives in a JSON file (MEMORY_PROFILES_FILE, see memory_profiles.example.json):
+
+    {
+        "backends": {"192.168.1.20:8188": "low_vram"},
+        "profiles": {"low_vram": {"unet_weight_dtype": "fp8_e4m3fn"}},
+        "split_checkpoints": {
+            "sdxl\\model.safetensors": {
+                "unet": "model_unet.safetensors",
+                "clip": ["clip_l.safetensors", "clip_g.safetensors"],
+                "clip_type": "sdxl",
+                "vae": "sdxl_vae.safetensors"
+            }
+        }
+    }
+
+A request may also pick a profile explicitly with memory_profile.
+"""
+
+import os
+import json
+from typing import Any, Dict, Optional
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+MEMORY_PROFILES_FILE = os.getenv(
+    "MEMORY_PROFILES_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_profiles.json"),
+)
+
+DEFAULT_PROFILE = "default"
+
+# Built-in profiles; the config file may override or add to these
+BUILTIN_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {},
+    "low_vram": {"unet_weight_dtype": "fp8_e4m3fn"},
+}
+
+_config: Optional[Dict[str, Any]] = None
+
+
+def _load_config() -> Dict[str, Any]:
+    """Reads the profile config once; a missing file means every backend is default."""
+    global _config
+    if _config is not None:
+        return _config
+
+    config: Dict[str, Any] = {"backends": {}, "profiles": dict(BUILTIN_PROFILES), "split_checkpoints": {}}
+    if os.path.exists(MEMORY_PROFILES_FILE):
+        try:
+            with open(MEMORY_PROFILES_FILE, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            config["backends"].update(loaded.get("backends", {}))
+            for name, settings in loaded.get("profiles", {}).items():
+                config["profiles"][name] = {**config["profiles"].get(name, {}), **settings}
+            # Checkpoint names are matched with ComfyUI's backslash separators
+            for ckpt_name, split in loaded.get("split_checkpoints", {}).items():
+                config["split_checkpoints"][ckpt_name.replace("/", "\\")] = split
+            print(f"INFO: Loaded memory profiles from {MEMORY_PROFILES_FILE} ({len(config['backends'])} backend(s))")
+        except Exception as e:
+            print(f"ERROR: Failed to load memory profiles from {MEMORY_PROFILES_FILE}: {e}")
+    _config = config
+    return _config
+
+
+def get_backend_profile(server_address: str) -> str:
+    """Profile name assigned to a backend (default when unassigned)."""
+    return _load_config()["backends"].get(server_address, DEFAULT_PROFILE)
+
+
+def _split_for(ckpt_name: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not ckpt_name:
+        return None
+    return _load_config()["split_checkpoints"].get(ckpt_name.replace("/", "\\"))
+
+
+def apply_memory_profile(params: Dict[str, Any], server_address: str) -> Dict[str, Any]:
+    """
+    Returns params with the backend's weight loading settings resolved:
+    memory_profile, unet_weight_dtype, and split_checkpoint /
+    split_checkpoint_model2 for checkpoints that have split components.
+    """
+    config = _load_config()
+    profile_name = params.get("memory_profile") or get_backend_profile(server_address)
+    profile = config["profiles"].get(profile_name)
+    if profile is None:
+        print(f"WARN: Unknown memory profile '{profile_name}', using '{DEFAULT_PROFILE}'")
+        profile_name, profile = DEFAULT_PROFILE, {}
+
+    resolved = dict(params)
+    resolved["memory_profile"] = profile_name
+    weight_dtype = profile.get("unet_weight_dtype")
+    if not weight_dtype or weight_dtype == "default":
+        return resolved
+
+    resolved["unet_weight_dtype"] = weight_dtype
+    split = _split_for(params.get("model_name"))
+    if split:
+        resolved["split_checkpoint"] = split
+    else:
+        print(f"WARN: No split components for '{params.get('model_name')}', loading it at default precision")
+    if params.get("model_merge_enabled"):
+        split2 = _split_for(params.get("model2_name"))
+        if split2:
+            resolved["split_checkpoint_model2"] = split2
+    return resolved
@@ -0,0 +1,66 @@
+"""
+Metrics - in-process job metrics for the gateway.
+
+Keeps the most recent job records and rolling hires timings per strategy.
+The full-frame "model" strategy is the baseline that other hires
+strategies report their time saved against.
+"""
+
+import time
+import threading
+from collections import deque
+from typing import Any, Dict, Optional
+
+RECENT_JOBS_LIMIT = 200
+HIRES_BASELINE_STRATEGY = "model"
+EWMA_ALPHA = 0.2  # Weight of the newest sample in the rolling averages
+
+_lock = threading.Lock()
+_recent_jobs = deque(maxlen=RECENT_JOBS_LIMIT)
+_hires_seconds_per_mp: Dict[str, float] = {}  # strategy -> rolling seconds per output megapixel
+_counters: Dict[str, int] = {}
+
+
+def increment(name: str, amount: int = 1) -> None:
+    """Bump a named counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def record_hires_timing(strategy: str, hires_seconds: float, output_megapixels: float) -> Optional[float]:
+    """
+    Fold one hires pass into the per-strategy rolling rate.
+    Returns: Estimated seconds saved against the baseline strategy for the
+    same output size, or None if this is the baseline or no baseline exists yet.
+    """
+    if hires_seconds <= 0 or output_megapixels <= 0:
+        return None
+    rate = hires_seconds / output_megapixels
+    with _lock:
+        previous = _hires_seconds_per_mp.get(strategy)
+        _hires_seconds_per_mp[strategy] = rate if previous is None else (
+            EWMA_ALPHA * rate + (1 - EWMA_ALPHA) * previous
+        )
+        baseline = _hires_seconds_per_mp.get(HIRES_BASELINE_STRATEGY)
+    if strategy == HIRES_BASELINE_STRATEGY or baseline is None:
+        return None
+    return round(baseline * output_megapixels - hires_seconds, 3)
+
+
+def record_job(record: Dict[str, Any]) -> None:
+    """Store a finished job's metrics record."""
+    record = dict(record)
+    record.setdefault("recorded_at", time.time())
+    with _lock:
+        _recent_jobs.append(record)
+    print(f"INFO: Job metrics: {record}")
+
+
+def get_metrics() -> Dict[str, Any]:
+    """Snapshot of counters, hires rates and recent jobs (newest first)."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "hires_seconds_per_megapixel": dict(_hires_seconds_per_mp),
+            "recent_jobs": list(reversed(_recent_jobs)),
+        }
@@ -0,0 +1,203 @@
+"""
+Model Registry - cached model-availability checks for external providers.
+
+Checking a model used to mean generating with it (a Seedream 2K image, a
+Gemini generate_content call) - slow and billed. The registry answers from
+the providers' metadata instead:
+
+  - the model listing (Gemini models.list, Ark /models) is fetched once per
+    provider and reused for every check
+  - a model the listing does not show (custom "ep-..." endpoints, aliases) gets
+    one cheap probe: Gemini models.get, or a Seedream request with a size the
+    API always rejects, so nothing is generated
+  - results are cached for MODEL_REGISTRY_TTL_SECONDS ("not available" answers
+    for MODEL_REGISTRY_NEGATIVE_TTL_SECONDS, so a newly enabled model shows up
+    soon); stale entries are served while they refresh in the background
+  - a background task re-lists every provider with an API key, so a check
+    rarely waits on the provider at all
+
+Transient failures (network, 5xx) are reported but never cached.
+"""
+
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+MODEL_REGISTRY_TTL_SECONDS = float(os.getenv("MODEL_REGISTRY_TTL_SECONDS", "600"))
+MODEL_REGISTRY_NEGATIVE_TTL_SECONDS = float(os.getenv("MODEL_REGISTRY_NEGATIVE_TTL_SECONDS", "60"))
+
+PROVIDERS = ("gemini", "seedream")
+PROVIDER_API_KEYS = {"gemini": "GOOGLE_API_KEY", "seedream": "ARK_API_KEY"}
+
+# Errors that mean "this model is not available to us" rather than "try again later"
+_UNAVAILABLE_STATUSES = (401, 403, 404)
+_UNAVAILABLE_MARKERS = ("not found", "NotFound", "NOT_FOUND", "ModelNotOpen", "PERMISSION_DENIED", "does not exist")
+
+
+def _unavailable_reason(error: Exception) -> Optional[str]:
+    """Provider error text if the error says the model is unavailable, else None (transient)."""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    text = str(error)
+    if (isinstance(status, int) and status in _UNAVAILABLE_STATUSES) or any(m in text for m in _UNAVAILABLE_MARKERS):
+        return text
+    return None
+
+
+async def _list_models(provider: str) -> Set[str]:
+    if provider == "seedream":
+        from seedream_service import list_seedream_models
+        return set(await list_seedream_models())
+    from gemini_service import list_gemini_models
+    return set(await list_gemini_models())
+
+
+async def _probe_model(provider: str, model_name: str) -> Dict[str, Any]:
+    """{"available": bool, "error"?: str}; raises on transient failures."""
+    try:
+        if provider == "seedream":
+            from seedream_service import probe_seedream_model
+            return await probe_seedream_model(model_name)
+        from gemini_service import describe_gemini_model
+        await describe_gemini_model(model_name)
+        return {"available": True}
+    except Exception as e:
+        reason = _unavailable_reason(e)
+        if reason is None:
+            raise
+        return {"available": False, "error": reason}
+
+
+class ModelRegistry:
+    """Stale-while-revalidate cache of provider listings and per-model probes."""
+
+    def __init__(self, ttl: float, negative_ttl: float):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # ("list", provider) or ("probe", provider, model) -> {"value", "checked_at", "ttl"}
+        self._entries: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+        self._locks: Dict[Tuple[str, ...], asyncio.Lock] = {}
+        self._refreshing: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    # --- Lifecycle ---
+
+    def start(self) -> None:
+        """Starts the background refresher on the running loop (idempotent)."""
+        if self._task is not None and not self._task.done():
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = [t for t in (self._task, *self._refreshing) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._refreshing.clear()
+
+    async def _run(self) -> None:
+        while True:
+            for provider in PROVIDERS:
+                if not os.getenv(PROVIDER_API_KEYS[provider]):
+                    continue
+                key = ("list", provider)
+                try:
+                    await self._fetch(key, lambda p=provider: self._load_listing(p))
+                except Exception as e:
+                    print(f"WARN: [ModelRegistry] Could not list {provider} models: {e}")
+            await asyncio.sleep(self.ttl)
+
+    # --- Public API ---
+
+    async def check(self, provider: str, model_name: str) -> Dict[str, Any]:
+        """
+        Whether a model can be used, answered from cache where possible.
+        Returns: { success, message | error, cached, checked_at, source }
+        """
+        listing, listing_cached = None, False
+        try:
+            listing, listing_cached = await self._get(("list", provider), lambda: self._load_listing(provider))
+        except Exception as e:
+            print(f"WARN: [ModelRegistry] Could not list {provider} models, probing instead: {e}")
+
+        if listing is not None and model_name in listing["value"]:
+            return {
+                "success": True,
+                "message": f"Model '{model_name}' is available",
+                "cached": listing_cached,
+                "checked_at": listing["checked_at"],
+                "source": "listing",
+            }
+
+        probe, probe_cached = await self._get(("probe", provider, model_name), lambda: self._load_probe(provider, model_name))
+        result = {"cached": probe_cached, "checked_at": probe["checked_at"], "source": "probe"}
+        if probe["value"]["available"]:
+            return {"success": True, "message": f"Model '{model_name}' is available", **result}
+        return {"success": False, "error": probe["value"].get("error") or f"Model '{model_name}' is not available", **result}
+
+    def get_status(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            ":".join(key): {
+                "age_seconds": round(now - entry["checked_at"], 1),
+                "stale": now - entry["checked_at"] > entry["ttl"],
+                "models": len(entry["value"]) if key[0] == "list" else None,
+            }
+            for key, entry in self._entries.items()
+        }
+
+    # --- Cache ---
+
+    async def _load_listing(self, provider: str) -> Tuple[Set[str], float]:
+        models = await _list_models(provider)
+        print(f"INFO: [ModelRegistry] Listed {len(models)} {provider} model(s)")
+        return models, self.ttl
+
+    async def _load_probe(self, provider: str, model_name: str) -> Tuple[Dict[str, Any], float]:
+        result = await _probe_model(provider, model_name)
+        print(f"INFO: [ModelRegistry] Probed {provider} model {model_name!r}: available={result['available']}")
+        return result, self.ttl if result["available"] else self.negative_ttl
+
+    async def _get(self, key: Tuple[str, ...], load: Callable[[], Awaitable[Tuple[Any, float]]]) -> Tuple[Dict[str, Any], bool]:
+        """Returns: (entry, served from cache). Stale entries are returned and refreshed in the background."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry["checked_at"] > entry["ttl"]:
+                self._refresh_in_background(key, load)
+            return entry, True
+        return await self._fetch(key, load), False
+
+    async def _fetch(self, key: Tuple[str, ...], load: Callable[[], Awaitable[Tuple[Any, float]]]) -> Dict[str, Any]:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        requested_at = time.time()
+        async with lock:
+            # Concurrent checks share one provider call
+            entry = self._entries.get(key)
+            if entry is not None and entry["checked_at"] >= requested_at:
+                return entry
+            value, ttl = await load()
+            entry = {"value": value, "checked_at": time.time(), "ttl": ttl}
+            self._entries[key] = entry
+            return entry
+
+    def _refresh_in_background(self, key: Tuple[str, ...], load: Callable[[], Awaitable[Tuple[Any, float]]]) -> None:
+        if self._locks.get(key) is not None and self._locks[key].locked():
+            return  # Already refreshing
+
+        async def refresh():
+            try:
+                await self._fetch(key, load)
+            except Exception as e:
+                print(f"WARN: [ModelRegistry] Refresh of {':'.join(key)} failed, keeping cached result: {e}")
+
+        task = asyncio.get_running_loop().create_task(refresh())
+        self._refreshing.add(task)
+        task.add_done_callback(self._refreshing.discard)
+
+
+registry = ModelRegistry(MODEL_REGISTRY_TTL_SECONDS, MODEL_REGISTRY_NEGATIVE_TTL_SECONDS)
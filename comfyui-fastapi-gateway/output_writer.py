@@ -0,0 +1,176 @@
+"""
+Output Writer - background persistence of generated images and videos.
+
+Saving a provider result used to happen inside the request (mkdir + write,
+hundreds of milliseconds on a network-mounted output volume). Now the caller
+only picks the output path and hands the data to write(); worker threads do
+the rest:
+
+  - a bounded queue (OUTPUT_WRITER_QUEUE_SIZE); when it is full the write runs
+    inline rather than buffering without limit
+  - output directories are created once per process (media_store.ensure_dir)
+  - each file is written to a temp name and renamed into place, so a partly
+    written file is never served
+  - fsync is batched: after OUTPUT_WRITER_FSYNC_BATCH files, or once the queue
+    goes idle, the written files and their directories are synced together
+  - failures are logged and counted (metrics counter "output_writes_failed")
+
+Data may be bytes or a zero-argument callable returning bytes, so decoding
+and encoding also move off the request path. Files streamed to disk by the
+caller (video downloads) join the fsync batches through sync_later().
+"""
+
+import os
+import queue
+import pathlib
+import threading
+from typing import Callable, List, Optional, Set, Tuple, Union
+from dotenv import load_dotenv
+
+import metrics
+from media_store import ensure_dir, forget_dir
+
+# Load environment variables
+load_dotenv()
+
+OUTPUT_WRITER_WORKERS = int(os.getenv("OUTPUT_WRITER_WORKERS", "2"))
+OUTPUT_WRITER_QUEUE_SIZE = int(os.getenv("OUTPUT_WRITER_QUEUE_SIZE", "64"))
+OUTPUT_WRITER_FSYNC_BATCH = int(os.getenv("OUTPUT_WRITER_FSYNC_BATCH", "8"))
+OUTPUT_WRITER_FSYNC = os.getenv("OUTPUT_WRITER_FSYNC", "1") not in ("0", "false", "False")
+
+OutputData = Union[bytes, bytearray, memoryview, Callable[[], bytes]]
+
+_queue: "queue.Queue[Optional[Tuple[pathlib.Path, Optional[OutputData]]]]" = queue.Queue(maxsize=OUTPUT_WRITER_QUEUE_SIZE)
+_workers: List[threading.Thread] = []
+_workers_lock = threading.Lock()
+
+
+def _write_file(path: pathlib.Path, data: OutputData) -> int:
+    if callable(data):
+        data = data()
+    tmp_path = path.with_suffix(path.suffix + ".part")
+    try:
+        try:
+            ensure_dir(path.parent)
+            f = open(tmp_path, "wb")
+        except FileNotFoundError:
+            forget_dir(path.parent)  # Removed since we cached it (e.g. output cleanup)
+            ensure_dir(path.parent)
+            f = open(tmp_path, "wb")
+        with f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return len(data)
+
+
+def _fsync_paths(paths: List[pathlib.Path]) -> None:
+    """Flushes written files, then each of their directories once (so the renames are durable too)."""
+    directories: Set[pathlib.Path] = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(path.parent)
+        except OSError as e:
+            print(f"WARN: [OutputWriter] fsync failed for {path}: {e}")
+    if not hasattr(os, "O_DIRECTORY"):
+        return  # Directories cannot be opened for fsync on Windows
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"WARN: [OutputWriter] fsync failed for {directory}: {e}")
+
+
+def _flush(paths: List[pathlib.Path]) -> None:
+    if OUTPUT_WRITER_FSYNC and paths:
+        _fsync_paths(paths)
+
+
+def _worker() -> None:
+    unsynced: List[pathlib.Path] = []
+    while True:
+        try:
+            # Block only when nothing is waiting to be synced
+            item = _queue.get(timeout=0.5) if unsynced else _queue.get()
+        except queue.Empty:
+            item = ()  # Idle: flush the batch
+        if item is None:
+            _flush(unsynced)
+            _queue.task_done()
+            return
+        if item:
+            path, data = item
+            try:
+                if data is not None:
+                    written = _write_file(path, data)
+                    print(f"DEBUG: [OutputWriter] Saved {path.absolute()} ({written:,} bytes)")
+                unsynced.append(path)
+            except Exception as e:
+                metrics.increment("output_writes_failed")
+                print(f"ERROR: [OutputWriter] Failed to save {path}: {e}")
+        if unsynced and (not item or len(unsynced) >= OUTPUT_WRITER_FSYNC_BATCH or _queue.empty()):
+            _flush(unsynced)
+            unsynced = []
+        if item:
+            _queue.task_done()
+
+
+def _ensure_workers() -> None:
+    with _workers_lock:
+        _workers[:] = [t for t in _workers if t.is_alive()]
+        while len(_workers) < OUTPUT_WRITER_WORKERS:
+            thread = threading.Thread(target=_worker, name=f"output-writer-{len(_workers)}", daemon=True)
+            thread.start()
+            _workers.append(thread)
+
+
+def write(path: pathlib.Path, data: OutputData) -> str:
+    """
+    Queues data to be saved at path and returns the absolute path at once.
+    The file appears once written; if the queue is full it is written before returning.
+    """
+    _ensure_workers()
+    try:
+        _queue.put_nowait((path, data))
+    except queue.Full:
+        metrics.increment("output_writer_queue_full")
+        print(f"WARN: [OutputWriter] Queue full, saving {path.name} inline")
+        try:
+            _write_file(path, data)
+        except Exception as e:
+            metrics.increment("output_writes_failed")
+            print(f"ERROR: [OutputWriter] Failed to save {path}: {e}")
+    return str(path.absolute())
+
+
+def sync_later(path: pathlib.Path) -> None:
+    """Adds a file written elsewhere (e.g. a streamed download) to the next fsync batch."""
+    if not OUTPUT_WRITER_FSYNC:
+        return
+    _ensure_workers()
+    try:
+        _queue.put_nowait((path, None))
+    except queue.Full:
+        pass  # Already on disk; only its fsync is skipped
+
+
+def shutdown(timeout: float = 30.0) -> None:
+    """Lets queued writes finish and syncs them, then stops the workers."""
+    with _workers_lock:
+        workers = list(_workers)
+        _workers.clear()
+    for _ in workers:
+        _queue.put(None)
+    for thread in workers:
+        thread.join(timeout=timeout)
@@ -0,0 +1,156 @@
+"""
+Provider Clients - shared, lazily created SDK clients for external providers.
+
+One keep-alive client per provider is reused by every request instead of
+building a new one (and a new connection pool) per call:
+
+    gemini   -> genai.Client, called through its async interface (client.aio)
+    seedream -> AsyncOpenAI against the Ark OpenAI-compatible endpoint
+    ark      -> byteplussdkarkruntime.Ark, which is sync-only, so its calls run
+                on a bounded thread pool via run_blocking()
+
+Each provider also has a concurrency limit (provider_slot) so a burst of
+slow calls to one provider queues instead of exhausting the gateway.
+Async clients and semaphores belong to the event loop that created them and
+are kept per loop; in the server that is a single process-wide instance.
+"""
+
+import os
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+ARK_API_KEY = os.getenv("ARK_API_KEY")
+ARK_BASE_URL = "https://ark.ap-southeast.bytepluses.com/api/v3"
+
+# Max concurrent in-flight calls per provider
+PROVIDER_CONCURRENCY = {
+    "gemini": int(os.getenv("GEMINI_MAX_CONCURRENCY", "4")),
+    "seedream": int(os.getenv("SEEDREAM_MAX_CONCURRENCY", "4")),
+    "ark": int(os.getenv("ARK_MAX_CONCURRENCY", "4")),
+}
+
+_lock = threading.Lock()
+_loop_state: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, Any]]" = weakref.WeakKeyDictionary()
+_ark_client = None
+_http_session: Optional[requests.Session] = None
+_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+def _state() -> Dict[str, Any]:
+    """Per-event-loop clients and semaphores."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        state = _loop_state.get(loop)
+        if state is None:
+            state = {"clients": {}, "semaphores": {}}
+            _loop_state[loop] = state
+        return state
+
+
+def get_gemini_client():
+    """Shared genai.Client; use client.aio for non-blocking calls."""
+    clients = _state()["clients"]
+    if "gemini" not in clients:
+        from google import genai
+        clients["gemini"] = genai.Client(api_key=GOOGLE_API_KEY)
+        print("INFO: [ProviderClients] Created Gemini client")
+    return clients["gemini"]
+
+
+def get_seedream_client():
+    """Shared AsyncOpenAI client for Seedream image generation."""
+    clients = _state()["clients"]
+    if "seedream" not in clients:
+        from openai import AsyncOpenAI
+        clients["seedream"] = AsyncOpenAI(base_url=ARK_BASE_URL, api_key=ARK_API_KEY)
+        print("INFO: [ProviderClients] Created Seedream (AsyncOpenAI) client")
+    return clients["seedream"]
+
+
+def get_ark_client():
+    """Shared sync Ark client (thread-safe); call it through run_blocking('ark', ...)."""
+    global _ark_client
+    with _lock:
+        if _ark_client is None:
+            from byteplussdkarkruntime import Ark
+            _ark_client = Ark(base_url=ARK_BASE_URL, api_key=ARK_API_KEY)
+            print("INFO: [ProviderClients] Created Ark client")
+        return _ark_client
+
+
+def get_http_session() -> requests.Session:
+    """Shared keep-alive session for plain HTTP fetches (reference images, results)."""
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+        return _http_session
+
+
+@asynccontextmanager
+async def provider_slot(provider: str):
+    """Holds one of the provider's concurrency slots for the duration of a call."""
+    semaphores = _state()["semaphores"]
+    if provider not in semaphores:
+        semaphores[provider] = asyncio.Semaphore(PROVIDER_CONCURRENCY.get(provider, 4))
+    async with semaphores[provider]:
+        yield
+
+
+def _executor(provider: str) -> ThreadPoolExecutor:
+    with _lock:
+        if provider not in _executors:
+            _executors[provider] = ThreadPoolExecutor(
+                max_workers=PROVIDER_CONCURRENCY.get(provider, 4),
+                thread_name_prefix=f"{provider}-call",
+            )
+        return _executors[provider]
+
+
+async def run_blocking(provider: str, fn: Callable, *args, **kwargs) -> Any:
+    """Runs a sync SDK call on the provider's bounded thread pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor(provider), functools.partial(fn, *args, **kwargs))
+
+
+async def close_clients() -> None:
+    """Closes this loop's async clients, the Ark client, the HTTP session and the executors (server shutdown)."""
+    global _ark_client, _http_session
+    state = _state()
+    gemini = state["clients"].pop("gemini", None)
+    if gemini is not None:
+        # aclose()/close() exist in google-genai >= 1.x; older clients hold no pooled sessions to release
+        aclose = getattr(gemini.aio, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        close = getattr(gemini, "close", None)
+        if close is not None:
+            close()
+    seedream = state["clients"].pop("seedream", None)
+    if seedream is not None:
+        await seedream.close()
+    state["clients"].clear()
+    with _lock:
+        if _ark_client is not None:
+            close = getattr(_ark_client, "close", None)
+            if close is not None:
+                close()
+            _ark_client = None
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+        for executor in _executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        _executors.clear()
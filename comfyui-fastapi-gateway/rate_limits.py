@@ -0,0 +1,240 @@
+"""
+Rate Limits - per-provider, per-model token buckets with retry and backoff.
+
+Every external generation (Gemini, Seedream, Seedance task creation) takes a
+token from the bucket for its (provider, model) before calling out:
+
+  - buckets refill at RATE_LIMITS[...]["rpm"] per minute up to "burst" tokens;
+    keys are "provider" or "provider:model" (the latter wins), e.g.
+    RATE_LIMITS='{"gemini": {"rpm": 20, "burst": 4}, "gemini:pro": {"rpm": 6}}'
+  - waiters are served round-robin across clients, so one client's burst
+    cannot starve everyone else
+  - retryable failures (429, 502-504, RESOURCE_EXHAUSTED/UNAVAILABLE) are retried
+    with full-jitter exponential backoff, honouring Retry-After; a 429 also
+    pauses the bucket so queued calls do not hit the provider meanwhile
+  - if every attempt fails the caller gets 429/503 with Retry-After instead of 500;
+    calls that are unsafe to repeat (Gemini chat turns) get a single attempt
+
+call_with_retry() returns the result together with queue position, wait time
+and attempt count so endpoints can show them to the client.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_RATE_LIMITS = {
+    "gemini": {"rpm": 20, "burst": 4},
+    "seedream": {"rpm": 30, "burst": 5},
+    "ark": {"rpm": 10, "burst": 2},
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("RATE_LIMITS", "{}"))}
+RATE_LIMIT_MAX_ATTEMPTS = int(os.getenv("RATE_LIMIT_MAX_ATTEMPTS", "4"))
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", "1.0"))
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", "30.0"))
+
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+# Provider errors usually reach us as text (SDK messages wrapped in HTTPException 500).
+# Status digits only count next to a status keyword, so IDs, sizes or seeds that
+# happen to contain "503" are not mistaken for one.
+_STATUS_PATTERN = re.compile(r"\b(?:error code|status code|status|http)\W{0,3}(429|50[234])\b", re.IGNORECASE)
+_RETRYABLE_MARKERS = (
+    (re.compile(r"RESOURCE_EXHAUSTED|rate limit|too many requests", re.IGNORECASE), 429),
+    (re.compile(r"\bUNAVAILABLE\b"), 503),  # gRPC status name (Gemini)
+    (re.compile(r"service unavailable|overloaded", re.IGNORECASE), 503),
+    (re.compile(r"bad gateway", re.IGNORECASE), 502),
+    (re.compile(r"DEADLINE_EXCEEDED|gateway timeout", re.IGNORECASE), 504),
+)
+
+
+class TokenBucket:
+    """Token bucket whose waiters are granted tokens round-robin by client."""
+
+    def __init__(self, name: str, rpm: float, burst: int):
+        self.name = name
+        self.rate = rpm / 60.0
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()  # client -> FIFO
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._waiters.values())
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _available(self) -> bool:
+        self._refill()
+        return self.tokens >= 1 and time.monotonic() >= self.paused_until
+
+    def pause(self, seconds: float) -> None:
+        """Stops granting tokens for a while (provider said 429)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+    async def acquire(self, client_id: str) -> Tuple[int, float]:
+        """
+        Waits for a token.
+        Returns: (queue position on arrival, 0 = served at once; seconds waited)
+        """
+        if not self._waiters and self._available():
+            self.tokens -= 1
+            return 0, 0.0
+
+        position = self.waiting + 1
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client_id, deque()).append(future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.tokens += 1  # Granted just as the caller went away; give it back
+            raise
+        return position, time.monotonic() - started
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            if not self._available():
+                wait_pause = self.paused_until - time.monotonic()
+                wait_token = (1 - self.tokens) / self.rate if self.rate > 0 else 1.0
+                await asyncio.sleep(max(wait_pause, wait_token, 0.01))
+                continue
+            # Next client in rotation; it moves to the back if it still has waiters
+            client_id, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            del self._waiters[client_id]
+            if queue:
+                self._waiters[client_id] = queue
+            if future.done():
+                continue  # Caller cancelled while queued
+            self.tokens -= 1
+            future.set_result(None)
+
+    def status(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "burst": self.burst,
+            "rpm": round(self.rate * 60, 2),
+            "waiting": self.waiting,
+            "waiting_by_client": {client: len(q) for client, q in self._waiters.items()},
+            "paused_seconds": round(max(0.0, self.paused_until - time.monotonic()), 2),
+        }
+
+
+_buckets: Dict[str, TokenBucket] = {}
+
+
+def get_bucket(provider: str, model: Optional[str]) -> TokenBucket:
+    key = f"{provider}:{model}" if model else provider
+    if key not in _buckets:
+        limits = {**RATE_LIMITS.get(provider, {"rpm": 60, "burst": 5}), **RATE_LIMITS.get(key, {})}
+        _buckets[key] = TokenBucket(key, limits["rpm"], limits["burst"])
+    return _buckets[key]
+
+
+def retryable_status(error: Exception) -> Optional[int]:
+    """HTTP status to report if the error is worth retrying, else None."""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status, int) and status in RETRYABLE_STATUSES:
+        return status
+    if isinstance(status, int) and status not in (500, 0):
+        return None  # A definite non-retryable answer (400, 403, 404, ...)
+    text = str(getattr(error, "detail", None) or error)
+    match = _STATUS_PATTERN.search(text)
+    if match:
+        return int(match.group(1))
+    for pattern, marker_status in _RETRYABLE_MARKERS:
+        if pattern.search(text):
+            return marker_status
+    return None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        value = headers.get("retry-after") or headers.get("Retry-After")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+async def call_with_retry(
+    provider: str,
+    model: Optional[str],
+    client_id: str,
+    call: Callable[[], Awaitable[Any]],
+    max_attempts: Optional[int] = None,
+    retry_statuses: Optional[Tuple[int, ...]] = None,
+) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Runs call() under the (provider, model) limiter, retrying retryable failures.
+    Pass max_attempts=1 for calls that are not safe to repeat (still rate limited,
+    and a retryable failure still becomes 429/503 with Retry-After), or
+    retry_statuses=(429,) for calls that may only be repeated when the provider
+    rejected them before doing anything (a 5xx/timeout may have created the task).
+    Returns: (result, {"queue_position", "waited_seconds", "attempts", ...})
+    """
+    bucket = get_bucket(provider, model)
+    info = {"limiter": bucket.name, "queue_position": 0, "waited_seconds": 0.0, "attempts": 0}
+    max_attempts = max_attempts or RATE_LIMIT_MAX_ATTEMPTS
+    for attempt in range(1, max_attempts + 1):
+        position, waited = await bucket.acquire(client_id)
+        info["attempts"] = attempt
+        info["queue_position"] = max(info["queue_position"], position)
+        info["waited_seconds"] = round(info["waited_seconds"] + waited, 3)
+        if position:
+            print(f"INFO: [RateLimit] {bucket.name}: {client_id} waited {waited:.1f}s (queue position {position})")
+        try:
+            return await call(), info
+        except Exception as e:
+            status = retryable_status(e)
+            if status is None:
+                raise
+            retry_after = _retry_after(e)
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(RATE_LIMIT_BACKOFF_MAX, RATE_LIMIT_BACKOFF_BASE * 2 ** (attempt - 1))
+            )
+            if status == 429:
+                bucket.pause(delay)
+            if attempt == max_attempts or (retry_statuses is not None and status not in retry_statuses):
+                metrics.increment(f"rate_limit_exhausted_{provider}")
+                print(f"WARN: [RateLimit] {bucket.name}: giving up after {attempt} attempt(s): {e}")
+                retry_seconds = max(1, math.ceil(delay))
+                raise HTTPException(
+                    status_code=429 if status == 429 else 503,
+                    detail=f"{provider} is busy ({status}) after {attempt} attempt(s); retry in {retry_seconds}s",
+                    headers={"Retry-After": str(retry_seconds)},
+                )
+            metrics.increment(f"rate_limit_retries_{provider}")
+            print(f"WARN: [RateLimit] {bucket.name}: {status} on attempt {attempt}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            info["waited_seconds"] = round(info["waited_seconds"] + delay, 3)
+
+
+def get_status() -> Dict[str, Any]:
+    """Snapshot of every limiter (tokens, queue lengths, pauses)."""
+    return {name: bucket.status() for name, bucket in _buckets.items()}
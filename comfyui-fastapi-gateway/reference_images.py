@@ -0,0 +1,138 @@
+"""
+Reference Images - downsample references to what their consumer can use.
+
+Users paste full-size camera photos as references, but every consumer
+resamples them down anyway: ControlNet preprocessors to their resolution,
+CLIP Vision encoders to a few hundred pixels, Seedream and Gemini to their
+output size. fit_reference() shrinks a reference to a consumer's limits
+before it is uploaded or sent (fit_blob() for images already in memory), so
+upload bytes and provider payloads stay proportional to what is actually used:
+
+  - limits are a max short side, max long side and/or max pixel count
+  - the size check reads the header only; images that already fit are
+    passed through untouched (same bytes, same hash)
+  - JPEGs are decoded at reduced scale (draft mode) and stay JPEG; other
+    formats become PNG so line art and transparency survive
+  - EXIF orientation is applied, as ComfyUI's LoadImage would
+  - results are cached by content hash and limits (REFERENCE_CACHE_SIZE)
+"""
+
+import io
+import os
+import math
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+from dotenv import load_dotenv
+
+from media import MediaBlob, get_blob, get_image_info
+
+# Load environment variables
+load_dotenv()
+
+REFERENCE_NORMALIZE_ENABLED = os.getenv("REFERENCE_NORMALIZE_ENABLED", "1") not in ("0", "false", "False")
+REFERENCE_JPEG_QUALITY = int(os.getenv("REFERENCE_JPEG_QUALITY", "92"))
+REFERENCE_CACHE_SIZE = int(os.getenv("REFERENCE_CACHE_SIZE", "32"))
+# CLIP/SigLIP/DINO vision encoders take 224-518 px crops of the short side
+CLIPVISION_REFERENCE_SIDE = int(os.getenv("CLIPVISION_REFERENCE_SIDE", "768"))
+
+_EXIF_ORIENTATION = 0x0112
+_SWAPPED_ORIENTATIONS = (5, 6, 7, 8)  # Transposed/rotated by 90 degrees
+_NO_GAIN = object()  # Cached "re-encoding did not make it smaller"
+
+_cache: "OrderedDict[Tuple, object]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _fit_scale(width: int, height: int, max_short_side: Optional[int],
+               max_long_side: Optional[int], max_pixels: Optional[int]) -> float:
+    scale = 1.0
+    if max_short_side:
+        scale = min(scale, max_short_side / min(width, height))
+    if max_long_side:
+        scale = min(scale, max_long_side / max(width, height))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    return scale
+
+
+def _downscale(blob: MediaBlob, scale: float) -> bytes:
+    with Image.open(io.BytesIO(blob.data)) as img:
+        source_format = img.format
+        swapped = img.getexif().get(_EXIF_ORIENTATION, 1) in _SWAPPED_ORIENTATIONS
+        target = (max(1, math.ceil(img.width * scale)), max(1, math.ceil(img.height * scale)))
+        # JPEG decodes straight to 1/2, 1/4 or 1/8 scale (never below target); no-op for other formats
+        img.draft(None, target)
+        img = ImageOps.exif_transpose(img)
+        if swapped:
+            target = (target[1], target[0])
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+
+        out = io.BytesIO()
+        if source_format == "JPEG":
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(out, format="JPEG", quality=REFERENCE_JPEG_QUALITY, subsampling=0)
+        else:
+            # Fast zlib level: references are sent once, not archived
+            img.save(out, format="PNG", compress_level=3)
+        return out.getvalue()
+
+
+def fit_reference(image_input: str, max_short_side: Optional[int] = None, max_long_side: Optional[int] = None,
+                  max_pixels: Optional[int] = None) -> Optional[MediaBlob]:
+    """
+    Downscaled copy of a base64/data-URI or http(s) reference that fits the limits.
+    Returns None if the image already fits, cannot be read, or would not get smaller
+    (callers then use the original).
+    """
+    if not REFERENCE_NORMALIZE_ENABLED or not image_input:
+        return None
+    info = get_image_info(image_input)
+    if info is None:
+        return None
+    if _fit_scale(info.width, info.height, max_short_side, max_long_side, max_pixels) >= 1.0:
+        return None
+    return fit_blob(get_blob(image_input), max_short_side, max_long_side, max_pixels)
+
+
+def fit_blob(blob: MediaBlob, max_short_side: Optional[int] = None, max_long_side: Optional[int] = None,
+             max_pixels: Optional[int] = None) -> Optional[MediaBlob]:
+    """fit_reference() for an already decoded image (e.g. raw bytes read from disk)."""
+    info = blob.info
+    if not REFERENCE_NORMALIZE_ENABLED or info is None:
+        return None
+    scale = _fit_scale(info.width, info.height, max_short_side, max_long_side, max_pixels)
+    if scale >= 1.0:
+        return None
+
+    key = (blob.sha256, max_short_side, max_long_side, max_pixels)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            cached = _cache[key]
+            return None if cached is _NO_GAIN else cached
+
+    try:
+        fitted = MediaBlob(_downscale(blob, scale))
+    except Exception as e:
+        print(f"WARN: [References] Could not downscale reference ({info.width}x{info.height}): {e}")
+        return None
+
+    if len(fitted.data) >= len(blob.data):
+        result = _NO_GAIN
+        print(f"DEBUG: [References] Downscaled {info.width}x{info.height} is not smaller; keeping original")
+    else:
+        result = fitted
+        width, height = fitted.size
+        print(
+            f"INFO: [References] {info.width}x{info.height} -> {width}x{height} "
+            f"({len(blob.data) / 1e6:.2f} MB -> {len(fitted.data) / 1e6:.2f} MB)"
+        )
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > REFERENCE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return None if result is _NO_GAIN else result
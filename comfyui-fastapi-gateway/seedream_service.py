@@ -1,15 +1,17 @@
 import os
 import io
+import asyncio
 import base64
-import datetime
-import uuid
-import pathlib
-import requests
 from PIL import Image
-from openai import OpenAI
 from fastapi import HTTPException
 from dotenv import load_dotenv
 
+from provider_clients import get_seedream_client, get_http_session, provider_slot
+from media_store import new_output_path
+from media import decode_base64, get_image_size
+from reference_images import fit_reference
+import output_writer
+
 # Load environment variables
 load_dotenv()
 
@@ -18,39 +20,32 @@ SEEDREAM_BASE_URL = "https://ark.ap-southeast.bytepluses.com/api/v3"
 SEEDREAM_MODEL = "seedream-4-5-251128"
 
 
-async def test_seedream_model(model_name: str) -> dict:
+async def list_seedream_models() -> list:
+    """Model IDs listed by the Ark OpenAI-compatible /models endpoint."""
+    client = get_seedream_client()
+    async with provider_slot("seedream"):
+        return [model.id async for model in client.models.list()]
+
+
+async def probe_seedream_model(model_name: str) -> dict:
     """
-    Test if a Seedream model name is valid by making a minimal API call.
-    Returns: { success: bool, error?: str }
+    Checks one model (e.g. a custom "ep-..." endpoint the listing does not show)
+    without generating anything: the request carries a size Seedream always
+    rejects, so a parameter error means the model resolved, while a missing or
+    unauthorised model fails before that.
+    Returns: { available: bool, error?: str }
     """
-    if not ARK_API_KEY:
-        return {"success": False, "error": "ARK_API_KEY not configured"}
-    
+    client = get_seedream_client()
     try:
-        client = OpenAI(
-            base_url=SEEDREAM_BASE_URL,
-            api_key=ARK_API_KEY,
-        )
-        
-        # Test with minimal prompt - just validating model access
-        response = client.images.generate(
-            model=model_name,
-            prompt="test",
-            size="2K",
-            response_format="b64_json",
-            extra_body={"watermark": False},
-        )
-        
-        # If we got here without exception, model exists
-        return {"success": True, "message": f"Model '{model_name}' is accessible"}
-    
+        async with provider_slot("seedream"):
+            await client.images.generate(model=model_name, prompt="probe", size="1x1", response_format="url")
+        return {"available": True}
     except Exception as e:
         error_str = str(e)
-        if "404" in error_str or "not found" in error_str.lower():
-            return {"success": False, "error": f"Model '{model_name}' not found"}
-        if "403" in error_str or "unauthorized" in error_str.lower():
-            return {"success": False, "error": f"Access denied for model '{model_name}'"}
-        return {"success": False, "error": error_str}
+        status = getattr(e, "status_code", None)
+        if status == 400 or "InvalidParameter" in error_str:
+            return {"available": True}
+        raise
 
 # Recommended resolutions for different aspect ratios (min 3.7M pixels)
 ASPECT_RATIO_TO_SIZE = {
@@ -65,78 +60,57 @@ ASPECT_RATIO_TO_SIZE = {
 }
 
 
+# Pixel counts of the size presets
+SIZE_PRESET_PIXELS = {"2K": 2048 * 2048, "4K": 4096 * 4096}
+
+
+def _png_bytes(image: Image.Image) -> bytes:
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
 def save_image_to_disk(image_data, model_name="seedream"):
     """
-    Saves image (Base64 string or PIL Image) to output_api/{date}/image/{model}_{time}_{uid}.png
-    Returns: Absolute path of saved file
+    Saves image (Base64 string, raw bytes or PIL Image) to output_api/{date}/image/{model}_{time}_{uid}.png
+    in the background (output_writer); the response does not wait on disk.
+    Returns: Absolute path the file is written to
     """
     try:
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        output_dir = pathlib.Path("output_api") / today / "image"
-        output_dir.mkdir(parents=True, exist_ok=True)
-
-        timestamp = datetime.datetime.now().strftime("%H-%M-%S")
-        short_id = str(uuid.uuid4())[:8]
-        clean_model = model_name.replace(":", "").replace("/", "-").split("-")[-1]
-        filename = f"{clean_model}_{timestamp}_{short_id}.png"
-        filepath = output_dir / filename
+        clean_model = model_name.replace(":", "").replace("/", "-").split("-")[-1]  # Simplify model name
+        filepath = new_output_path("image", clean_model, ".png", create_dir=False)
 
+        # Decoding/encoding happens on the writer thread too
         if isinstance(image_data, Image.Image):
-            image_data.save(filepath, format="PNG")
+            data = lambda: _png_bytes(image_data)
         elif isinstance(image_data, str):
-            # Base64 string
-            if "," in image_data:
-                image_data = image_data.split(",")[1]
-            image_data = "".join(image_data.split())
-            image_data = image_data.rstrip("=")
-            padding_needed = (4 - len(image_data) % 4) % 4
-            if padding_needed:
-                image_data += "=" * padding_needed
-            img_bytes = base64.b64decode(image_data)
-            with open(filepath, "wb") as f:
-                f.write(img_bytes)
-
-        print(f"DEBUG: Saved Seedream image to: {filepath.absolute()}")
-        return str(filepath.absolute())
+            # Base64 string (with or without prefix)
+            data = lambda: decode_base64(image_data)
+        else:
+            data = bytes(image_data)
+
+        return output_writer.write(filepath, data)
     except Exception as e:
-        print(f"ERROR: Failed to save Seedream image: {e}")
-        import traceback
-        traceback.print_exc()
+        print(f"ERROR: Failed to queue Seedream image for saving: {e}")
         return None
 
 
 def _get_image_dimensions(image_input: str) -> tuple:
-    """Extract width and height from a base64 or URL image."""
-    try:
-        if image_input.startswith("http"):
-            response = requests.get(image_input)
-            response.raise_for_status()
-            img = Image.open(io.BytesIO(response.content))
-        else:
-            # Base64
-            if "," in image_input:
-                image_input = image_input.split(",")[1]
-            image_input = "".join(image_input.split())
-            image_input = image_input.rstrip("=")
-            padding_needed = (4 - len(image_input) % 4) % 4
-            if padding_needed:
-                image_input += "=" * padding_needed
-            img_bytes = base64.b64decode(image_input)
-            img = Image.open(io.BytesIO(img_bytes))
-        
-        return img.width, img.height
-    except Exception as e:
-        print(f"ERROR: Failed to get image dimensions: {e}")
-        return None, None
+    """Extract width and height from a base64 or URL image (header only, cached)."""
+    return get_image_size(image_input)
 
 
-def _prepare_image_for_api(image_input: str) -> str:
+def _prepare_image_for_api(image_input: str, max_pixels: int = None) -> str:
     """
     Convert base64 image to URL or return URL as-is.
     Seedream API prefers URLs but can accept base64 with data: prefix.
+    Base64 references above max_pixels are downsampled first (URLs are fetched by Seedream itself).
     """
     if image_input.startswith("http"):
         return image_input
+    fitted = fit_reference(image_input, max_pixels=max_pixels) if max_pixels else None
+    if fitted:
+        return fitted.data_uri()
     else:
         # Return as data URL for API
         if not image_input.startswith("data:"):
@@ -170,10 +144,11 @@ async def generate_image_seedream(
     print(f"DEBUG: prompt length: {len(prompt)}")
     print(f"DEBUG: image_inputs count: {len(image_inputs) if image_inputs else 0}")
     
-    # Log resolution for each input image
+    # Log resolution for each input image (measured once, off the event loop)
+    image_dims = []
     if image_inputs:
-        for i, img in enumerate(image_inputs):
-            w, h = _get_image_dimensions(img)
+        image_dims = await asyncio.to_thread(lambda: [_get_image_dimensions(img) for img in image_inputs])
+        for i, (w, h) in enumerate(image_dims):
             if w and h:
                 pixels = w * h
                 print(f"DEBUG: Image {i+1}: {w}x{h} ({pixels:,} pixels)")
@@ -186,10 +161,7 @@ async def generate_image_seedream(
         raise HTTPException(status_code=500, detail="ARK_API_KEY not configured. Please add it to your .env file.")
 
     try:
-        client = OpenAI(
-            base_url=SEEDREAM_BASE_URL,
-            api_key=ARK_API_KEY,
-        )
+        client = get_seedream_client()
 
         # Determine size parameter
         resolution = parameters.get("resolution", "auto") if parameters else "auto"
@@ -273,7 +245,7 @@ async def generate_image_seedream(
         elif resolution == "4K":
             size = "4K"
         elif resolution == "from_image_1" and image_inputs and len(image_inputs) >= 1:
-            w, h = _get_image_dimensions(image_inputs[0])
+            w, h = image_dims[0]
             if w and h:
                 w, h, is_valid, msg = _validate_and_adjust_dimensions(w, h)
                 if is_valid:
@@ -285,7 +257,7 @@ async def generate_image_seedream(
             else:
                 size = "2K"  # Fallback
         elif resolution == "from_image_2" and image_inputs and len(image_inputs) >= 2:
-            w, h = _get_image_dimensions(image_inputs[1])
+            w, h = image_dims[1]
             if w and h:
                 w, h, is_valid, msg = _validate_and_adjust_dimensions(w, h)
                 if is_valid:
@@ -328,7 +300,17 @@ async def generate_image_seedream(
 
         # Add images if provided
         if image_inputs and len(image_inputs) > 0:
-            prepared_images = [_prepare_image_for_api(img) for img in image_inputs]
+            # References carry no detail beyond the output size, kept within the model's pixel window
+            if size in SIZE_PRESET_PIXELS:
+                output_pixels = SIZE_PRESET_PIXELS[size]
+            elif size and "x" in size:
+                output_pixels = int(size.split("x")[0]) * int(size.split("x")[1])
+            else:
+                output_pixels = MAX_PIXELS
+            max_reference_pixels = min(MAX_PIXELS, max(MIN_PIXELS, output_pixels))
+            prepared_images = await asyncio.to_thread(
+                lambda: [_prepare_image_for_api(img, max_reference_pixels) for img in image_inputs]
+            )
             if len(prepared_images) == 1:
                 extra_body["image"] = prepared_images[0]
             else:
@@ -351,7 +333,8 @@ async def generate_image_seedream(
             print("DEBUG: No size param - using auto")
 
         print(f"DEBUG: Calling Seedream API...")
-        response = client.images.generate(**api_kwargs)
+        async with provider_slot("seedream"):
+            response = await client.images.generate(**api_kwargs)
 
         print(f"DEBUG: Response received")
         print(f"DEBUG: Generated {len(response.data)} image(s)")
@@ -369,10 +352,10 @@ async def generate_image_seedream(
             elif hasattr(first_result, 'url') and first_result.url:
                 # If URL format, download and convert
                 print(f"DEBUG: Got URL response, downloading...")
-                img_response = requests.get(first_result.url)
+                img_response = await asyncio.to_thread(get_http_session().get, first_result.url, timeout=120)
                 img_response.raise_for_status()
                 generated_image_b64 = base64.b64encode(img_response.content).decode('utf-8')
-                save_image_to_disk(generated_image_b64, model_name=SEEDREAM_MODEL)
+                save_image_to_disk(img_response.content, model_name=SEEDREAM_MODEL)
 
         # Build result
         result_payload = {
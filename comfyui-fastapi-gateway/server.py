@@ -2,19 +2,50 @@
 import json
 import base64
 import urllib.request as request
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Dict, Any
 
 import asyncio
 import threading
+import time
 import os
+import uuid
+from collections import OrderedDict
 from comfyui import run_comfyui_dynamic as run_comfyui
+from comfyui import run_comfyui_refine, run_comfyui_matrix, run_comfyui_template, run_comfyui_draft
+from comfyui import detach_reference_images, require_custom_nodes, MissingCustomNodeError
+from workflow.templates import load_templates, list_templates, get_template
+from workflow.params import HIRES_STRATEGIES, SINGLE_PASS_HIRES_STRATEGIES
+from workflow.modules import PREPROCESSOR_ORDER
+from media import media_scope
+from rate_limits import call_with_retry
+
+WORKFLOW_TEMPLATE_DIR = os.getenv(
+    "WORKFLOW_TEMPLATE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates"),
+)
 
 class LoraConfig(BaseModel):
     name: str
     strength: float
+
+class ControlNetUnit(BaseModel):
+    model_name: str
+    preprocessor: str = "none"  # "anyLine" | "depth" | "openPose" | "canny" | "none" (raw reference)
+    strength: float = 1.0
+    start_percent: float = 0.0
+    end_percent: float = 1.0
+    resolution: Optional[int] = None  # Overrides the request-wide cn_*_resolution for this unit
+
+    @field_validator("preprocessor")
+    @classmethod
+    def _known_preprocessor(cls, value: str) -> str:
+        if value not in PREPROCESSOR_ORDER and value != "none":
+            raise ValueError(f"preprocessor must be one of {[*PREPROCESSOR_ORDER, 'none']}")
+        return value
     
 class ControlNetPreviewRequest(BaseModel):
     server_address: str # Still needed for comfyui.py
@@ -32,13 +63,19 @@ class ControlNetPreviewRequest(BaseModel):
     controlnet_upscale_model: Optional[str] = None
     controlnet_upscale_factor: Optional[float] = 1.0
     controlnet_upscale_method: Optional[str] = "nearest-exact"
+    # "chained": preprocessors feed into each other, one composite image (legacy)
+    # "parallel": one independent branch per preprocessor, one image each
+    preview_mode: Optional[str] = "chained"
 from comfyui import run_controlnet_preview_only # We'll create this function
+from comfyui import run_controlnet_preview_branches
 
 
 
 class GenerateRequest(BaseModel):
     server_address: str
     model_name: str
+    # "default" | "low_vram" (fp8 UNet via split loaders); None = the backend's configured profile
+    memory_profile: Optional[str] = None
     positive_prompt: str
     negative_prompt: str
     random_seed: int
@@ -56,7 +93,7 @@ class GenerateRequest(BaseModel):
     # Hires Fix
     hf_enable: bool = False
     hf_scale: Optional[float] = Field(default=1.5) # Changed to Optional
-    hf_denoising_strength: Optional[float] = Field(default=0.4) # Changed to Optional
+    hf_denoising_strength: Optional[float] = None  # Default 0.4; also used by "latent" unless hf_latent_denoise is set
     hf_upscaler: Optional[str] = Field(default="RealESRGAN_x4") # Changed to Optional
     hf_colortransfer: str = "none"
     hf_steps: Optional[int] = 15
@@ -65,6 +102,29 @@ class GenerateRequest(BaseModel):
     hf_scheduler: Optional[str] = None
     hf_temporal_size: Optional[int] = 64
     hf_temporal_overlap: Optional[int] = 8
+    # "model": full-frame KSampler on the upscaled image
+    # "tiled": overlapping tiles (Ultimate SD Upscale), bounded VRAM for very large outputs
+    # "latent": LatentUpscaleBy on the base latent, no ESRGAN pass or extra VAE round trip
+    # "deep_shrink": one pass at the output size with PatchModelAddDownscale, no second pass
+    hf_strategy: Optional[str] = "model"
+    hf_tile_size: Optional[int] = None     # Max sampled region per tile (incl. overlap), default 1024
+    hf_tile_overlap: Optional[int] = None  # Tile padding in px, default 64
+    hf_latent_denoise: Optional[float] = None          # "latent" strategy denoise, default hf_denoising_strength if sent, else 0.55
+    hf_latent_upscale_method: Optional[str] = None     # "latent" strategy LatentUpscaleBy method
+
+    # Keep the base latent so the job can be re-refined via /api/jobs/{id}/refine
+    persist_latent: bool = False
+
+    # Draft: a few-step LCM preview first, then the full job with the same seed.
+    # Without auto-continue the full job waits for POST /api/jobs/{id}/accept-draft
+    draft: bool = False
+    draft_auto_continue: bool = True
+    draft_lora: Optional[str] = None       # Defaults to DRAFT_LORA_NAME
+    draft_lora_strength: Optional[float] = None
+    draft_steps: Optional[int] = None      # Default 4
+    draft_cfg: Optional[float] = None      # Default 1.0
+    draft_sampler: Optional[str] = None    # Default "lcm"
+    draft_scheduler: Optional[str] = None  # Default "sgm_uniform"
 
     # Model Merge (NEW)
     model_merge_enabled: bool = False
@@ -76,6 +136,15 @@ class GenerateRequest(BaseModel):
     sampling_type: Optional[str] = "eps"
     zsnr_enabled: bool = False
 
+    # Token merging (ToMe): ratios default to a choice by resolution (off below ~1MP)
+    tome_enabled: bool = False
+    tome_ratio: Optional[float] = None     # Base pass, 0.0-1.0
+    hf_tome_ratio: Optional[float] = None  # Hires pass, 0.0-1.0
+
+    # HyperTile on the hires pass only; tile size defaults to a choice by output resolution
+    hf_hypertile: bool = False
+    hf_hypertile_tile_size: Optional[int] = None
+
     # LoRAs
     loras_enabled: bool = False
     loras_config: List[LoraConfig] = Field(default_factory=list)
@@ -85,8 +154,10 @@ class GenerateRequest(BaseModel):
     controlnet_model_name: Optional[str] = None
     controlnet_ref_image_base64: Optional[str] = None
     controlnet_strength: Optional[float] = Field(default=1.0) # Changed to Optional
+    # Multiple units on the shared reference; when set, the single model / chained preprocessors are unused
+    controlnet_units: Optional[List[ControlNetUnit]] = None
     controlnet_upscale_model: Optional[str] = None
-    controlnet_upscale_factor: Optional[float] = 1.0
+    controlnet_upscale_factor: Optional[float] = None  # None = 1.0, or planned in "auto" mode
     controlnet_upscale_method: Optional[str] = "nearest-exact"
     controlnet_preprocessors: Dict[str, bool] = Field(
         default_factory=lambda: {
@@ -96,11 +167,14 @@ class GenerateRequest(BaseModel):
     selected_anyline_style: str = "lineart_realistic" # Default if not sent
 
     # ControlNet Preprocessor specific settings
-    cn_anyline_resolution: Optional[int] = 1152
+    # "fixed": unset resolutions use the defaults (1152/1472/1024/192)
+    # "auto": unset resolutions and the reference upscale follow the sampled image size
+    cn_resolution_mode: Optional[str] = "fixed"
+    cn_anyline_resolution: Optional[int] = None
     cn_depth_model: Optional[str] = "depth_anything_v2_vitl.pth"
-    cn_depth_resolution: Optional[int] = 1472
-    cn_openpose_resolution: Optional[int] = 1024
-    cn_canny_resolution: Optional[int] = 192
+    cn_depth_resolution: Optional[int] = None
+    cn_openpose_resolution: Optional[int] = None
+    cn_canny_resolution: Optional[int] = None
 
     # CLIP Vision
     clipvision_enabled: bool = False
@@ -123,13 +197,132 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def media_blob_scope(request: Request, call_next):
+    # Every reference image is decoded once per request and shared by all services
+    with media_scope():
+        return await call_next(request)
+
+@app.on_event("startup")
+async def load_workflow_templates():
+    # Parse and index external workflow templates once; requests only patch copies
+    load_templates(WORKFLOW_TEMPLATE_DIR)
+
+@app.on_event("shutdown")
+async def stop_local_preprocessors():
+    import local_preprocessors
+    local_preprocessors.shutdown()
+
+
+@app.on_event("shutdown")
+async def flush_output_writer():
+    # Queued result files are written and synced before exit
+    import output_writer
+    await asyncio.to_thread(output_writer.shutdown)
+
+@app.on_event("shutdown")
+async def close_provider_clients():
+    import provider_clients
+    await provider_clients.close_clients()
+
+@app.on_event("startup")
+async def start_video_poller():
+    # Resumes Seedance tasks left unfinished by a previous run
+    from video_jobs import tracker
+    tracker.start()
+
+@app.on_event("shutdown")
+async def stop_video_poller():
+    from video_jobs import tracker
+    await tracker.stop()
+
+@app.on_event("startup")
+async def start_model_registry():
+    # Keeps provider model listings warm so model checks are answered from cache
+    from model_registry import registry
+    registry.start()
+
+@app.on_event("shutdown")
+async def stop_model_registry():
+    from model_registry import registry
+    await registry.stop()
+
+# Drafts awaiting acceptance: job_id -> {"params", "created_at"} (oldest evicted first).
+# Params carry the uploaded reference filenames, not their base64 (detach_reference_images).
+PENDING_DRAFTS_LIMIT = int(os.getenv("PENDING_DRAFTS_LIMIT", "100"))
+PENDING_DRAFTS_TTL_SECONDS = float(os.getenv("PENDING_DRAFTS_TTL_SECONDS", "1800"))
+_pending_drafts: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_expired_drafts: "OrderedDict[str, None]" = OrderedDict()  # Recently expired/evicted job IDs, answered with 410
+_pending_drafts_lock = threading.Lock()  # Also written from WebSocket job threads
+
+def _forget_draft(job_id: str) -> None:
+    del _pending_drafts[job_id]
+    _expired_drafts[job_id] = None
+    while len(_expired_drafts) > PENDING_DRAFTS_LIMIT:
+        _expired_drafts.popitem(last=False)
+
+def _expire_drafts() -> None:
+    cutoff = time.monotonic() - PENDING_DRAFTS_TTL_SECONDS
+    # Ordered by creation, so expired drafts are at the front
+    while _pending_drafts:
+        job_id, entry = next(iter(_pending_drafts.items()))
+        if entry["created_at"] >= cutoff:
+            break
+        _forget_draft(job_id)
+        print(f"INFO: Pending draft {job_id} expired")
+
+def _remember_draft(job_id: str, params_dict: Dict[str, Any]) -> None:
+    with _pending_drafts_lock:
+        _expire_drafts()
+        _pending_drafts[job_id] = {"params": params_dict, "created_at": time.monotonic()}
+        while len(_pending_drafts) > PENDING_DRAFTS_LIMIT:
+            _forget_draft(next(iter(_pending_drafts)))
+
+def _take_draft(job_id: str) -> Dict[str, Any]:
+    """Removes and returns a pending draft's params; 410 if it expired, 404 if unknown."""
+    with _pending_drafts_lock:
+        _expire_drafts()
+        entry = _pending_drafts.pop(job_id, None)
+        expired = job_id in _expired_drafts
+    if entry is None:
+        if expired:
+            raise HTTPException(status_code=410, detail=f"Draft for job {job_id} has expired; generate it again")
+        raise HTTPException(status_code=404, detail=f"No pending draft for job {job_id}")
+    return entry["params"]
+
+def _data_uri(png_bytes: bytes) -> str:
+    return f"data:image/png;base64,{base64.b64encode(png_bytes).decode('utf-8')}"
+
+def _custom_node_check(req: GenerateRequest) -> None:
+    """Raises MissingCustomNodeError before anything is queued (e.g. "tiled" without UltimateSDUpscale)."""
+    require_custom_nodes({"hf_enable": req.hf_enable, "hf_strategy": req.hf_strategy}, req.server_address)
+
+async def _require_custom_nodes(req: GenerateRequest) -> None:
+    try:
+        await asyncio.to_thread(_custom_node_check, req)
+    except MissingCustomNodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/api/generate")
 async def generate(req: GenerateRequest):
     print("INFO: FastAPI /api/generate (HTTP POST) called")
+    await _require_custom_nodes(req)
+    draft_bytes = None
     try:
         # Pydantic model now accepts None for Optional fields.
         # comfyui.py will handle these None values and apply defaults.
         params_dict = req.model_dump() # Pass Nones as is
+        params_dict["job_id"] = uuid.uuid4().hex
+
+        if req.draft:
+            # Draft and full job share the uploads; a pending draft keeps only their filenames
+            await asyncio.to_thread(detach_reference_images, params_dict, req.server_address)
+            draft_bytes = await asyncio.to_thread(run_comfyui_draft, None, **params_dict)
+            if draft_bytes is None:
+                raise HTTPException(status_code=500, detail="Draft generation failed in comfyui.py")
+            if not req.draft_auto_continue:
+                _remember_draft(params_dict["job_id"], params_dict)
+                return {"draft_image": _data_uri(draft_bytes), "job_id": params_dict["job_id"], "awaiting_accept": True}
 
         png_bytes = run_comfyui(**params_dict, progress_callback=None)
 
@@ -142,6 +335,296 @@ async def generate(req: GenerateRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+    b64 = base64.b64encode(png_bytes).decode("utf-8")
+    response = {"image": f"data:image/png;base64,{b64}", "job_id": params_dict["job_id"]}
+    if draft_bytes:
+        response["draft_image"] = _data_uri(draft_bytes)
+    return response
+
+@app.post("/api/generate/stream")
+async def generate_stream(req: GenerateRequest):
+    """
+    Server-Sent Events: a 'draft' event as soon as the draft is rendered (if draft=true),
+    then 'result' (or 'error'). Plain /api/generate returns the draft only with the final image.
+    """
+    print("INFO: FastAPI /api/generate/stream (HTTP POST) called")
+    await _require_custom_nodes(req)
+    params_dict = req.model_dump()
+    job_id = params_dict["job_id"] = uuid.uuid4().hex
+
+    def _event(name: str, data: Dict[str, Any]) -> str:
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    async def _events():
+        try:
+            if req.draft:
+                await asyncio.to_thread(detach_reference_images, params_dict, req.server_address)
+                draft_bytes = await asyncio.to_thread(run_comfyui_draft, None, **params_dict)
+                if draft_bytes is None:
+                    yield _event("error", {"job_id": job_id, "detail": "Draft generation failed in comfyui.py"})
+                    return
+                if not req.draft_auto_continue:
+                    _remember_draft(job_id, params_dict)
+                yield _event("draft", {
+                    "draft_image": _data_uri(draft_bytes),
+                    "job_id": job_id,
+                    "awaiting_accept": not req.draft_auto_continue,
+                })
+                if not req.draft_auto_continue:
+                    return
+
+            png_bytes = await asyncio.to_thread(run_comfyui, None, **params_dict)
+            if png_bytes is None:
+                yield _event("error", {"job_id": job_id, "detail": "Image generation failed in comfyui.py"})
+                return
+            yield _event("result", {"image": _data_uri(png_bytes), "job_id": job_id})
+        except Exception as e:
+            print(f"ERROR in /api/generate/stream: {type(e).__name__} - {e}")
+            import traceback
+            traceback.print_exc()
+            yield _event("error", {"job_id": job_id, "detail": str(e)})
+
+    return StreamingResponse(_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/api/jobs/{job_id}/accept-draft")
+async def accept_draft(job_id: str):
+    """Run the full-quality job for a draft generated with draft_auto_continue=false."""
+    print(f"INFO: FastAPI /api/jobs/{job_id}/accept-draft called")
+    params_dict = _take_draft(job_id)
+    try:
+        png_bytes = await asyncio.to_thread(run_comfyui, None, **params_dict)
+    except Exception as e:
+        print(f"ERROR in /api/jobs/{job_id}/accept-draft: {type(e).__name__} - {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+    if png_bytes is None:
+        raise HTTPException(status_code=500, detail="Image generation failed in comfyui.py")
+    return {"image": _data_uri(png_bytes), "job_id": job_id}
+
+# Hires strategies with a second pass that can be re-run from a base latent
+REFINE_STRATEGIES = tuple(s for s in HIRES_STRATEGIES if s not in SINGLE_PASS_HIRES_STRATEGIES)
+
+class RefineRequest(BaseModel):
+    # Any field left as None keeps the value the job was generated with
+    server_address: Optional[str] = None
+    hf_scale: Optional[float] = None
+    hf_denoising_strength: Optional[float] = None
+    hf_upscaler: Optional[str] = None
+    hf_colortransfer: Optional[str] = None
+    hf_steps: Optional[int] = None
+    hf_cfg: Optional[float] = None
+    hf_sampler: Optional[str] = None
+    hf_scheduler: Optional[str] = None
+    hf_strategy: Optional[str] = None
+    hf_tile_size: Optional[int] = None
+    hf_tile_overlap: Optional[int] = None
+    hf_latent_denoise: Optional[float] = None
+    hf_latent_upscale_method: Optional[str] = None
+    hf_tome_ratio: Optional[float] = None
+    hf_hypertile: Optional[bool] = None
+    hf_hypertile_tile_size: Optional[int] = None
+
+    @field_validator("hf_strategy")
+    @classmethod
+    def _two_pass_strategy(cls, value: Optional[str]) -> Optional[str]:
+        # Refine re-runs the second pass; single-pass strategies (deep_shrink) have none
+        if value is not None and value not in REFINE_STRATEGIES:
+            raise ValueError(f"hf_strategy must be one of {list(REFINE_STRATEGIES)} for refine")
+        return value
+
+@app.post("/api/jobs/{job_id}/refine")
+async def refine_job(job_id: str, req: RefineRequest):
+    """
+    Re-run only the hires pass of a finished job from its persisted base latent.
+    The job must have been generated with persist_latent=true.
+    """
+    print(f"INFO: FastAPI /api/jobs/{job_id}/refine called")
+    try:
+        png_bytes = await asyncio.to_thread(run_comfyui_refine, job_id, None, **req.model_dump())
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No persisted latent for job '{job_id}' (expired or generated without persist_latent).")
+    except MissingCustomNodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        print(f"ERROR in /api/jobs/{job_id}/refine: {type(e).__name__} - {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if png_bytes is None:
+        raise HTTPException(status_code=500, detail="Refine failed in comfyui.py")
+
+    b64 = base64.b64encode(png_bytes).decode("utf-8")
+    return {"image": f"data:image/png;base64,{b64}", "job_id": job_id}
+
+class MatrixAxis(BaseModel):
+    param: str                           # One of workflow.params.MATRIX_AXIS_PARAMS
+    values: List[Any]
+    labels: Optional[List[str]] = None   # Defaults to str(value)
+
+class MatrixGenerateRequest(GenerateRequest):
+    matrix_x: MatrixAxis
+    matrix_y: Optional[MatrixAxis] = None
+
+def _matrix_plan(req: MatrixGenerateRequest):
+    """Expands the request axes into cells and grid labels. Raises ValueError if invalid."""
+    from workflow.params import expand_matrix
+    cells = expand_matrix(
+        req.matrix_x.param, req.matrix_x.values,
+        req.matrix_y.param if req.matrix_y else None,
+        req.matrix_y.values if req.matrix_y else None,
+    )
+    def _labels(axis: MatrixAxis) -> List[str]:
+        if axis.labels and len(axis.labels) == len(axis.values):
+            return axis.labels
+        return [f"{axis.param}: {value}" for value in axis.values]
+    x_labels = _labels(req.matrix_x)
+    y_labels = _labels(req.matrix_y) if req.matrix_y else None
+    params_dict = req.model_dump(exclude={"matrix_x", "matrix_y"})
+    params_dict["job_id"] = uuid.uuid4().hex
+    return cells, x_labels, y_labels, params_dict
+
+def _matrix_grid(cell_images: Dict[str, bytes], x_labels: List[str], y_labels: Optional[List[str]]) -> bytes:
+    from image_grid import compose_grid
+    by_position = {}
+    for cell_key, image_bytes in cell_images.items():
+        x, y = (int(v) for v in cell_key.split(","))
+        by_position[(x, y)] = image_bytes
+    return compose_grid(by_position, x_labels, y_labels)
+
+@app.post("/api/generate-matrix")
+async def generate_matrix(req: MatrixGenerateRequest):
+    """
+    Render an X/Y matrix (e.g. prompts x samplers) as one ComfyUI prompt that
+    shares the checkpoint, LoRA chain and per-prompt conditioning across cells.
+    """
+    print("INFO: FastAPI /api/generate-matrix called")
+    try:
+        cells, x_labels, y_labels, params_dict = _matrix_plan(req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        cell_images = await asyncio.to_thread(run_comfyui_matrix, cells, None, None, **params_dict)
+        if not cell_images:
+            raise HTTPException(status_code=500, detail="Matrix generation failed in comfyui.py")
+        grid_bytes = await asyncio.to_thread(_matrix_grid, cell_images, x_labels, y_labels)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"ERROR in /api/generate-matrix: {type(e).__name__} - {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    cells_payload = []
+    for cell_key, _ in cells:
+        x, y = (int(v) for v in cell_key.split(","))
+        image_bytes = cell_images.get(cell_key)
+        cells_payload.append({
+            "x": x,
+            "y": y,
+            "image": f"data:image/png;base64,{base64.b64encode(image_bytes).decode('utf-8')}" if image_bytes else None,
+        })
+    return {
+        "cells": cells_payload,
+        "x_labels": x_labels,
+        "y_labels": y_labels,
+        "grid": f"data:image/png;base64,{base64.b64encode(grid_bytes).decode('utf-8')}",
+    }
+
+@app.websocket("/api/generate-matrix-ws")
+async def generate_matrix_ws(websocket: WebSocket):
+    """Same as /api/generate-matrix, streaming each cell as it completes."""
+    await websocket.accept()
+    loop = asyncio.get_event_loop()
+    print("INFO: FastAPI matrix WebSocket connection accepted.")
+    try:
+        raw_params = await websocket.receive_json()
+        try:
+            req = MatrixGenerateRequest(**raw_params)
+            cells, x_labels, y_labels, params_dict = _matrix_plan(req)
+        except Exception as validation_error:
+            await websocket.send_json({"type": "error", "message": f"Invalid matrix request: {validation_error}"})
+            return
+
+        await websocket.send_json({"type": "matrix_plan", "cells": len(cells), "x_labels": x_labels, "y_labels": y_labels})
+
+        def _send(payload: Dict[str, Any]) -> None:
+            try:
+                asyncio.run_coroutine_threadsafe(websocket.send_json(payload), loop)
+            except Exception as e_ws_send:
+                print(f"ERROR: FastAPI error sending matrix update over WebSocket: {e_ws_send}")
+
+        def progress_callback(current_step, total_steps, preview_image_data_uri=None, preview_kind="step_preview"):
+            percent = int((current_step / total_steps) * 100) if total_steps else 0
+            _send({"type": "progress", "progress": percent, "current_step": current_step, "total_steps": total_steps})
+
+        def cell_callback(cell_key: str, image_bytes: bytes) -> None:
+            x, y = (int(v) for v in cell_key.split(","))
+            b64 = base64.b64encode(image_bytes).decode("utf-8")
+            _send({"type": "matrix_cell", "x": x, "y": y, "image": f"data:image/png;base64,{b64}"})
+
+        with media_scope():
+            cell_images = await asyncio.to_thread(
+                run_comfyui_matrix, cells, progress_callback, cell_callback, **params_dict
+            )
+        if not cell_images:
+            await websocket.send_json({"type": "error", "message": "Matrix generation failed or returned no data."})
+            return
+
+        grid_bytes = await asyncio.to_thread(_matrix_grid, cell_images, x_labels, y_labels)
+        b64_grid = base64.b64encode(grid_bytes).decode("utf-8")
+        await websocket.send_json({"type": "matrix_grid", "image": f"data:image/png;base64,{b64_grid}"})
+
+    except WebSocketDisconnect:
+        print("INFO: FastAPI matrix WebSocket disconnected by client.")
+    except Exception as e:
+        print(f"ERROR: FastAPI matrix WebSocket error: {type(e).__name__} - {e}")
+        import traceback
+        traceback.print_exc()
+        try:
+            await websocket.send_json({"type": "error", "message": f"Server error: {type(e).__name__} - {str(e)}"})
+        except Exception:
+            pass
+    finally:
+        try:
+            if websocket.client_state != websocket.client_state.DISCONNECTED: # type: ignore
+                await websocket.close()
+        except Exception:
+            pass
+
+class TemplateRunRequest(BaseModel):
+    server_address: str = "127.0.0.1:8188"
+    values: Dict[str, Any] = Field(default_factory=dict)
+
+@app.get("/api/templates")
+async def get_templates():
+    return {"templates": [template.describe() for template in list_templates()]}
+
+@app.post("/api/templates/{template_name}/run")
+async def run_template(template_name: str, req: TemplateRunRequest):
+    print(f"INFO: FastAPI /api/templates/{template_name}/run called")
+    if get_template(template_name) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown workflow template '{template_name}'")
+    try:
+        png_bytes = await asyncio.to_thread(
+            run_comfyui_template, template_name, req.values, None, req.server_address
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(f"ERROR in /api/templates/{template_name}/run: {type(e).__name__} - {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if png_bytes is None:
+        raise HTTPException(status_code=500, detail="Template run failed in comfyui.py")
+
     b64 = base64.b64encode(png_bytes).decode("utf-8")
     return {"image": f"data:image/png;base64,{b64}"}
 
@@ -151,9 +634,19 @@ class ExternalGenerateRequest(BaseModel):
     images: Optional[List[str]] = None # List of Base64 images (supports multiple references)
     image: Optional[str] = None # DEPRECATED: Single image for backward compatibility
     parameters: Optional[Dict[str, Any]] = None # New params (AR, Res, Temp)
+    session_id: Optional[str] = None # Gemini chat session; defaults to the client address
+
+class ChatResetRequest(BaseModel):
+    session_id: Optional[str] = None
+
+def _client_key(request: Request) -> str:
+    return f"client:{request.client.host}" if request.client else "default"
+
+def _chat_session_id(session_id: Optional[str], request: Request) -> str:
+    return session_id or _client_key(request)
 
 @app.post("/api/external/generate")
-async def generate_external(req: ExternalGenerateRequest):
+async def generate_external(req: ExternalGenerateRequest, request: Request):
     print(f"INFO: /api/external/generate called for model {req.model}")
     
     # DEBUG: Print Payload
@@ -189,12 +682,14 @@ async def generate_external(req: ExternalGenerateRequest):
         # Route to appropriate service based on model
         # Check if model name starts with 'seedream' or matches known aliases
         is_seedream = req.model.lower().startswith("seedream") or req.model.lower() in ["sd45", "sd40"]
+        client_key = _chat_session_id(req.session_id, request)
         
         if is_seedream:
             # Seedream service
             from seedream_service import generate_image_seedream
             print(f"INFO: Routing to Seedream service (model: {req.model})")
-            result = await generate_image_seedream(
+            provider = "seedream"
+            call = lambda: generate_image_seedream(
                 prompt=req.prompt,
                 model_name=req.model,  # Pass the actual model name
                 image_inputs=image_inputs if image_inputs else None,
@@ -204,13 +699,22 @@ async def generate_external(req: ExternalGenerateRequest):
             # Gemini (flash, pro) - default
             from gemini_service import generate_image_gemini
             print("INFO: Routing to Gemini service")
-            result = await generate_image_gemini(
+            provider = "gemini"
+            call = lambda: generate_image_gemini(
                 prompt=req.prompt,
                 model_alias=req.model,
                 image_inputs=image_inputs if image_inputs else None,
-                parameters=req.parameters
+                parameters=req.parameters,
+                session_id=client_key
             )
         
+        # Per-provider/model limiter: queues bursts, retries 429/5xx with backoff.
+        # Gemini without images is a chat turn: a repeat could add the turn to the history twice.
+        chat_turn = provider == "gemini" and not image_inputs
+        result, rate_limit = await call_with_retry(
+            provider, req.model, client_key, call, max_attempts=1 if chat_turn else None
+        )
+        
         # If the service returns an image, use it.
         image_data = result.get("image")
         
@@ -224,7 +728,8 @@ async def generate_external(req: ExternalGenerateRequest):
             "status": "success", 
             "message": "Generation successful", 
             "image": image_data,
-            "thinking_process": mock_thoughts 
+            "thinking_process": mock_thoughts,
+            "rate_limit": rate_limit
         }
     except HTTPException as he:
         # Re-raise HTTP exceptions from service
@@ -234,12 +739,14 @@ async def generate_external(req: ExternalGenerateRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/external/reset")
-async def reset_chat_history():
+async def reset_chat_history(request: Request, req: Optional[ChatResetRequest] = None):
+    """Resets the calling client's chat history only (session_id, else the client address)."""
     print("INFO: /api/external/reset called")
     from gemini_service import reset_gemini_chat
     try:
-        reset_gemini_chat()
-        return {"status": "success", "message": "Chat history reset."}
+        session_id = _chat_session_id(req.session_id if req else None, request)
+        removed = reset_gemini_chat(session_id)
+        return {"status": "success", "message": "Chat history reset.", "session_id": session_id, "chats_removed": removed}
     except Exception as e:
         print(f"Reset Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -251,25 +758,25 @@ class TestModelRequest(BaseModel):
 @app.post("/api/external/test-model")
 async def test_model(req: TestModelRequest):
     """
-    Test if a model name is valid by sending a minimal request to the provider.
-    Returns success/failure without generating an actual image.
+    Check whether a model name is usable, from the cached model registry
+    (provider model listings, plus a non-generating probe for unlisted models).
+    Nothing is generated; repeated checks are answered from cache.
     """
     print(f"INFO: /api/external/test-model called for provider={req.provider}, model={req.model_name}")
-    
+    from model_registry import registry
+
     try:
-        if req.provider == "seedream":
-            # Test Seedream model
-            from seedream_service import test_seedream_model
-            result = await test_seedream_model(req.model_name)
-        else:
-            # Test Gemini model (default)
-            from gemini_service import test_gemini_model
-            result = await test_gemini_model(req.model_name)
-        
-        return result
+        provider = "seedream" if req.provider == "seedream" else "gemini"
+        return await registry.check(provider, req.model_name)
     except Exception as e:
         print(f"Test Model Error: {e}")
-        return {"success": False, "error": str(e)}
+        return {"success": False, "error": str(e), "cached": False}
+
+@app.get("/api/external/models/status")
+async def model_registry_status():
+    """Age and freshness of every cached model listing/probe."""
+    from model_registry import registry
+    return registry.get_status()
 
 # Video Generation Request Model
 class VideoGenerateRequest(BaseModel):
@@ -284,14 +791,15 @@ class VideoGenerateRequest(BaseModel):
     camera_fixed: bool = False               # Lock camera (T2V only)
     watermark: bool = False                  # Add watermark
     generate_audio: bool = False             # Generate audio
+    include_base64: bool = False             # Also return the video inline (default: media_url only)
 
 @app.post("/api/video/generate")
-async def generate_video(req: VideoGenerateRequest):
+async def generate_video(req: VideoGenerateRequest, request: Request):
     """
-    Generate video using Seedance API.
+    Generate video using Seedance API and wait for the result.
     
-    This is an async endpoint that polls for completion.
-    Video generation can take 30-120 seconds.
+    Video generation can take 30-120 seconds; clients that should not hold
+    the request open use POST /api/video/jobs instead.
     """
     print(f"INFO: /api/video/generate called")
     print(f"DEBUG: Model: {req.model}, Duration: {req.duration}s, Resolution: {req.resolution}")
@@ -312,17 +820,21 @@ async def generate_video(req: VideoGenerateRequest):
             seed=req.seed,
             camera_fixed=req.camera_fixed,
             watermark=req.watermark,
-            generate_audio=req.generate_audio
+            generate_audio=req.generate_audio,
+            include_base64=req.include_base64,
+            client_id=_client_key(request)
         )
         
         return {
             "status": "success",
             "message": "Video generation complete",
             "video_url": result.get("video_url"),
+            "media_url": result.get("media_url"),
             "video_base64": result.get("video_base64"),
             "duration": result.get("duration"),
             "saved_path": result.get("saved_path"),
-            "task_id": result.get("task_id")
+            "task_id": result.get("task_id"),
+            "rate_limit": result.get("rate_limit")
         }
         
     except HTTPException:
@@ -333,14 +845,103 @@ async def generate_video(req: VideoGenerateRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+def _video_task_kwargs(req: VideoGenerateRequest) -> Dict[str, Any]:
+    kwargs = req.model_dump(exclude={"include_base64"})
+    kwargs["model_name"] = kwargs.pop("model")
+    return kwargs
+
+@app.post("/api/video/jobs", status_code=202)
+async def submit_video_job(req: VideoGenerateRequest, request: Request):
+    """
+    Starts a Seedance video job and returns its task ID immediately.
+    Follow it with GET /api/video/jobs/{task_id}, .../events (SSE) or .../ws.
+    """
+    from video_jobs import tracker
+    print(f"INFO: /api/video/jobs called (model: {req.model}, {req.duration}s, {req.resolution})")
+    task_id = await tracker.submit(client_id=_client_key(request), **_video_task_kwargs(req))
+    return {"status": "accepted", "task_id": task_id, "job": tracker.get(task_id)}
+
+@app.get("/api/video/jobs/{task_id}")
+async def get_video_job(task_id: str):
+    from video_jobs import tracker
+    job = tracker.get(task_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown video job: {task_id}")
+    return job
+
+@app.get("/api/video/jobs/{task_id}/events")
+async def video_job_events(task_id: str):
+    """Server-Sent Events: one 'status' event per change, ending when the job finishes."""
+    from video_jobs import tracker
+    if tracker.get(task_id) is None:
+        raise HTTPException(status_code=404, detail=f"Unknown video job: {task_id}")
+
+    async def _events():
+        async for job in tracker.watch(task_id, heartbeat=15):
+            if job is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+
+    return StreamingResponse(_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/api/video/jobs/{task_id}/ws")
+async def video_job_ws(websocket: WebSocket, task_id: str):
+    from video_jobs import tracker
+    await websocket.accept()
+    try:
+        if tracker.get(task_id) is None:
+            await websocket.send_json({"type": "error", "message": f"Unknown video job: {task_id}"})
+            return
+        async for job in tracker.watch(task_id):
+            await websocket.send_json({"type": "video_job", "job": job})
+    except WebSocketDisconnect:
+        print(f"INFO: Video job WS client disconnected ({task_id}); the job keeps running")
+    finally:
+        if websocket.client_state != websocket.client_state.DISCONNECTED: # type: ignore
+            await websocket.close()
+
+@app.get("/api/media/{media_id}")
+async def get_media(media_id: str, request: Request):
+    """Serves a saved output file; supports single HTTP Range requests (video seeking, resumed downloads)."""
+    from media_store import resolve_media, media_type, parse_range, iter_file
+    path = resolve_media(media_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Unknown media: {media_id}")
+
+    size = path.stat().st_size
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=86400"}
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        (start, end), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file(path, start, end), status_code=status_code, media_type=media_type(path), headers=headers)
+
 @app.post("/api/preview-controlnet-preprocessor")
 async def preview_controlnet(req: ControlNetPreviewRequest):
     print("INFO: FastAPI /api/preview-controlnet-preprocessor called")
     try:
         params_dict = req.model_dump()
+
+        if req.preview_mode == "parallel":
+            branch_result = await asyncio.to_thread(run_controlnet_preview_branches, **params_dict)
+            if not branch_result or not branch_result["images"]:
+                return {"error": "Preprocessor preview generation failed or returned no data."}
+            images = {
+                name: f"data:image/png;base64,{base64.b64encode(img).decode('utf-8')}"
+                for name, img in branch_result["images"].items()
+            }
+            return {"images": images, "cached": branch_result["cached"]}
         
         # Call a new function in comfyui.py designed for this
-        preview_image_bytes = run_controlnet_preview_only(**params_dict)
+        preview_image_bytes = await asyncio.to_thread(run_controlnet_preview_only, **params_dict)
 
         if preview_image_bytes:
             b64_preview = base64.b64encode(preview_image_bytes).decode("utf-8")
@@ -356,6 +957,17 @@ async def preview_controlnet(req: ControlNetPreviewRequest):
         # Return error in JSON format
         return {"error": str(e)} # Or raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/rate-limits")
+async def get_rate_limits():
+    """Tokens, queue lengths (per client) and 429 pauses of every provider limiter."""
+    import rate_limits
+    return rate_limits.get_status()
+
+@app.get("/api/metrics/jobs")
+async def get_job_metrics():
+    import metrics
+    return metrics.get_metrics()
+
 @app.get("/api/get-samplers")
 async def get_samplers():
     print("INFO: FastAPI /api/get-samplers called")
@@ -439,7 +1051,16 @@ async def generate_ws(websocket: WebSocket):
             await websocket.close()
             return
 
-        result_holder = {"image_bytes": None, "error": None}
+        try:
+            await asyncio.to_thread(_custom_node_check, params)
+        except MissingCustomNodeError as e:
+            print(f"ERROR: FastAPI {e}")
+            await websocket.send_json({"type": "error", "message": str(e)})
+            await websocket.close()
+            return
+
+        result_holder = {"image_bytes": None, "error": None, "draft_only": False}
+        job_id = uuid.uuid4().hex
 
         # MODIFIED progress_callback signature to include preview_kind
         def progress_callback(current_step, total_steps, preview_image_data_uri=None, preview_kind="step_preview"):
@@ -470,9 +1091,29 @@ async def generate_ws(websocket: WebSocket):
 
 
         def run_job_in_thread():
+            with media_scope():
+                _run_job()
+
+        def _run_job():
             try:
                 print("DEBUG: FastAPI run_job_in_thread started.")
                 params_dict = params.model_dump() # Pass Nones as is, comfyui.py handles defaults
+                params_dict["job_id"] = job_id
+                
+                if params.draft:
+                    detach_reference_images(params_dict, params.server_address)
+                    draft_bytes = run_comfyui_draft(progress_callback=progress_callback, **params_dict)
+                    if draft_bytes is None:
+                        result_holder["error"] = "Draft generation failed"
+                        return
+                    draft_payload = {"type": "draft", "image": _data_uri(draft_bytes), "job_id": job_id}
+                    if not params.draft_auto_continue:
+                        _remember_draft(job_id, params_dict)
+                        draft_payload["awaiting_accept"] = True
+                    asyncio.run_coroutine_threadsafe(websocket.send_json(draft_payload), loop).result(timeout=10)
+                    if not params.draft_auto_continue:
+                        result_holder["draft_only"] = True
+                        return
                 
                 image_bytes_result = run_comfyui(
                     **params_dict,
@@ -507,10 +1148,12 @@ async def generate_ws(websocket: WebSocket):
             print(f"ERROR: FastAPI job failed with error: {result_holder['error']}")
             if websocket.client_state != websocket.client_state.DISCONNECTED: # type: ignore
                 await websocket.send_json({"type": "error", "message": result_holder["error"]})
+        elif result_holder["draft_only"]:
+            print(f"INFO: FastAPI draft for job {job_id} sent; full job awaits accept-draft.")
         elif result_holder["image_bytes"]:
             b64 = base64.b64encode(result_holder["image_bytes"]).decode("utf-8")
             if websocket.client_state != websocket.client_state.DISCONNECTED: # type: ignore
-                await websocket.send_json({"type": "result", "image": f"data:image/png;base64,{b64}"})
+                await websocket.send_json({"type": "result", "image": f"data:image/png;base64,{b64}", "job_id": job_id})
                 print("INFO: FastAPI successfully sent result image over WebSocket.")
         else: 
             msg = "Image generation failed or returned no data (and no specific error reported from thread)."
@@ -0,0 +1,326 @@
+"""
+Video Jobs - submit/status tracking for Seedance video tasks.
+
+POST /api/video/jobs returns the Seedance task ID as soon as the task is
+created. One background poller then tracks every outstanding task:
+
+  - each task is polled with exponential backoff (VIDEO_POLL_INITIAL_SECONDS,
+    x1.5 per poll, capped at VIDEO_POLL_MAX_SECONDS), so long renders cost few calls
+  - a job fails after VIDEO_JOB_TIMEOUT_SECONDS, or after VIDEO_POLL_MAX_FAILURES
+    status calls fail in a row (e.g. an expired task ID resumed from disk)
+  - on success the video is streamed to disk before the job is marked done and
+    is then served from its media_url (GET /api/media/{media_id}); a failed
+    download leaves the job "downloading" and is retried on the poll backoff,
+    up to VIDEO_DOWNLOAD_MAX_ATTEMPTS or until the provider's URL has expired
+  - every state change is written to output_api/video_jobs/{task_id}.json, so a
+    client that disconnects (or a gateway restart) does not lose the result;
+    unfinished jobs are picked up again when the poller starts
+
+Clients read a job with get() or follow it with watch() (GET, SSE and WS in server.py).
+"""
+
+import os
+import re
+import json
+import time
+import asyncio
+import pathlib
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+from dotenv import load_dotenv
+
+from media_store import media_id_for
+from rate_limits import call_with_retry
+
+# Load environment variables
+load_dotenv()
+
+VIDEO_JOBS_DIR = pathlib.Path(os.getenv("VIDEO_JOBS_DIR", "output_api/video_jobs"))
+VIDEO_POLL_INITIAL_SECONDS = float(os.getenv("VIDEO_POLL_INITIAL_SECONDS", "2"))
+VIDEO_POLL_MAX_SECONDS = float(os.getenv("VIDEO_POLL_MAX_SECONDS", "15"))
+VIDEO_POLL_BACKOFF = 1.5
+VIDEO_JOB_TIMEOUT_SECONDS = float(os.getenv("VIDEO_JOB_TIMEOUT_SECONDS", "3600"))
+VIDEO_POLL_MAX_FAILURES = int(os.getenv("VIDEO_POLL_MAX_FAILURES", "10"))  # Consecutive failed status calls
+VIDEO_DOWNLOAD_MAX_ATTEMPTS = int(os.getenv("VIDEO_DOWNLOAD_MAX_ATTEMPTS", "5"))
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+FAILED_PROVIDER_STATUSES = ("failed", "cancelled", "expired")
+# Download responses meaning the signed video URL is no longer valid
+EXPIRED_URL_STATUSES = (403, 404, 410)
+
+_TASK_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def is_terminal(job: Dict[str, Any]) -> bool:
+    return job["status"] in TERMINAL_STATUSES
+
+
+class VideoJobTracker:
+    """Owns the outstanding Seedance tasks and the single poller that advances them."""
+
+    def __init__(self, jobs_dir: pathlib.Path):
+        self.jobs_dir = jobs_dir
+        self._jobs: Dict[str, Dict[str, Any]] = {}  # Unfinished jobs only; finished ones live on disk
+        self._next_poll: Dict[str, float] = {}
+        self._interval: Dict[str, float] = {}
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._in_flight: Set[asyncio.Task] = set()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    # --- Lifecycle ---
+
+    def start(self) -> None:
+        """Starts the poller on the running loop (idempotent) and resumes unfinished jobs."""
+        if self._task is not None and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._resume_pending()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        print(f"INFO: [VideoJobs] Poller started ({len(self._jobs)} unfinished job(s))")
+
+    async def stop(self) -> None:
+        tasks = [t for t in (self._task, *self._in_flight) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._in_flight.clear()
+
+    def _resume_pending(self) -> None:
+        if not self.jobs_dir.exists():
+            return
+        for path in self.jobs_dir.glob("*.json"):
+            job = self._load(path.stem)
+            if job and not is_terminal(job) and job["task_id"] not in self._jobs:
+                self._track(job, delay=0)
+
+    # --- Public API ---
+
+    async def submit(self, client_id: str = "default", **kwargs) -> str:
+        """
+        Creates the Seedance task (submit_video_task kwargs) and starts tracking it.
+        Task creation goes through the Ark rate limiter (queued, retried on 429 only:
+        after a 5xx or timeout the task may exist, and a retry would bill a second video).
+        """
+        from video_service import submit_video_task, SEEDANCE_MODEL
+
+        self.start()
+        model = kwargs.get("model_name") or SEEDANCE_MODEL
+        task_id, rate_limit = await call_with_retry(
+            "ark", model, client_id, lambda: submit_video_task(**kwargs), retry_statuses=(429,)
+        )
+        now = time.time()
+        job = {
+            "task_id": task_id,
+            "status": "queued",
+            "provider_status": None,
+            "model": model,
+            "created_at": now,
+            "updated_at": now,
+            "polls": 0,
+            "video_url": None,
+            "saved_path": None,
+            "media_id": None,
+            "media_url": None,
+            "error": None,
+            "rate_limit": rate_limit,
+        }
+        await asyncio.to_thread(self._persist, job)
+        self._track(job, delay=VIDEO_POLL_INITIAL_SECONDS)
+        return task_id
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Current state of a job (tracked or persisted), or None if unknown."""
+        if task_id in self._jobs:
+            return dict(self._jobs[task_id])
+        return self._load(task_id)
+
+    async def watch(self, task_id: str, heartbeat: Optional[float] = None) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Yields the job now and after every change, ending once it is finished.
+        With a heartbeat, yields None after that many idle seconds (SSE keep-alives).
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(task_id, []).append(queue)
+        try:
+            # Read after subscribing so no change falls between the two
+            job = self.get(task_id)
+            if job is None:
+                return
+            yield job
+            while not is_terminal(job):
+                try:
+                    job = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield job
+        finally:
+            subscribers = self._subscribers.get(task_id, [])
+            if queue in subscribers:
+                subscribers.remove(queue)
+            if not subscribers:
+                self._subscribers.pop(task_id, None)
+
+    async def wait(self, task_id: str) -> Dict[str, Any]:
+        """Returns the job once it has finished."""
+        job = None
+        async for job in self.watch(task_id):
+            pass
+        if job is None:
+            raise KeyError(f"Unknown video job: {task_id}")
+        return job
+
+    # --- Poller ---
+
+    def _track(self, job: Dict[str, Any], delay: float) -> None:
+        self._jobs[job["task_id"]] = job
+        self._interval[job["task_id"]] = VIDEO_POLL_INITIAL_SECONDS
+        self._next_poll[job["task_id"]] = time.time() + delay
+        if self._wake is not None:
+            self._wake.set()
+
+    def _reschedule(self, task_id: str) -> None:
+        interval = self._interval.get(task_id, VIDEO_POLL_INITIAL_SECONDS)
+        self._next_poll[task_id] = time.time() + interval
+        self._interval[task_id] = min(interval * VIDEO_POLL_BACKOFF, VIDEO_POLL_MAX_SECONDS)
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            now = time.time()
+            for task_id in [t for t, at in self._next_poll.items() if at <= now]:
+                # Not rescheduled until this poll finishes; a slow download never delays other jobs
+                del self._next_poll[task_id]
+                poll = asyncio.get_running_loop().create_task(self._poll(task_id))
+                self._in_flight.add(poll)
+                poll.add_done_callback(self._in_flight.discard)
+            delay = max(0.0, min(self._next_poll.values()) - now) if self._next_poll else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, task_id: str) -> None:
+        from video_service import get_video_task, extract_video_url, download_video
+
+        job = self._jobs[task_id]
+        try:
+            try:
+                result = await get_video_task(task_id)
+            except Exception as e:
+                job["poll_failures"] = job.get("poll_failures", 0) + 1
+                print(f"WARN: [VideoJobs] Poll failed for {task_id} ({job['poll_failures']} in a row): {e}")
+                if job["poll_failures"] >= VIDEO_POLL_MAX_FAILURES:
+                    await self._update(job, status="failed", error=f"Status unavailable after {job['poll_failures']} attempts: {e}")
+                elif self._timed_out(job):
+                    await self._update(job, status="failed", error=f"Timed out after {int(VIDEO_JOB_TIMEOUT_SECONDS)}s")
+                return
+
+            job["poll_failures"] = 0
+            job["polls"] += 1
+            provider_status = getattr(result, "status", None)
+
+            if provider_status == "succeeded":
+                video_url = extract_video_url(result)
+                if not video_url:
+                    await self._update(job, status="failed", provider_status=provider_status, error="Task succeeded without a video URL")
+                    return
+                try:
+                    saved_path = await download_video(video_url, job["model"])
+                except Exception as e:
+                    await self._download_failed(job, provider_status, video_url, e)
+                    return
+                print(f"INFO: [VideoJobs] {task_id} succeeded after {job['polls']} poll(s)")
+                media_id = media_id_for(saved_path)
+                await self._update(
+                    job,
+                    status="succeeded",
+                    provider_status=provider_status,
+                    video_url=video_url,
+                    saved_path=saved_path,
+                    media_id=media_id,
+                    media_url=f"/api/media/{media_id}",
+                    error=None,
+                )
+            elif provider_status in FAILED_PROVIDER_STATUSES:
+                error = getattr(result, "error", None) or provider_status
+                print(f"WARN: [VideoJobs] {task_id} {provider_status}: {error}")
+                await self._update(job, status="failed", provider_status=provider_status, error=str(error))
+            elif self._timed_out(job):
+                await self._update(job, status="failed", provider_status=provider_status, error=f"Timed out after {int(VIDEO_JOB_TIMEOUT_SECONDS)}s")
+            elif provider_status != job["provider_status"]:
+                status = "running" if provider_status == "running" else "queued"
+                await self._update(job, status=status, provider_status=provider_status)
+        except Exception as e:
+            print(f"ERROR: [VideoJobs] Unexpected error polling {task_id}: {e}")
+        finally:
+            # Every unfinished job is polled again, whatever happened above
+            if not is_terminal(job):
+                self._reschedule(task_id)
+
+    async def _download_failed(self, job: Dict[str, Any], provider_status: str, video_url: str, error: Exception) -> None:
+        """Keeps the job "downloading" for another attempt, or fails it once retries are pointless."""
+        job["download_failures"] = job.get("download_failures", 0) + 1
+        status = getattr(getattr(error, "response", None), "status_code", None)
+        print(f"WARN: [VideoJobs] Download failed for {job['task_id']} (attempt {job['download_failures']}): {error}")
+        if status in EXPIRED_URL_STATUSES:
+            await self._update(job, status="failed", provider_status=provider_status, video_url=video_url,
+                               error=f"Video URL expired before it could be downloaded (HTTP {status})")
+        elif job["download_failures"] >= VIDEO_DOWNLOAD_MAX_ATTEMPTS:
+            await self._update(job, status="failed", provider_status=provider_status, video_url=video_url,
+                               error=f"Download failed after {job['download_failures']} attempts: {error}")
+        else:
+            await self._update(job, status="downloading", provider_status=provider_status, video_url=video_url,
+                               error=f"Download failed, retrying: {error}")
+
+    @staticmethod
+    def _timed_out(job: Dict[str, Any]) -> bool:
+        return time.time() - job["created_at"] > VIDEO_JOB_TIMEOUT_SECONDS
+
+    async def _update(self, job: Dict[str, Any], **fields) -> None:
+        job.update(fields, updated_at=time.time())
+        # Persist before notifying, so anyone told about a change can also read it back
+        await asyncio.to_thread(self._persist, job)
+        if is_terminal(job):
+            self._jobs.pop(job["task_id"], None)
+            self._interval.pop(job["task_id"], None)
+        for queue in self._subscribers.get(job["task_id"], []):
+            queue.put_nowait(dict(job))
+
+    # --- Persistence ---
+
+    def _path(self, task_id: str) -> Optional[pathlib.Path]:
+        if not _TASK_ID_PATTERN.match(task_id):
+            return None
+        return self.jobs_dir / f"{task_id}.json"
+
+    def _persist(self, job: Dict[str, Any]) -> None:
+        """Writes the job record atomically (write to temp file, then rename)."""
+        path = self._path(job["task_id"])
+        if path is None:
+            print(f"ERROR: [VideoJobs] Unexpected task ID, not persisted: {job['task_id']!r}")
+            return
+        try:
+            self.jobs_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(json.dumps(job), encoding="utf-8")
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            print(f"ERROR: [VideoJobs] Could not persist {job['task_id']}: {e}")
+
+    def _load(self, task_id: str) -> Optional[Dict[str, Any]]:
+        path = self._path(task_id)
+        if path is None:
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"WARN: [VideoJobs] Could not read {path}: {e}")
+            return None
+
+
+tracker = VideoJobTracker(VIDEO_JOBS_DIR)
@@ -6,15 +6,16 @@ Provides text-to-video and image-to-video generation capabilities.
 import os
 import io
 import base64
-import datetime
-import uuid
 import pathlib
 import time
-import requests
 import asyncio
 from dotenv import load_dotenv
 from fastapi import HTTPException
 
+from provider_clients import get_ark_client, get_http_session, provider_slot, run_blocking
+from media_store import new_output_path, stream_to_file, STREAM_CHUNK_SIZE
+import output_writer
+
 # Load environment variables
 load_dotenv()
 
@@ -23,34 +24,34 @@ SEEDANCE_BASE_URL = "https://ark.ap-southeast.bytepluses.com/api/v3"
 SEEDANCE_MODEL = "seedance-1-5-pro-251215"
 
 
+def _video_output_path(model_name: str, create_dir: bool = True) -> pathlib.Path:
+    clean_model = model_name.replace(":", "").replace("/", "-").split("-")[0]
+    return new_output_path("video", clean_model, ".mp4", create_dir=create_dir)
+
+
 def save_video_to_disk(video_data: bytes, model_name: str = "seedance") -> str:
     """
-    Saves video bytes to output_api/{date}/video/{model}_{time}_{uid}.mp4
-    Returns: Absolute path of saved file
+    Saves video bytes to output_api/{date}/video/{model}_{time}_{uid}.mp4 in the background
+    Returns: Absolute path the file is written to
     """
     try:
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        output_dir = pathlib.Path("output_api") / today / "video"
-        output_dir.mkdir(parents=True, exist_ok=True)
-
-        timestamp = datetime.datetime.now().strftime("%H-%M-%S")
-        short_id = str(uuid.uuid4())[:8]
-        clean_model = model_name.replace(":", "").replace("/", "-").split("-")[0]
-        filename = f"{clean_model}_{timestamp}_{short_id}.mp4"
-        filepath = output_dir / filename
-
-        with open(filepath, "wb") as f:
-            f.write(video_data)
-
-        print(f"DEBUG: Saved video to: {filepath.absolute()}")
-        return str(filepath.absolute())
+        return output_writer.write(_video_output_path(model_name, create_dir=False), bytes(video_data))
     except Exception as e:
-        print(f"ERROR: Failed to save video: {e}")
-        import traceback
-        traceback.print_exc()
+        print(f"ERROR: Failed to queue video for saving: {e}")
         return None
 
 
+def _stream_video_to_disk(video_url: str, model_name: str) -> str:
+    """Downloads in chunks straight to output_api/{date}/video/ (never the whole file in memory)."""
+    filepath = _video_output_path(model_name)
+    with get_http_session().get(video_url, stream=True, timeout=(10, 300)) as response:
+        response.raise_for_status()
+        written = stream_to_file(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), filepath)
+    output_writer.sync_later(filepath)
+    print(f"DEBUG: Streamed video to: {filepath.absolute()} ({written:,} bytes)")
+    return str(filepath.absolute())
+
+
 def _prepare_image_for_api(image_input: str) -> str:
     """
     Prepare image for Seedance API.
@@ -65,7 +66,7 @@ def _prepare_image_for_api(image_input: str) -> str:
         if "localhost" in image_input or "127.0.0.1" in image_input or "192.168." in image_input:
             print(f"DEBUG: Local URL detected, downloading and converting to base64...")
             try:
-                response = requests.get(image_input, timeout=10)
+                response = get_http_session().get(image_input, timeout=10)
                 response.raise_for_status()
                 image_bytes = response.content
                 
@@ -101,7 +102,8 @@ def _prepare_image_for_api(image_input: str) -> str:
         return image_input
 
 
-async def generate_video_seedance(
+
+async def submit_video_task(
     prompt: str,
     model_name: str = None,
     first_frame_image: str = None,
@@ -113,9 +115,9 @@ async def generate_video_seedance(
     camera_fixed: bool = False,
     watermark: bool = False,
     generate_audio: bool = False
-) -> dict:
+) -> str:
     """
-    Generate video using Seedance API.
+    Creates a Seedance video generation task and returns its task ID at once.
     
     Parameters:
         prompt: Text description (can include --duration, --rs, --rt, etc.)
@@ -129,13 +131,10 @@ async def generate_video_seedance(
         camera_fixed: Lock camera movement (T2V only, not for I2V)
         watermark: Add watermark to output
         generate_audio: Generate audio for the video
-    
-    Returns:
-        dict with 'video_url', 'video_base64', 'duration', 'saved_path', etc.
     """
     actual_model = model_name or SEEDANCE_MODEL
     
-    print(f"DEBUG: generate_video_seedance called")
+    print(f"DEBUG: submit_video_task called")
     print(f"DEBUG: Model: {actual_model}")
     print(f"DEBUG: Prompt: {prompt[:100]}..." if len(prompt) > 100 else f"DEBUG: Prompt: {prompt}")
     print(f"DEBUG: First frame: {'Yes' if first_frame_image else 'No'}")
@@ -148,13 +147,8 @@ async def generate_video_seedance(
         raise HTTPException(status_code=500, detail="ARK_API_KEY not configured")
     
     try:
-        # Import BytePlus SDK
-        from byteplussdkarkruntime import Ark
-        
-        client = Ark(
-            base_url=SEEDANCE_BASE_URL,
-            api_key=ARK_API_KEY,
-        )
+        # Shared sync SDK client; calls run on the bounded Ark executor
+        client = get_ark_client()
         
         # Build prompt with parameters appended
         full_prompt = prompt
@@ -185,7 +179,7 @@ async def generate_video_seedance(
         
         # Add first frame image if provided (Image-to-Video)
         if first_frame_image:
-            image_url = _prepare_image_for_api(first_frame_image)
+            image_url = await asyncio.to_thread(_prepare_image_for_api, first_frame_image)
             content.append({
                 "type": "image_url",
                 "image_url": {"url": image_url},
@@ -195,7 +189,7 @@ async def generate_video_seedance(
         
         # Add last frame image if provided
         if last_frame_image:
-            image_url = _prepare_image_for_api(last_frame_image)
+            image_url = await asyncio.to_thread(_prepare_image_for_api, last_frame_image)
             content.append({
                 "type": "image_url",
                 "image_url": {"url": image_url},
@@ -215,156 +209,156 @@ async def generate_video_seedance(
         
         print(f"DEBUG: generate_audio = {generate_audio}")
         
-        create_result = client.content_generation.tasks.create(**create_kwargs)
+        async with provider_slot("ark"):
+            create_result = await run_blocking("ark", client.content_generation.tasks.create, **create_kwargs)
         
         task_id = create_result.id
         print(f"DEBUG: Task created, ID: {task_id}")
-        
-        # Poll for completion
-        print("DEBUG: Polling for task completion...")
-        max_attempts = 300  # 5 minutes max (1 second intervals)
-        attempt = 0
-        
-        while attempt < max_attempts:
-            get_result = client.content_generation.tasks.get(task_id=task_id)
-            status = get_result.status
-            
-            if status == "succeeded":
-                print(f"DEBUG: Task succeeded!")
-                
-                # Debug: Print full result structure
-                print(f"DEBUG: get_result type: {type(get_result)}")
-                
-                # Extract video URL from result - use model_dump() for reliable access
-                video_url = None
-                video_duration = None
-                
-                # Method 1: Use model_dump() to get dict representation (most reliable)
-                try:
-                    result_dict = get_result.model_dump()
-                    print(f"DEBUG: Result dict keys: {result_dict.keys()}")
-                    print(f"DEBUG: Full result dict: {result_dict}")
-                    
-                    # Check content in dict
-                    content = result_dict.get('content')
-                    if content:
-                        print(f"DEBUG: Content type: {type(content)}")
-                        
-                        # Content might be a dict or a list
-                        if isinstance(content, dict):
-                            # Single content object
-                            if 'video_url' in content:
-                                vu = content['video_url']
-                                video_url = vu.get('url') if isinstance(vu, dict) else str(vu)
-                            if 'url' in content:
-                                video_url = content['url']
-                        elif isinstance(content, list):
-                            # List of content items
-                            for item in content:
-                                if isinstance(item, dict):
-                                    if 'video_url' in item:
-                                        vu = item['video_url']
-                                        video_url = vu.get('url') if isinstance(vu, dict) else str(vu)
-                                        break
-                                    if 'url' in item:
-                                        video_url = item['url']
-                                        break
-                        else:
-                            # Content might be a string URL directly
-                            video_url = str(content)
-                    
-                    # Check for direct video_url field in result
-                    if not video_url and 'video_url' in result_dict:
-                        vu = result_dict['video_url']
-                        video_url = vu.get('url') if isinstance(vu, dict) else str(vu)
-                    
-                    # Check frames field (videos might be stored here)
-                    if not video_url and result_dict.get('frames'):
-                        frames = result_dict['frames']
-                        print(f"DEBUG: Frames: {frames}")
-                        if isinstance(frames, list) and frames:
-                            video_url = frames[0] if isinstance(frames[0], str) else frames[0].get('url')
-                    
-                except Exception as e:
-                    print(f"DEBUG: Error using model_dump: {e}")
-                
-                # Method 2: Try direct attribute access as fallback
-                if not video_url:
-                    try:
-                        content = get_result.content
-                        print(f"DEBUG: Direct content access type: {type(content)}")
-                        print(f"DEBUG: Direct content attrs: {dir(content)}")
-                        
-                        # Try content.video_url
-                        if hasattr(content, 'video_url'):
-                            vu = content.video_url
-                            video_url = vu.url if hasattr(vu, 'url') else str(vu)
-                            print(f"DEBUG: Found content.video_url: {video_url}")
-                        
-                        # Try content.url
-                        if not video_url and hasattr(content, 'url'):
-                            video_url = content.url
-                            print(f"DEBUG: Found content.url: {video_url}")
-                        
-                        # Try iterating if content is iterable
-                        if not video_url and hasattr(content, '__iter__'):
-                            for item in content:
-                                if hasattr(item, 'video_url'):
-                                    vu = item.video_url
-                                    video_url = vu.url if hasattr(vu, 'url') else str(vu)
-                                    break
-                    except Exception as e:
-                        print(f"DEBUG: Error with direct access: {e}")
-                
-                print(f"DEBUG: Final Video URL: {video_url}")
-                print(f"DEBUG: Duration: {video_duration}")
-                
-                # Download video and save to disk
-                saved_path = None
-                video_base64 = None
-                if video_url:
-                    try:
-                        video_response = requests.get(video_url)
-                        video_response.raise_for_status()
-                        video_bytes = video_response.content
-                        saved_path = save_video_to_disk(video_bytes, actual_model)
-                        video_base64 = base64.b64encode(video_bytes).decode('utf-8')
-                    except Exception as e:
-                        print(f"WARN: Failed to download/save video: {e}")
-                
-                return {
-                    "status": "success",
-                    "video_url": video_url,
-                    "video_base64": video_base64,
-                    "duration": video_duration,
-                    "saved_path": saved_path,
-                    "task_id": task_id
-                }
-                
-            elif status == "failed":
-                error_msg = getattr(get_result, 'error', 'Unknown error')
-                print(f"DEBUG: Task failed: {error_msg}")
-                raise HTTPException(status_code=500, detail=f"Video generation failed: {error_msg}")
-            
-            else:
-                # Still processing
-                if attempt % 10 == 0:  # Log every 10 seconds
-                    print(f"DEBUG: Status: {status}, attempt {attempt}/{max_attempts}")
-                await asyncio.sleep(1)
-                attempt += 1
-        
-        # Timeout
-        raise HTTPException(status_code=504, detail="Video generation timed out after 5 minutes")
+        return task_id
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"ERROR: Video generation failed: {e}")
+        print(f"ERROR: Video task creation failed: {e}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def get_video_task(task_id: str):
+    """Fetches the current Seedance task state (one tasks.get call)."""
+    client = get_ark_client()
+    async with provider_slot("ark"):
+        return await run_blocking("ark", client.content_generation.tasks.get, task_id=task_id)
+
+
+def extract_video_url(get_result) -> str:
+    """Finds the video URL in a succeeded task result (the SDK has returned several shapes)."""
+    video_url = None
+    
+    # Method 1: Use model_dump() to get dict representation (most reliable)
+    try:
+        result_dict = get_result.model_dump()
+        print(f"DEBUG: Result dict keys: {result_dict.keys()}")
+        
+        # Check content in dict
+        content = result_dict.get('content')
+        if content:
+            # Content might be a dict or a list
+            if isinstance(content, dict):
+                # Single content object
+                if 'video_url' in content:
+                    vu = content['video_url']
+                    video_url = vu.get('url') if isinstance(vu, dict) else str(vu)
+                if 'url' in content:
+                    video_url = content['url']
+            elif isinstance(content, list):
+                # List of content items
+                for item in content:
+                    if isinstance(item, dict):
+                        if 'video_url' in item:
+                            vu = item['video_url']
+                            video_url = vu.get('url') if isinstance(vu, dict) else str(vu)
+                            break
+                        if 'url' in item:
+                            video_url = item['url']
+                            break
+            else:
+                # Content might be a string URL directly
+                video_url = str(content)
+        
+        # Check for direct video_url field in result
+        if not video_url and 'video_url' in result_dict:
+            vu = result_dict['video_url']
+            video_url = vu.get('url') if isinstance(vu, dict) else str(vu)
+        
+        # Check frames field (videos might be stored here)
+        if not video_url and result_dict.get('frames'):
+            frames = result_dict['frames']
+            if isinstance(frames, list) and frames:
+                video_url = frames[0] if isinstance(frames[0], str) else frames[0].get('url')
+        
+    except Exception as e:
+        print(f"DEBUG: Error using model_dump: {e}")
+    
+    # Method 2: Try direct attribute access as fallback
+    if not video_url:
+        try:
+            content = get_result.content
+            
+            # Try content.video_url
+            if hasattr(content, 'video_url'):
+                vu = content.video_url
+                video_url = vu.url if hasattr(vu, 'url') else str(vu)
+            
+            # Try content.url
+            if not video_url and hasattr(content, 'url'):
+                video_url = content.url
+            
+            # Try iterating if content is iterable
+            if not video_url and hasattr(content, '__iter__'):
+                for item in content:
+                    if hasattr(item, 'video_url'):
+                        vu = item.video_url
+                        video_url = vu.url if hasattr(vu, 'url') else str(vu)
+                        break
+        except Exception as e:
+            print(f"DEBUG: Error with direct access: {e}")
+    
+    print(f"DEBUG: Final Video URL: {video_url}")
+    return video_url
+
+
+async def download_video(video_url: str, model_name: str = None) -> str:
+    """
+    Downloads a finished video to disk.
+    Returns: Absolute path of saved file
+    Raises: the download error (requests.HTTPError for an expired URL), so the caller can retry
+    """
+    return await asyncio.to_thread(_stream_video_to_disk, video_url, model_name or SEEDANCE_MODEL)
+
+
+async def generate_video_seedance(timeout: float = 300, include_base64: bool = False, **kwargs) -> dict:
+    """
+    Generate video using Seedance API and wait for the result.
+    
+    Submits through the video job tracker (see video_jobs.py), so the task is
+    polled and persisted like any other job even if this caller goes away.
+    Accepts the same keyword arguments as submit_video_task, plus client_id
+    for the rate limiter's fair queueing.
+    
+    Returns:
+        dict with 'video_url', 'media_url', 'duration', 'saved_path', etc.;
+        'video_base64' is only filled when include_base64 is set.
+    """
+    from video_jobs import tracker
+    
+    task_id = await tracker.submit(**kwargs)
+    try:
+        job = await asyncio.wait_for(tracker.wait(task_id), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Video generation still running after {int(timeout)}s; poll /api/video/jobs/{task_id}")
+    
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=500, detail=f"Video generation failed: {job.get('error') or 'Unknown error'}")
+    
+    video_base64 = None
+    if include_base64 and job.get("saved_path"):
+        video_bytes = await asyncio.to_thread(pathlib.Path(job["saved_path"]).read_bytes)
+        video_base64 = base64.b64encode(video_bytes).decode('utf-8')
+    
+    return {
+        "status": "success",
+        "video_url": job.get("video_url"),
+        "media_url": job.get("media_url"),
+        "video_base64": video_base64,
+        "duration": None,
+        "saved_path": job.get("saved_path"),
+        "task_id": task_id,
+        "rate_limit": job.get("rate_limit")
+    }
+
+
 # Test function
 if __name__ == "__main__":
     import asyncio
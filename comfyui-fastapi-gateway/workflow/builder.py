@@ -5,19 +5,29 @@ import json
 from typing import Dict, Any, Optional, List, Tuple
 
 from .context import WorkflowContext
-from .params import validate_params
+from .params import validate_params, get_draft_params
 from .modules import (
     BaseModule,
     LoaderModule,
     LoraModule,
     ModelMergeModule,
     SamplingDiscreteModule,
+    DeepShrinkModule,
+    TokenMergingModule,
+    HiresHyperTileModule,
     ConditioningModule,
     ClipVisionModule,
     ControlNetModule,
     SamplerModule,
+    LatentInputModule,
     HiresFixModule,
+    TiledUpscaleModule,
+    LatentHiresModule,
     OutputModule,
+    SaveLatentModule,
+    PREPROCESSOR_ORDER,
+    add_reference_chain,
+    add_preprocessor_node,
 )
 
 
@@ -27,27 +37,62 @@ class WorkflowBuilder:
     
     The pipeline runs modules in order:
     1. Loader (checkpoint)
-    2. Model modifiers (LoRAs, merge, sampling discrete)
+    2. Model modifiers (LoRAs, merge, sampling discrete, Deep Shrink, token merging,
+       hires HyperTile)
     3. Conditioning (CLIP, ClipVision, ControlNet)
-    4. Sampler (KSampler)
-    5. Postprocess (HiresFix)
+    4. Sampler (KSampler, optional base latent persistence)
+    5. Postprocess (HiresFix, tiled or latent upscale; none for Deep Shrink)
     6. Output (Image Saver)
+    
+    Refine workflows swap step 4 for a persisted base latent.
     """
     
     def __init__(self, client_id: str = "workflow_builder"):
         self.client_id = client_id
         
-        # Default module pipeline order
-        self.modules: List[BaseModule] = [
+        # Model stage: checkpoint + model modifiers
+        self.model_modules: List[BaseModule] = [
             LoaderModule(),
             ModelMergeModule(),      # NEW: Merge before LoRAs
             LoraModule(),
             SamplingDiscreteModule(), # NEW: After model modifications
+            DeepShrinkModule(),       # Single-pass hires (hf_strategy "deep_shrink")
+            TokenMergingModule(),     # Patches the finished model per pass
+            HiresHyperTileModule(),   # Hires model only, after its ToMe patch
+        ]
+        
+        # Conditioning stage: prompts, ClipVision, ControlNet
+        self.conditioning_modules: List[BaseModule] = [
             ConditioningModule(),
             ClipVisionModule(),
             ControlNetModule(),
+        ]
+        
+        # Sampling stage: base pass + hires strategies (no output)
+        self.sampling_modules: List[BaseModule] = [
             SamplerModule(),
+            SaveLatentModule(),
+            HiresFixModule(),
+            TiledUpscaleModule(),
+            LatentHiresModule(),
+        ]
+        
+        # Default module pipeline order
+        self.modules: List[BaseModule] = [
+            *self.model_modules,
+            *self.conditioning_modules,
+            *self.sampling_modules,
+            OutputModule(),
+        ]
+        
+        # Refine pipeline: same model/conditioning, base pass replaced by LoadLatent
+        self.refine_modules: List[BaseModule] = [
+            *self.model_modules,
+            *self.conditioning_modules,
+            LatentInputModule(),
             HiresFixModule(),
+            TiledUpscaleModule(),
+            LatentHiresModule(),
             OutputModule(),
         ]
         
@@ -71,24 +116,142 @@ class WorkflowBuilder:
         
         # Create fresh context
         ctx = WorkflowContext()
+        self._run_modules(self.modules, ctx, validated_params)
+        
+        print(f"[WorkflowBuilder] Complete. Total nodes: {len(ctx.nodes)}")
+        
+        return ctx.nodes, ctx.preview_node_id
+    
+    def build_refine(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Build a hires-only workflow that starts from a persisted base latent.
+        
+        Args:
+            params: Original job parameters merged with the new hires settings,
+                    plus base_latent_filename (a .latent file in ComfyUI input)
+            
+        Returns:
+            Workflow nodes dict
+        """
+        validated_params = validate_params(params)
+        validated_params["hf_enable"] = True
+        
+        print(f"[WorkflowBuilder] Building REFINE workflow for client: {self.client_id}")
+        
+        ctx = WorkflowContext()
+        self._run_modules(self.refine_modules, ctx, validated_params)
+        
+        print(f"[WorkflowBuilder] Refine complete. Total nodes: {len(ctx.nodes)}")
+        
+        return ctx.nodes
+    
+    def build_matrix(
+        self, params: Dict[str, Any], cells: List[Tuple[str, Dict[str, Any]]]
+    ) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        Build one workflow that renders every cell of a parameter matrix.
+        
+        The model stage (loader, merge, LoRAs) is built once and shared by all
+        cells, conditioning is built once per distinct prompt pair, and each
+        cell gets its own sampling branch ending in a PreviewImage.
+        
+        Args:
+            params: Base generation parameters
+            cells: List of (cell_key, param_overrides)
+            
+        Returns:
+            Tuple of (workflow_nodes_dict, {cell_key: output_node_id})
+        """
+        validated_params = validate_params(params)
+        
+        print(f"[WorkflowBuilder] Building MATRIX workflow ({len(cells)} cells) for client: {self.client_id}")
+        
+        ctx = WorkflowContext()
+        self._run_modules(self.model_modules, ctx, validated_params)
+        
+        conditioning_cache: Dict[Tuple[str, str], Tuple] = {}
+        cell_output_ids: Dict[str, str] = {}
+        
+        for cell_key, overrides in cells:
+            cell_params = dict(validated_params)
+            cell_params.update(overrides)
+            
+            prompt_key = (cell_params.get("positive_prompt", ""), cell_params.get("negative_prompt", ""))
+            if prompt_key not in conditioning_cache:
+                ctx.positive_cond_ref = None
+                ctx.negative_cond_ref = None
+                ctx.latent_ref = None
+                self._run_modules(self.conditioning_modules, ctx, cell_params)
+                conditioning_cache[prompt_key] = (
+                    ctx.positive_cond_ref, ctx.negative_cond_ref, ctx.latent_ref
+                )
+            ctx.positive_cond_ref, ctx.negative_cond_ref, ctx.latent_ref = conditioning_cache[prompt_key]
+            
+            # Persisting latents is per-job, not per-cell
+            cell_params["persist_latent"] = False
+            self._run_modules(self.sampling_modules, ctx, cell_params)
+            
+            output_id, _ = ctx.add_node(
+                "PreviewImage",
+                {"images": ctx.pixels_ref},
+                f"MATRIX CELL {cell_key}"
+            )
+            cell_output_ids[cell_key] = output_id
         
-        # Run each module in order
-        for module in self.modules:
+        print(
+            f"[WorkflowBuilder] Matrix complete. Cells: {len(cells)}, "
+            f"conditionings: {len(conditioning_cache)}, nodes: {len(ctx.nodes)}"
+        )
+        
+        return ctx.nodes, cell_output_ids
+    
+    def build_draft(self, params: Dict[str, Any], draft_lora: str) -> Tuple[Dict[str, Any], str]:
+        """
+        Build the fast draft workflow for a job.
+        
+        Model and conditioning stages are the same modules the full job runs,
+        so the checkpoint, CLIP and conditioning nodes are cache hits when the
+        full job follows. Only the base pass runs, ending in a PreviewImage.
+        
+        Returns:
+            Tuple of (workflow_nodes_dict, draft_output_node_id)
+        """
+        validated_params = validate_params(get_draft_params(params, draft_lora))
+        
+        print(f"[WorkflowBuilder] Building DRAFT workflow for client: {self.client_id}")
+        
+        ctx = WorkflowContext()
+        self._run_modules(
+            [*self.model_modules, *self.conditioning_modules, SamplerModule()],
+            ctx,
+            validated_params,
+        )
+        output_id, _ = ctx.add_node(
+            "PreviewImage",
+            {"images": ctx.pixels_ref},
+            "DRAFT PREVIEW"
+        )
+        
+        print(f"[WorkflowBuilder] Draft complete. Total nodes: {len(ctx.nodes)}")
+        
+        return ctx.nodes, output_id
+    
+    def _run_modules(
+        self, modules: List[BaseModule], ctx: WorkflowContext, params: Dict[str, Any]
+    ) -> None:
+        """Run each module in order against a shared context."""
+        for module in modules:
             module_name = module.get_name()
             
-            if module.should_run(validated_params):
+            if module.should_run(params):
                 print(f"[WorkflowBuilder] Running: {module_name}")
                 try:
-                    module.build(ctx, validated_params)
+                    module.build(ctx, params)
                 except Exception as e:
                     print(f"[WorkflowBuilder] ERROR in {module_name}: {e}")
                     raise
             else:
                 print(f"[WorkflowBuilder] Skipping: {module_name}")
-        
-        print(f"[WorkflowBuilder] Complete. Total nodes: {len(ctx.nodes)}")
-        
-        return ctx.nodes, ctx.preview_node_id
     
     def build_preview_workflow(self, params: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -113,8 +276,6 @@ class WorkflowBuilder:
             print("[WorkflowBuilder] No reference image for preview")
             return {}
         
-        cn_module = ControlNetModule()
-        
         # Load reference image directly
         load_img_id, _ = ctx.add_node(
             "LoadImage",
@@ -123,70 +284,13 @@ class WorkflowBuilder:
         )
         current_image_ref = ctx.get_ref(load_img_id, 0)
         
-        # Apply preprocessor chain (simplified from ControlNetModule)
+        # Apply preprocessor chain (same order as ControlNetModule)
         preprocessors = validated_params.get("controlnet_preprocessors", {})
-        
-        if preprocessors.get("anyLine"):
-            style = validated_params.get("selected_anyline_style", "lineart_realistic")
-            resolution = validated_params.get("cn_anyline_resolution", 1152)
-            anyline_id, _ = ctx.add_node(
-                "AnyLineArtPreprocessor_aux",
-                {
-                    "image": current_image_ref,
-                    "merge_with_lineart": style,
-                    "resolution": resolution,
-                    "lineart_lower_bound": 0.0,
-                    "lineart_upper_bound": 1.0,
-                    "object_min_size": 36,
-                    "object_connectivity": 1,
-                },
-                "Preview: AnyLine"
-            )
-            current_image_ref = ctx.get_ref(anyline_id, 0)
-        
-        if preprocessors.get("depth"):
-            depth_model = validated_params.get("cn_depth_model", "depth_anything_v2_vitl.pth")
-            resolution = validated_params.get("cn_depth_resolution", 1472)
-            depth_id, _ = ctx.add_node(
-                "DepthAnythingV2Preprocessor",
-                {
-                    "image": current_image_ref,
-                    "ckpt_name": depth_model,
-                    "resolution": resolution,
-                },
-                "Preview: Depth"
-            )
-            current_image_ref = ctx.get_ref(depth_id, 0)
-        
-        if preprocessors.get("openPose"):
-            resolution = validated_params.get("cn_openpose_resolution", 1024)
-            pose_id, _ = ctx.add_node(
-                "OpenposePreprocessor",
-                {
-                    "image": current_image_ref,
-                    "resolution": resolution,
-                    "detect_hand": "enable",
-                    "detect_body": "enable",
-                    "detect_face": "enable",
-                    "scale_stick_for_xinsr_cn": "disable",
-                },
-                "Preview: OpenPose"
-            )
-            current_image_ref = ctx.get_ref(pose_id, 0)
-        
-        if preprocessors.get("canny"):
-            resolution = validated_params.get("cn_canny_resolution", 192)
-            canny_id, _ = ctx.add_node(
-                "CannyEdgePreprocessor",
-                {
-                    "image": current_image_ref,
-                    "low_threshold": 100,
-                    "high_threshold": 200,
-                    "resolution": resolution,
-                },
-                "Preview: Canny"
-            )
-            current_image_ref = ctx.get_ref(canny_id, 0)
+        for name in PREPROCESSOR_ORDER:
+            if preprocessors.get(name):
+                current_image_ref = add_preprocessor_node(
+                    ctx, name, current_image_ref, validated_params, "Preview"
+                )
         
         # Final preview node
         preview_id, _ = ctx.add_node(
@@ -198,3 +302,56 @@ class WorkflowBuilder:
         print(f"[WorkflowBuilder] Preview workflow built. Nodes: {len(ctx.nodes)}")
         
         return ctx.nodes
+    
+    def build_preview_branches_workflow(
+        self, params: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        Build a preview workflow with one independent branch per enabled
+        preprocessor, all fed from a shared LoadImage (+ optional upscale).
+        
+        Unlike build_preview_workflow, each preprocessor sees the reference
+        image rather than the previous preprocessor's output. Branches whose
+        inputs are unchanged since the last run are served from ComfyUI's
+        cache, so tuning one preprocessor only re-executes that branch.
+        
+        Args:
+            params: Parameters with controlnet settings
+            
+        Returns:
+            Tuple of (workflow_nodes_dict, {preprocessor_name: preview_node_id})
+        """
+        validated_params = validate_params(params)
+        
+        print(f"[WorkflowBuilder] Building PREVIEW BRANCHES workflow")
+        
+        ctx = WorkflowContext()
+        
+        if not validated_params.get("controlnet_ref_image_filename"):
+            print("[WorkflowBuilder] No reference image for preview")
+            return {}, {}
+        
+        preprocessors = validated_params.get("controlnet_preprocessors", {})
+        enabled = [name for name in PREPROCESSOR_ORDER if preprocessors.get(name)]
+        if not enabled:
+            print("[WorkflowBuilder] No preprocessors enabled for preview")
+            return {}, {}
+        
+        # Shared reference load + upscale, computed once for all branches
+        ref_image = add_reference_chain(
+            ctx, validated_params, validated_params["controlnet_ref_image_filename"], "Preview"
+        )
+        
+        branch_preview_ids: Dict[str, str] = {}
+        for name in enabled:
+            hint_ref = add_preprocessor_node(ctx, name, ref_image, validated_params, "Preview")
+            preview_id, _ = ctx.add_node(
+                "PreviewImage",
+                {"images": hint_ref},
+                f"PREPROCESSOR PREVIEW: {name}"
+            )
+            branch_preview_ids[name] = preview_id
+        
+        print(f"[WorkflowBuilder] Preview branches built: {enabled}. Nodes: {len(ctx.nodes)}")
+        
+        return ctx.nodes, branch_preview_ids
@@ -25,6 +25,12 @@ class WorkflowContext:
     latent_ref: Optional[List] = None
     pixels_ref: Optional[List] = None
     
+    # Model for the hires pass when it differs from model_ref (None = use model_ref)
+    hires_model_ref: Optional[List] = None
+    
+    # Sampled (pre-decode) latent of the base pass
+    samples_ref: Optional[List] = None
+    
     # Model name string reference (for Image Saver)
     model_name_str_ref: Optional[List] = None
     
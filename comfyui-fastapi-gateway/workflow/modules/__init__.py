@@ -1,11 +1,28 @@
 # Workflow Modules Package
 from .base import BaseModule
 from .loader import LoaderModule
-from .model_modifiers import LoraModule, ModelMergeModule, SamplingDiscreteModule
-from .conditioning import ConditioningModule, ControlNetModule, ClipVisionModule
-from .sampler import SamplerModule
-from .postprocess import HiresFixModule
-from .output import OutputModule
+from .model_modifiers import (
+    LoraModule,
+    ModelMergeModule,
+    SamplingDiscreteModule,
+    DeepShrinkModule,
+    TokenMergingModule,
+    HiresHyperTileModule,
+)
+from .conditioning import (
+    ConditioningModule,
+    ControlNetModule,
+    ClipVisionModule,
+    PREPROCESSOR_ORDER,
+    PREPROCESSOR_PARAMS,
+    CANNY_LOW_THRESHOLD,
+    CANNY_HIGH_THRESHOLD,
+    add_reference_chain,
+    add_preprocessor_node,
+)
+from .sampler import SamplerModule, LatentInputModule
+from .postprocess import HiresFixModule, TiledUpscaleModule, LatentHiresModule
+from .output import OutputModule, SaveLatentModule
 
 __all__ = [
     'BaseModule',
@@ -13,10 +30,23 @@ __all__ = [
     'LoraModule',
     'ModelMergeModule',
     'SamplingDiscreteModule',
+    'DeepShrinkModule',
+    'TokenMergingModule',
+    'HiresHyperTileModule',
     'ConditioningModule',
     'ControlNetModule',
     'ClipVisionModule',
     'SamplerModule',
+    'LatentInputModule',
     'HiresFixModule',
+    'TiledUpscaleModule',
+    'LatentHiresModule',
     'OutputModule',
+    'SaveLatentModule',
+    'PREPROCESSOR_ORDER',
+    'PREPROCESSOR_PARAMS',
+    'CANNY_LOW_THRESHOLD',
+    'CANNY_HIGH_THRESHOLD',
+    'add_reference_chain',
+    'add_preprocessor_node',
 ]
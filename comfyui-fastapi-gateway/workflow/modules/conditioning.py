@@ -1,11 +1,159 @@
 """
 Conditioning modules - CLIP encoding, ControlNet, ClipVision.
 """
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 from .base import BaseModule
 from ..context import WorkflowContext
 
 
+# Order in which enabled preprocessors are chained
+PREPROCESSOR_ORDER = ("anyLine", "depth", "openPose", "canny")
+
+PREPROCESSOR_LABELS = {
+    "anyLine": "AnyLine",
+    "depth": "Depth",
+    "openPose": "OpenPose",
+    "canny": "Canny",
+}
+
+# Canny thresholds (also used by the gateway's local Canny preview)
+CANNY_LOW_THRESHOLD = 100
+CANNY_HIGH_THRESHOLD = 200
+
+# Params each preprocessor reads; identical values mean an identical node
+PREPROCESSOR_PARAMS = {
+    "anyLine": ("cn_anyline_resolution", "selected_anyline_style"),
+    "depth": ("cn_depth_resolution", "cn_depth_model"),
+    "openPose": ("cn_openpose_resolution",),
+    "canny": ("cn_canny_resolution",),
+}
+
+
+def add_reference_chain(
+    ctx: WorkflowContext,
+    params: Dict[str, Any],
+    ref_image_file: str,
+    title_prefix: str,
+) -> List:
+    """
+    Load the ControlNet reference image and apply the optional model
+    upscale / rescale. Returns the reference to the resulting image.
+    """
+    load_img_id, _ = ctx.add_node(
+        "LoadImage",
+        {"image": ref_image_file},
+        f"{title_prefix} Load Ref Image"
+    )
+    current_image_ref = ctx.get_ref(load_img_id, 0)
+    
+    # Optional: Upscale Reference Image
+    cn_upscale_model = params.get("controlnet_upscale_model")
+    if cn_upscale_model and cn_upscale_model != "None":
+        # Load Upscale Model
+        upscale_loader_id, _ = ctx.add_node(
+            "UpscaleModelLoader",
+            {"model_name": cn_upscale_model},
+            f"{title_prefix} Upscale Model Loader"
+        )
+        upscale_model_ref = ctx.get_ref(upscale_loader_id, 0)
+        
+        # Apply Upscale
+        upscale_id, _ = ctx.add_node(
+            "ImageUpscaleWithModel",
+            {
+                "upscale_model": upscale_model_ref,
+                "image": current_image_ref,
+            },
+            f"{title_prefix} Image Upscale"
+        )
+        current_image_ref = ctx.get_ref(upscale_id, 0)
+        print(f"[ControlNet] Upscaled reference image with {cn_upscale_model}")
+    
+    # Optional: Resize Reference Image (applied after model upscale if any)
+    cn_upscale_factor = params.get("controlnet_upscale_factor") or 1.0
+    cn_upscale_method = params.get("controlnet_upscale_method") or "nearest-exact"
+    
+    if cn_upscale_factor != 1.0:
+        scale_id, _ = ctx.add_node(
+            "ImageScaleBy",
+            {
+                "image": current_image_ref,
+                "upscale_method": cn_upscale_method,
+                "scale_by": cn_upscale_factor,
+            },
+            f"{title_prefix} Rescale Ref"
+        )
+        current_image_ref = ctx.get_ref(scale_id, 0)
+        print(f"[ControlNet] Rescaled reference image by {cn_upscale_factor}x using {cn_upscale_method}")
+    
+    return current_image_ref
+
+
+def add_preprocessor_node(
+    ctx: WorkflowContext,
+    name: str,
+    image_ref: List,
+    params: Dict[str, Any],
+    title_prefix: str,
+) -> List:
+    """
+    Add a single ControlNet preprocessor node fed by image_ref.
+    Returns the reference to the preprocessor output.
+    """
+    if name == "anyLine":
+        node_id, _ = ctx.add_node(
+            "AnyLineArtPreprocessor_aux",
+            {
+                "image": image_ref,
+                "merge_with_lineart": params.get("selected_anyline_style", "lineart_realistic"),
+                "resolution": params.get("cn_anyline_resolution", 1152),
+                "lineart_lower_bound": 0.0,
+                "lineart_upper_bound": 1.0,
+                "object_min_size": 36,
+                "object_connectivity": 1,
+            },
+            f"{title_prefix}: AnyLine"
+        )
+    elif name == "depth":
+        node_id, _ = ctx.add_node(
+            "DepthAnythingV2Preprocessor",
+            {
+                "image": image_ref,
+                "ckpt_name": params.get("cn_depth_model", "depth_anything_v2_vitl.pth"),
+                "resolution": params.get("cn_depth_resolution", 1472),
+            },
+            f"{title_prefix}: Depth"
+        )
+    elif name == "openPose":
+        node_id, _ = ctx.add_node(
+            "OpenposePreprocessor",
+            {
+                "image": image_ref,
+                "resolution": params.get("cn_openpose_resolution", 1024),
+                "detect_hand": "enable",
+                "detect_body": "enable",
+                "detect_face": "enable",
+                "scale_stick_for_xinsr_cn": "disable",
+            },
+            f"{title_prefix}: OpenPose"
+        )
+    elif name == "canny":
+        node_id, _ = ctx.add_node(
+            "CannyEdgePreprocessor",
+            {
+                "image": image_ref,
+                "low_threshold": CANNY_LOW_THRESHOLD,
+                "high_threshold": CANNY_HIGH_THRESHOLD,
+                "resolution": params.get("cn_canny_resolution", 192),
+            },
+            f"{title_prefix}: Canny"
+        )
+    else:
+        raise ValueError(f"Unknown ControlNet preprocessor: {name}")
+    
+    return ctx.get_ref(node_id, 0)
+
+
 class ConditioningModule(BaseModule):
     """CLIP text encoding for positive/negative prompts."""
     
@@ -129,133 +277,42 @@ class ClipVisionModule(BaseModule):
 
 
 class ControlNetModule(BaseModule):
-    """ControlNet preprocessing and application."""
+    """
+    ControlNet preprocessing and application.
+    
+    With controlnet_units, each unit has its own model, preprocessor,
+    strength and start/end percent. All hints branch from one shared
+    reference chain, identical preprocessors and ControlNet loaders are
+    built once, and each unit's ControlNetApplyAdvanced is chained on the
+    conditioning. Without units, the legacy single model is applied to the
+    chained preprocessor output.
+    """
     
     def should_run(self, params: Dict[str, Any]) -> bool:
-        return (
+        return bool(
             params.get("controlnet_enabled") and 
-            params.get("controlnet_model_name") and
+            (params.get("controlnet_units") or params.get("controlnet_model_name")) and
             params.get("controlnet_ref_image_filename")
         )
     
     def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
         """Add ControlNet preprocessors and apply."""
         
+        if params.get("controlnet_units"):
+            self._build_units(ctx, params)
+            return
+        
         ref_image_file = params["controlnet_ref_image_filename"]
         cn_model = params["controlnet_model_name"]
         cn_strength = params.get("controlnet_strength", 1.0)
         preprocessors = params.get("controlnet_preprocessors", {})
         
-        # Load reference image
-        load_img_id, _ = ctx.add_node(
-            "LoadImage",
-            {"image": ref_image_file},
-            "CN Load Ref Image"
-        )
-        current_image_ref = ctx.get_ref(load_img_id, 0)
-        
-        # Optional: Upscale Reference Image
-        cn_upscale_model = params.get("controlnet_upscale_model")
-        if cn_upscale_model and cn_upscale_model != "None":
-            # Load Upscale Model
-            upscale_loader_id, _ = ctx.add_node(
-                "UpscaleModelLoader",
-                {"model_name": cn_upscale_model},
-                "CN Upscale Model Loader"
-            )
-            upscale_model_ref = ctx.get_ref(upscale_loader_id, 0)
-            
-            # Apply Upscale
-            upscale_id, _ = ctx.add_node(
-                "ImageUpscaleWithModel",
-                {
-                    "upscale_model": upscale_model_ref,
-                    "image": current_image_ref,
-                },
-                "CN Image Upscale"
-            )
-            current_image_ref = ctx.get_ref(upscale_id, 0)
-            print(f"[ControlNetModule] Upscaled reference image with {cn_upscale_model}")
-        
-        # Optional: Resize Reference Image (applied after model upscale if any)
-        cn_upscale_factor = params.get("controlnet_upscale_factor", 1.0)
-        cn_upscale_method = params.get("controlnet_upscale_method", "nearest-exact")
-        
-        if cn_upscale_factor != 1.0:
-            scale_id, _ = ctx.add_node(
-                "ImageScaleBy",
-                {
-                    "image": current_image_ref,
-                    "upscale_method": cn_upscale_method,
-                    "scale_by": cn_upscale_factor,
-                },
-                "CN Rescale Ref"
-            )
-            current_image_ref = ctx.get_ref(scale_id, 0)
-            print(f"[ControlNetModule] Rescaled reference image by {cn_upscale_factor}x using {cn_upscale_method}")
+        current_image_ref = add_reference_chain(ctx, params, ref_image_file, "CN")
 
         # Apply preprocessor chain
-        if preprocessors.get("anyLine"):
-            style = params.get("selected_anyline_style", "lineart_realistic")
-            resolution = params.get("cn_anyline_resolution", 1152)
-            anyline_id, _ = ctx.add_node(
-                "AnyLineArtPreprocessor_aux",
-                {
-                    "image": current_image_ref,
-                    "merge_with_lineart": style,
-                    "resolution": resolution,
-                    "lineart_lower_bound": 0.0,
-                    "lineart_upper_bound": 1.0,
-                    "object_min_size": 36,
-                    "object_connectivity": 1,
-                },
-                "CN: AnyLine"
-            )
-            current_image_ref = ctx.get_ref(anyline_id, 0)
-        
-        if preprocessors.get("depth"):
-            depth_model = params.get("cn_depth_model", "depth_anything_v2_vitl.pth")
-            resolution = params.get("cn_depth_resolution", 1472)
-            depth_id, _ = ctx.add_node(
-                "DepthAnythingV2Preprocessor",
-                {
-                    "image": current_image_ref,
-                    "ckpt_name": depth_model,
-                    "resolution": resolution,
-                },
-                "CN: Depth"
-            )
-            current_image_ref = ctx.get_ref(depth_id, 0)
-        
-        if preprocessors.get("openPose"):
-            resolution = params.get("cn_openpose_resolution", 1024)
-            pose_id, _ = ctx.add_node(
-                "OpenposePreprocessor",
-                {
-                    "image": current_image_ref,
-                    "resolution": resolution,
-                    "detect_hand": "enable",
-                    "detect_body": "enable",
-                    "detect_face": "enable",
-                    "scale_stick_for_xinsr_cn": "disable",
-                },
-                "CN: OpenPose"
-            )
-            current_image_ref = ctx.get_ref(pose_id, 0)
-        
-        if preprocessors.get("canny"):
-            resolution = params.get("cn_canny_resolution", 192)
-            canny_id, _ = ctx.add_node(
-                "CannyEdgePreprocessor",
-                {
-                    "image": current_image_ref,
-                    "low_threshold": 100,
-                    "high_threshold": 200,
-                    "resolution": resolution,
-                },
-                "CN: Canny"
-            )
-            current_image_ref = ctx.get_ref(canny_id, 0)
+        for name in PREPROCESSOR_ORDER:
+            if preprocessors.get(name):
+                current_image_ref = add_preprocessor_node(ctx, name, current_image_ref, params, "CN")
         
         # Preview preprocessor output
         preview_id, _ = ctx.add_node(
@@ -291,3 +348,69 @@ class ControlNetModule(BaseModule):
         ctx.negative_cond_ref = ctx.get_ref(cn_apply_id, 1)
         
         print(f"[ControlNetModule] Applied {cn_model} with strength={cn_strength}")
+
+    def _build_units(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Add one hint branch and one chained ControlNetApplyAdvanced per unit."""
+        
+        image_ref = add_reference_chain(ctx, params, params["controlnet_ref_image_filename"], "CN")
+        hint_refs: Dict[tuple, List] = {}
+        loader_refs: Dict[str, List] = {}
+        
+        for index, unit in enumerate(params["controlnet_units"]):
+            preprocessor = unit.get("preprocessor") or "none"
+            cn_model = unit["model_name"]
+            
+            # Per-unit resolution overrides the request-wide one
+            unit_params = params
+            if unit.get("resolution") and preprocessor in PREPROCESSOR_PARAMS:
+                unit_params = {**params, PREPROCESSOR_PARAMS[preprocessor][0]: unit["resolution"]}
+            
+            if preprocessor == "none":
+                hint_ref = image_ref
+            else:
+                hint_key = (preprocessor, *(unit_params.get(k) for k in PREPROCESSOR_PARAMS[preprocessor]))
+                if hint_key not in hint_refs:
+                    hint_refs[hint_key] = add_preprocessor_node(ctx, preprocessor, image_ref, unit_params, "CN")
+                    # The first hint is streamed to the client as the preprocessor preview
+                    if ctx.preview_node_id is None:
+                        preview_id, _ = ctx.add_node(
+                            "PreviewImage",
+                            {"images": hint_refs[hint_key]},
+                            "CN Preprocessor Preview"
+                        )
+                        ctx.preview_node_id = preview_id
+                hint_ref = hint_refs[hint_key]
+            
+            if cn_model not in loader_refs:
+                cn_loader_id, _ = ctx.add_node(
+                    "ControlNetLoader",
+                    {"control_net_name": cn_model},
+                    f"Load ControlNet: {cn_model}"
+                )
+                loader_refs[cn_model] = ctx.get_ref(cn_loader_id, 0)
+            
+            strength = unit.get("strength")
+            start_percent = unit.get("start_percent")
+            end_percent = unit.get("end_percent")
+            cn_apply_id, _ = ctx.add_node(
+                "ControlNetApplyAdvanced",
+                {
+                    "positive": ctx.positive_cond_ref,
+                    "negative": ctx.negative_cond_ref,
+                    "control_net": loader_refs[cn_model],
+                    "image": hint_ref,
+                    "strength": 1.0 if strength is None else strength,
+                    "start_percent": 0.0 if start_percent is None else start_percent,
+                    "end_percent": 1.0 if end_percent is None else end_percent,
+                },
+                f"Apply ControlNet Unit {index + 1} ({PREPROCESSOR_LABELS.get(preprocessor, preprocessor)})"
+            )
+            ctx.positive_cond_ref = ctx.get_ref(cn_apply_id, 0)
+            ctx.negative_cond_ref = ctx.get_ref(cn_apply_id, 1)
+            
+            print(f"[ControlNetModule] Unit {index + 1}: {cn_model} on {preprocessor} @ {strength}")
+        
+        print(
+            f"[ControlNetModule] Applied {len(params['controlnet_units'])} unit(s) "
+            f"with {len(hint_refs)} preprocessor(s) and {len(loader_refs)} model(s)"
+        )
@@ -2,11 +2,51 @@
 Loader module - Checkpoint and VAE loading.
 """
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 from .base import BaseModule
 from ..context import WorkflowContext
 
 
+def add_split_loaders(
+    ctx: WorkflowContext, split: Dict[str, Any], weight_dtype: str, title_suffix: str = ""
+) -> Tuple[List, List, List]:
+    """
+    Load a checkpoint from its separate UNet / CLIP / VAE files, with the
+    UNet weights stored at weight_dtype (e.g. fp8_e4m3fn).
+    
+    Returns:
+        Tuple of (model_ref, clip_ref, vae_ref)
+    """
+    unet_id, _ = ctx.add_node(
+        "UNETLoader",
+        {"unet_name": split["unet"], "weight_dtype": weight_dtype},
+        f"Load UNet ({weight_dtype}){title_suffix}"
+    )
+    
+    clip_files = split["clip"] if isinstance(split["clip"], list) else [split["clip"]]
+    clip_type = split.get("clip_type", "stable_diffusion")
+    if len(clip_files) > 1:
+        clip_id, _ = ctx.add_node(
+            "DualCLIPLoader",
+            {"clip_name1": clip_files[0], "clip_name2": clip_files[1], "type": clip_type},
+            f"Load CLIP{title_suffix}"
+        )
+    else:
+        clip_id, _ = ctx.add_node(
+            "CLIPLoader",
+            {"clip_name": clip_files[0], "type": clip_type},
+            f"Load CLIP{title_suffix}"
+        )
+    
+    vae_id, _ = ctx.add_node(
+        "VAELoader",
+        {"vae_name": split["vae"]},
+        f"Load VAE{title_suffix}"
+    )
+    
+    return ctx.get_ref(unet_id, 0), ctx.get_ref(clip_id, 0), ctx.get_ref(vae_id, 0)
+
+
 class LoaderModule(BaseModule):
     """Loads the checkpoint model."""
     
@@ -19,6 +59,17 @@ class LoaderModule(BaseModule):
         
         model_name = params.get("model_name", "default")
         
+        # Reduced-precision profile: split loaders, fp8 UNet weights
+        split = params.get("split_checkpoint")
+        if split:
+            ctx.model_ref, ctx.clip_ref, ctx.vae_ref = add_split_loaders(
+                ctx, split, params.get("unet_weight_dtype", "default")
+            )
+            # Image Saver still gets the checkpoint name for its metadata and hash
+            ctx.model_name_str_ref = model_name
+            print(f"[LoaderModule] Loaded split checkpoint: {model_name} ({params.get('unet_weight_dtype')} UNet)")
+            return
+        
         # Checkpoint Loader with Name (Image Saver compatible)
         ckpt_id, _ = ctx.add_node(
             "Checkpoint Loader with Name (Image Saver)",
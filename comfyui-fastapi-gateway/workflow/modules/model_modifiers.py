@@ -1,10 +1,18 @@
 """
-Model modifier modules - LoRA, ModelMerge, SamplingDiscrete.
+Model modifier modules - LoRA, ModelMerge, SamplingDiscrete, DeepShrink,
+TokenMerging, HyperTile.
 """
 import os
 from typing import Dict, Any
 from .base import BaseModule
 from ..context import WorkflowContext
+from ..params import (
+    get_tome_ratios,
+    get_hires_strategy,
+    get_hypertile_size,
+    get_param,
+    SINGLE_PASS_HIRES_STRATEGIES,
+)
 
 
 class LoraModule(BaseModule):
@@ -30,6 +38,21 @@ class LoraModule(BaseModule):
             # Normalize path separators for ComfyUI
             lora_name_normalized = lora_name.replace("/", "\\")
             
+            # Model-only LoRAs leave the CLIP chain (and its conditioning) untouched
+            if lora_info.get("model_only"):
+                lora_id, _ = ctx.add_node(
+                    "LoraLoaderModelOnly",
+                    {
+                        "lora_name": lora_name_normalized,
+                        "strength_model": lora_strength,
+                        "model": ctx.model_ref,
+                    },
+                    f"Load LoRA (model only): {os.path.basename(lora_name)}"
+                )
+                ctx.model_ref = ctx.get_ref(lora_id, 0)
+                print(f"[LoraModule] Added model-only LoRA: {lora_name} @ {lora_strength}")
+                continue
+            
             lora_id, _ = ctx.add_node(
                 "LoraLoader",
                 {
@@ -64,13 +87,22 @@ class ModelMergeModule(BaseModule):
         model2_name = params["model2_name"]
         merge_ratio = params.get("model_merge_ratio", 0.5)
         
-        # Load second checkpoint
-        ckpt2_id, _ = ctx.add_node(
-            "CheckpointLoaderSimple",
-            {"ckpt_name": model2_name},
-            "Load Checkpoint 2 (Merge)"
-        )
-        model2_ref = ctx.get_ref(ckpt2_id, 0)
+        # Load second checkpoint (only its UNet, at reduced precision, when split)
+        split2 = params.get("split_checkpoint_model2")
+        if split2:
+            unet2_id, _ = ctx.add_node(
+                "UNETLoader",
+                {"unet_name": split2["unet"], "weight_dtype": params.get("unet_weight_dtype", "default")},
+                "Load UNet 2 (Merge)"
+            )
+            model2_ref = ctx.get_ref(unet2_id, 0)
+        else:
+            ckpt2_id, _ = ctx.add_node(
+                "CheckpointLoaderSimple",
+                {"ckpt_name": model2_name},
+                "Load Checkpoint 2 (Merge)"
+            )
+            model2_ref = ctx.get_ref(ckpt2_id, 0)
         
         # Merge models
         merge_id, _ = ctx.add_node(
@@ -115,3 +147,115 @@ class SamplingDiscreteModule(BaseModule):
         ctx.model_ref = ctx.get_ref(sampling_id, 0)
         
         print(f"[SamplingDiscreteModule] Applied {sampling_type}, ZSNR: {zsnr_enabled}")
+
+
+class DeepShrinkModule(BaseModule):
+    """
+    Applies Deep Shrink (PatchModelAddDownscale) for single-pass hires.
+    
+    The output-size latent is sampled in one pass; an input block is
+    downscaled by hf_scale for the early steps, where composition forms,
+    so it is laid out at base resolution and duplicated subjects are avoided.
+    """
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        return get_hires_strategy(params) == "deep_shrink"
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Add the PatchModelAddDownscale node."""
+        
+        downscale_factor = float(get_param(params, "hf_scale"))
+        block_number = int(get_param(params, "hf_deep_shrink_block"))
+        end_percent = float(get_param(params, "hf_deep_shrink_end"))
+        
+        shrink_id, _ = ctx.add_node(
+            "PatchModelAddDownscale",
+            {
+                "model": ctx.model_ref,
+                "block_number": block_number,
+                "downscale_factor": downscale_factor,
+                "start_percent": 0.0,
+                "end_percent": end_percent,
+                "downscale_after_skip": True,
+                "downscale_method": "bicubic",
+                "upscale_method": "bicubic",
+            },
+            f"Deep Shrink (x{downscale_factor}, block {block_number})"
+        )
+        ctx.model_ref = ctx.get_ref(shrink_id, 0)
+        
+        print(f"[DeepShrinkModule] Downscale x{downscale_factor} on block {block_number} until {end_percent}")
+
+
+class TokenMergingModule(BaseModule):
+    """
+    Applies token merging (TomePatchModel) with a ratio per pass.
+    
+    The base and hires passes each get their own patch on the unpatched
+    model, so the hires ratio never stacks on top of the base one.
+    Ratios are kept in the node titles (embedded workflow) and in the Image
+    Saver's parameters string (see OutputModule).
+    """
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        return any(ratio > 0 for ratio in get_tome_ratios(params))
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Add TomePatchModel nodes for the base and/or hires model."""
+        
+        base_ratio, hires_ratio = get_tome_ratios(params)
+        unpatched_model_ref = ctx.model_ref
+        
+        if hires_ratio > 0:
+            hires_tome_id, _ = ctx.add_node(
+                "TomePatchModel",
+                {"model": unpatched_model_ref, "ratio": hires_ratio},
+                f"HF: ToMe (ratio: {hires_ratio})"
+            )
+            ctx.hires_model_ref = ctx.get_ref(hires_tome_id, 0)
+        elif base_ratio > 0:
+            # Keep the hires pass on the full model
+            ctx.hires_model_ref = unpatched_model_ref
+        
+        if base_ratio > 0:
+            tome_id, _ = ctx.add_node(
+                "TomePatchModel",
+                {"model": unpatched_model_ref, "ratio": base_ratio},
+                f"ToMe (ratio: {base_ratio})"
+            )
+            ctx.model_ref = ctx.get_ref(tome_id, 0)
+        
+        print(f"[TokenMergingModule] ToMe ratio base: {base_ratio}, hires: {hires_ratio}")
+
+
+class HiresHyperTileModule(BaseModule):
+    """
+    Applies HyperTile to the hires model only.
+    
+    The base pass keeps the untiled model, so composition is unchanged;
+    the hires KSampler's self-attention runs over tiles of the upscaled latent.
+    """
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        strategy = get_hires_strategy(params)
+        return bool(params.get("hf_hypertile") and strategy and strategy not in SINGLE_PASS_HIRES_STRATEGIES)
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Add a HyperTile node on the hires model reference."""
+        
+        tile_size = get_hypertile_size(params)
+        
+        hypertile_id, _ = ctx.add_node(
+            "HyperTile",
+            {
+                "model": ctx.hires_model_ref or ctx.model_ref,
+                "tile_size": tile_size,
+                "swap_size": int(get_param(params, "hf_hypertile_swap_size")),
+                "max_depth": 0,
+                "scale_depth": False,
+            },
+            f"HF: HyperTile ({tile_size}px)"
+        )
+        ctx.hires_model_ref = ctx.get_ref(hypertile_id, 0)
+        
+        print(f"[HiresHyperTileModule] HyperTile on hires model, tile size {tile_size}")
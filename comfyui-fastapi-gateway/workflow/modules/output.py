@@ -1,9 +1,21 @@
 """
-Output module - Image saving.
+Output modules - Image saving and base latent persistence.
 """
 from typing import Dict, Any
 from .base import BaseModule
 from ..context import WorkflowContext
+from ..params import get_tome_ratios
+
+
+def _custom_parameters(params: Dict[str, Any]) -> str:
+    """Extra "Key: value" entries for the A1111-style parameters string (read by Civitai etc.)."""
+    base_ratio, hires_ratio = get_tome_ratios(params)
+    entries = []
+    if base_ratio > 0:
+        entries.append(f"ToMe ratio: {base_ratio}")
+    if hires_ratio > 0:
+        entries.append(f"Hires ToMe ratio: {hires_ratio}")
+    return ", ".join(entries)
 
 
 class OutputModule(BaseModule):
@@ -28,38 +40,61 @@ class OutputModule(BaseModule):
         positive_prompt = params.get("positive_prompt", "")
         negative_prompt = params.get("negative_prompt", "")
         
-        saver_id, _ = ctx.add_node(
-            "Image Saver",
-            {
-                "images": ctx.pixels_ref,
-                "filename": filename_format,
-                "path": path_format,
-                "extension": "png",
-                "steps": ctx.steps_cfg_ref,
-                "cfg": ctx.get_ref(ctx.steps_cfg_ref[0], 1),
-                "modelname": ctx.model_name_str_ref,
-                "sampler_name": sampler_name,
-                "scheduler": scheduler,
-                "positive": positive_prompt,
-                "negative": negative_prompt,
-                "seed_value": seed,
-                "width": width,
-                "height": height,
-                "lossless_webp": True,
-                "quality_jpeg_or_webp": 100,
-                "optimize_png": False,
-                "counter": 0,
-                "denoise": 1.0,
-                "clip_skip": clipskip,
-                "time_format": "%Y-%m-%d-%H%M%S",
-                "save_workflow_as_json": False,
-                "embed_workflow": True,
-                "additional_hashes": "",
-                "download_civitai_data": True,
-                "easy_remix": True,
-            },
-            "FINAL_IMAGE_SAVER_NODE"
-        )
+        saver_inputs = {
+            "images": ctx.pixels_ref,
+            "filename": filename_format,
+            "path": path_format,
+            "extension": "png",
+            "steps": ctx.steps_cfg_ref,
+            "cfg": ctx.get_ref(ctx.steps_cfg_ref[0], 1),
+            "modelname": ctx.model_name_str_ref,
+            "sampler_name": sampler_name,
+            "scheduler": scheduler,
+            "positive": positive_prompt,
+            "negative": negative_prompt,
+            "seed_value": seed,
+            "width": width,
+            "height": height,
+            "lossless_webp": True,
+            "quality_jpeg_or_webp": 100,
+            "optimize_png": False,
+            "counter": 0,
+            "denoise": 1.0,
+            "clip_skip": clipskip,
+            "time_format": "%Y-%m-%d-%H%M%S",
+            "save_workflow_as_json": False,
+            "embed_workflow": True,
+            "additional_hashes": "",
+            "download_civitai_data": True,
+            "easy_remix": True,
+        }
+        custom = _custom_parameters(params)
+        if custom:
+            # Only sent when there is something to record, for Image Saver versions without "custom"
+            saver_inputs["custom"] = custom
+        saver_id, _ = ctx.add_node("Image Saver", saver_inputs, "FINAL_IMAGE_SAVER_NODE")
         ctx.final_saver_node_id = saver_id
         
         print(f"[OutputModule] Image Saver configured: {path_format}/{filename_format}")
+
+
+class SaveLatentModule(BaseModule):
+    """Persists the base-pass latent so the job can be refined later."""
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        return bool(params.get("persist_latent") and params.get("job_id"))
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Build the SaveLatent node on the base KSampler output."""
+        
+        job_id = params["job_id"]
+        
+        ctx.add_node(
+            "SaveLatent",
+            {
+                "samples": ctx.samples_ref,
+                "filename_prefix": f"gateway_latents/{job_id}",
+            },
+            "PERSIST_BASE_LATENT"
+        )
+        print(f"[SaveLatentModule] Persisting base latent for job {job_id}")
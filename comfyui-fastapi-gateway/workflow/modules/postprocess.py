@@ -1,16 +1,39 @@
 """
-Postprocess module - HiresFix upscaling and color transfer.
+Postprocess modules - HiresFix upscaling strategies and color transfer.
 """
-from typing import Dict, Any
+from typing import Dict, Any, List
 from .base import BaseModule
 from ..context import WorkflowContext
+from ..params import get_hires_strategy, get_hires_size, plan_tiles
+
+
+def normalize_upscaler_name(upscaler: str) -> str:
+    """Ensure upscaler name has extension."""
+    if not upscaler.lower().endswith(('.pth', '.safetensors')):
+        upscaler += ".pth"
+    return upscaler
+
+
+def add_color_transfer(ctx: WorkflowContext, original_pixels_ref: List, method: str) -> None:
+    """Match the hires output's colors to the base pass, if enabled."""
+    if method and method != "none":
+        ct_id, _ = ctx.add_node(
+            "ImageColorTransferMira",
+            {
+                "src_image": ctx.pixels_ref,
+                "ref_image": original_pixels_ref,
+                "method": method,
+            },
+            f"HF: Color Transfer ({method})"
+        )
+        ctx.pixels_ref = ctx.get_ref(ct_id, 0)
 
 
 class HiresFixModule(BaseModule):
     """Applies HiresFix upscaling with optional color transfer."""
     
     def should_run(self, params: Dict[str, Any]) -> bool:
-        return params.get("hf_enable", False)
+        return get_hires_strategy(params) == "model"
     
     def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
         """Build HiresFix upscaling chain."""
@@ -25,9 +48,7 @@ class HiresFixModule(BaseModule):
         hf_colortransfer = params.get("hf_colortransfer", "none")
         seed = params.get("random_seed", -1)
         
-        # Ensure upscaler name has extension
-        if not hf_upscaler.lower().endswith(('.pth', '.safetensors')):
-            hf_upscaler += ".pth"
+        hf_upscaler = normalize_upscaler_name(hf_upscaler)
         
         # Store original pixels for color transfer
         original_pixels_ref = ctx.pixels_ref
@@ -70,7 +91,7 @@ class HiresFixModule(BaseModule):
         hf_ksampler_id, _ = ctx.add_node(
             "KSampler",
             {
-                "model": ctx.model_ref,  # Use current model (with LoRAs applied)
+                "model": ctx.hires_model_ref or ctx.model_ref,  # Current model (with LoRAs applied)
                 "positive": ctx.positive_cond_ref,
                 "negative": ctx.negative_cond_ref,
                 "latent_image": ctx.get_ref(vae_encode_id, 0),
@@ -100,16 +121,164 @@ class HiresFixModule(BaseModule):
         ctx.pixels_ref = ctx.get_ref(vae_decode_id, 0)
         
         # Apply color transfer if enabled
-        if hf_colortransfer and hf_colortransfer != "none":
-            ct_id, _ = ctx.add_node(
-                "ImageColorTransferMira",
-                {
-                    "src_image": ctx.pixels_ref,
-                    "ref_image": original_pixels_ref,
-                    "method": hf_colortransfer,
-                },
-                f"HF: Color Transfer ({hf_colortransfer})"
-            )
-            ctx.pixels_ref = ctx.get_ref(ct_id, 0)
+        add_color_transfer(ctx, original_pixels_ref, hf_colortransfer)
         
         print(f"[HiresFixModule] Applied upscale {hf_scale}x with {hf_upscaler}")
+
+
+class TiledUpscaleModule(BaseModule):
+    """
+    Tiled hires strategy (Ultimate SD Upscale).
+    
+    Samples overlapping tiles of the upscaled image instead of one full-frame
+    KSampler, so peak VRAM is bounded by the tile size rather than the
+    output size. Needs the ComfyUI_UltimateSDUpscale custom node pack
+    (checked by comfyui.require_custom_nodes before queueing).
+    """
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        return get_hires_strategy(params) == "tiled"
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Build the tiled upscale + sample chain."""
+        
+        hf_scale = params.get("hf_scale", 1.5)
+        hf_upscaler = normalize_upscaler_name(params.get("hf_upscaler", "RealESRGAN_x4.pth"))
+        hf_denoise = params.get("hf_denoising_strength", 0.4)
+        hf_steps = params.get("hf_steps", 15)
+        hf_cfg = params.get("hf_cfg", 7.0)
+        hf_sampler = params.get("hf_sampler") or params.get("sampler_name", "euler")
+        hf_scheduler = params.get("hf_scheduler") or params.get("scheduler", "normal")
+        hf_colortransfer = params.get("hf_colortransfer", "none")
+        seed = params.get("random_seed", -1)
+        
+        target_w, target_h = get_hires_size(params)
+        tile_w, tile_h, overlap = plan_tiles(
+            target_w, target_h,
+            params.get("hf_tile_size", 1024),
+            params.get("hf_tile_overlap", 64),
+        )
+        
+        # Store original pixels for color transfer
+        original_pixels_ref = ctx.pixels_ref
+        
+        # Load upscaler model
+        upscaler_id, _ = ctx.add_node(
+            "UpscaleModelLoader",
+            {"model_name": hf_upscaler},
+            "HF: Load Upscaler"
+        )
+        
+        tiled_id, _ = ctx.add_node(
+            "UltimateSDUpscale",
+            {
+                "image": ctx.pixels_ref,
+                "model": ctx.hires_model_ref or ctx.model_ref,
+                "positive": ctx.positive_cond_ref,
+                "negative": ctx.negative_cond_ref,
+                "vae": ctx.vae_ref,
+                "upscale_by": hf_scale,
+                "seed": seed,
+                "steps": hf_steps,
+                "cfg": hf_cfg,
+                "sampler_name": hf_sampler,
+                "scheduler": hf_scheduler,
+                "denoise": hf_denoise,
+                "upscale_model": ctx.get_ref(upscaler_id, 0),
+                "mode_type": "Chess",
+                "tile_width": tile_w,
+                "tile_height": tile_h,
+                "mask_blur": max(8, overlap // 4),
+                "tile_padding": overlap,
+                "seam_fix_mode": "None",
+                "seam_fix_denoise": 1.0,
+                "seam_fix_width": 64,
+                "seam_fix_mask_blur": 8,
+                "seam_fix_padding": 16,
+                "force_uniform_tiles": True,
+                "tiled_decode": True,
+            },
+            "HF: Tiled Upscale"
+        )
+        ctx.pixels_ref = ctx.get_ref(tiled_id, 0)
+        
+        # Apply color transfer if enabled
+        add_color_transfer(ctx, original_pixels_ref, hf_colortransfer)
+        
+        print(
+            f"[TiledUpscaleModule] {target_w}x{target_h} via {tile_w}x{tile_h} tiles "
+            f"(padding {overlap}) with {hf_upscaler}"
+        )
+
+
+class LatentHiresModule(BaseModule):
+    """
+    Latent hires strategy.
+    
+    Upscales the base latent directly and samples it, skipping the ESRGAN
+    pass and the extra VAE encode/decode round trip of HiresFixModule.
+    """
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        return get_hires_strategy(params) == "latent"
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Build LatentUpscaleBy -> KSampler -> VAEDecodeTiled."""
+        
+        hf_scale = params.get("hf_scale", 1.5)
+        hf_denoise = params.get("hf_latent_denoise", 0.55)
+        hf_upscale_method = params.get("hf_latent_upscale_method", "nearest-exact")
+        hf_steps = params.get("hf_steps", 15)
+        hf_cfg = params.get("hf_cfg", 7.0)
+        hf_sampler = params.get("hf_sampler") or params.get("sampler_name", "euler")
+        hf_scheduler = params.get("hf_scheduler") or params.get("scheduler", "normal")
+        hf_colortransfer = params.get("hf_colortransfer", "none")
+        seed = params.get("random_seed", -1)
+        
+        # Base pixels are only decoded if color transfer needs them
+        original_pixels_ref = ctx.pixels_ref
+        
+        upscale_id, _ = ctx.add_node(
+            "LatentUpscaleBy",
+            {
+                "samples": ctx.samples_ref,
+                "upscale_method": hf_upscale_method,
+                "scale_by": hf_scale,
+            },
+            "HF: Latent Upscale"
+        )
+        
+        hf_ksampler_id, _ = ctx.add_node(
+            "KSampler",
+            {
+                "model": ctx.hires_model_ref or ctx.model_ref,
+                "positive": ctx.positive_cond_ref,
+                "negative": ctx.negative_cond_ref,
+                "latent_image": ctx.get_ref(upscale_id, 0),
+                "seed": seed,
+                "steps": hf_steps,
+                "cfg": hf_cfg,
+                "sampler_name": hf_sampler,
+                "scheduler": hf_scheduler,
+                "denoise": hf_denoise,
+            },
+            "HF: KSampler"
+        )
+        
+        vae_decode_id, _ = ctx.add_node(
+            "VAEDecodeTiled",
+            {
+                "samples": ctx.get_ref(hf_ksampler_id, 0),
+                "vae": ctx.vae_ref,
+                "tile_size": 512,
+                "overlap": 64,
+                "temporal_size": 64,
+                "temporal_overlap": 8,
+            },
+            "HF: VAE Decode Tiled"
+        )
+        ctx.pixels_ref = ctx.get_ref(vae_decode_id, 0)
+        
+        add_color_transfer(ctx, original_pixels_ref, hf_colortransfer)
+        
+        print(f"[LatentHiresModule] Latent upscale {hf_scale}x ({hf_upscale_method}), denoise={hf_denoise}")
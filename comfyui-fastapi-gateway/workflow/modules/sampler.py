@@ -1,9 +1,10 @@
 """
-Sampler module - EmptyLatent and KSampler.
+Sampler modules - EmptyLatent and KSampler, or a persisted latent for refines.
 """
 from typing import Dict, Any
 from .base import BaseModule
 from ..context import WorkflowContext
+from ..params import get_hires_strategy, get_hires_size, SINGLE_PASS_HIRES_STRATEGIES
 
 
 class SamplerModule(BaseModule):
@@ -42,6 +43,34 @@ class SamplerModule(BaseModule):
             "Create Canvas"
         )
         
+        # Single-pass hires (Deep Shrink) samples the output size directly
+        if get_hires_strategy(params) in SINGLE_PASS_HIRES_STRATEGIES:
+            out_width, out_height = get_hires_size(params)
+            if ctx.latent_ref is None:
+                empty_latent_id, _ = ctx.add_node(
+                    "EmptyLatentImage",
+                    {
+                        "width": out_width,
+                        "height": out_height,
+                        "batch_size": ctx.get_ref(canvas_id, 2),
+                    },
+                    "Empty Latent (Output Size)"
+                )
+                ctx.latent_ref = ctx.get_ref(empty_latent_id, 0)
+            else:
+                upscale_id, _ = ctx.add_node(
+                    "LatentUpscale",
+                    {
+                        "samples": ctx.latent_ref,
+                        "upscale_method": "bicubic",
+                        "width": out_width,
+                        "height": out_height,
+                        "crop": "disabled",
+                    },
+                    "Upscale Latent (Output Size)"
+                )
+                ctx.latent_ref = ctx.get_ref(upscale_id, 0)
+        
         # Only create empty latent if not using ClipVision img2img
         if ctx.latent_ref is None:
             empty_latent_id, _ = ctx.add_node(
@@ -84,11 +113,13 @@ class SamplerModule(BaseModule):
             "KSampler (Main)"
         )
         
+        ctx.samples_ref = ctx.get_ref(ksampler_id, 0)
+        
         # Decode to pixels
         decode_id, _ = ctx.add_node(
             "VAEDecode",
             {
-                "samples": ctx.get_ref(ksampler_id, 0),
+                "samples": ctx.samples_ref,
                 "vae": ctx.vae_ref,
             },
             "VAE Decode"
@@ -96,3 +127,48 @@ class SamplerModule(BaseModule):
         ctx.pixels_ref = ctx.get_ref(decode_id, 0)
         
         print(f"[SamplerModule] KSampler: {sampler_name}/{scheduler}, steps={steps}")
+
+
+class LatentInputModule(BaseModule):
+    """Loads a persisted base latent in place of sampling (refine workflows)."""
+    
+    def should_run(self, params: Dict[str, Any]) -> bool:
+        return bool(params.get("base_latent_filename"))
+    
+    def build(self, ctx: WorkflowContext, params: Dict[str, Any]) -> None:
+        """Build LoadLatent, StepsAndCfg, and VAEDecode nodes."""
+        
+        latent_file = params["base_latent_filename"]
+        steps = params.get("steps", 20)
+        cfg = params.get("cfg", 7.0)
+        
+        load_id, _ = ctx.add_node(
+            "LoadLatent",
+            {"latent": latent_file},
+            "Load Base Latent"
+        )
+        ctx.samples_ref = ctx.get_ref(load_id, 0)
+        
+        # Steps and CFG node (for Image Saver compatibility)
+        steps_cfg_id, _ = ctx.add_node(
+            "StepsAndCfg",
+            {
+                "steps": steps,
+                "cfg": cfg,
+            },
+            "Steps & CFG"
+        )
+        ctx.steps_cfg_ref = [steps_cfg_id, 0]
+        
+        # Decode to pixels (HiresFix upscales and color-matches against these)
+        decode_id, _ = ctx.add_node(
+            "VAEDecode",
+            {
+                "samples": ctx.samples_ref,
+                "vae": ctx.vae_ref,
+            },
+            "VAE Decode"
+        )
+        ctx.pixels_ref = ctx.get_ref(decode_id, 0)
+        
+        print(f"[LatentInputModule] Loaded base latent: {latent_file}")
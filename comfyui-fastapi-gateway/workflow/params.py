@@ -1,7 +1,9 @@
 """
 Parameter validation and default values for workflow generation.
 """
-from typing import Dict, Any
+import re
+import math
+from typing import Dict, Any, List, Optional, Tuple
 
 
 # Default values for all workflow parameters
@@ -24,6 +26,29 @@ DEFAULTS = {
     "hf_steps": 15,
     "hf_cfg": 7.0,
     "hf_colortransfer": "none",
+    "hf_strategy": "model",
+    "hf_tile_size": 1024,
+    "hf_tile_overlap": 64,
+    # Latent upscaling discards detail the model must re-create, so this path needs more denoise
+    "hf_latent_denoise": 0.55,
+    "hf_latent_upscale_method": "nearest-exact",
+    # Deep Shrink: UNet block downscaled for the first part of the schedule
+    "hf_deep_shrink_block": 3,
+    "hf_deep_shrink_end": 0.35,
+    
+    # Token merging (ToMe) - opt-in; None ratios are chosen by resolution
+    "tome_enabled": False,
+    
+    # HyperTile on the hires model only - opt-in; None tile size is chosen by resolution
+    "hf_hypertile": False,
+    "hf_hypertile_swap_size": 2,
+    
+    # Draft preview (LCM / Lightning LoRA)
+    "draft_steps": 4,
+    "draft_cfg": 1.0,
+    "draft_sampler": "lcm",
+    "draft_scheduler": "sgm_uniform",
+    "draft_lora_strength": 1.0,
     
     # ControlNet
     "controlnet_strength": 1.0,
@@ -67,6 +92,14 @@ def validate_params(params: Dict[str, Any]) -> Dict[str, Any]:
     """
     validated = dict(params)  # Copy input
     
+    # "auto" ControlNet resolutions fill only the values the request left unset
+    if params.get("cn_resolution_mode") == "auto":
+        validated.update(plan_controlnet_resolution(params))
+    
+    # An explicit hf_denoising_strength also drives the "latent" strategy unless hf_latent_denoise is set
+    if params.get("hf_latent_denoise") is None and params.get("hf_denoising_strength") is not None:
+        validated["hf_latent_denoise"] = params["hf_denoising_strength"]
+    
     # Apply defaults for missing values
     for key, default_value in DEFAULTS.items():
         if key not in validated or validated[key] is None:
@@ -77,3 +110,291 @@ def validate_params(params: Dict[str, Any]) -> Dict[str, Any]:
         validated["batch_size"] = validated["loops"]
     
     return validated
+
+
+# Hires strategies selectable via hf_strategy
+HIRES_STRATEGIES = ("model", "tiled", "latent", "deep_shrink")
+
+# Strategies that sample the output size directly, without a second pass
+SINGLE_PASS_HIRES_STRATEGIES = ("deep_shrink",)
+
+
+def get_hires_strategy(params: Dict[str, Any]) -> Optional[str]:
+    """Return the active hires strategy, or None when hires fix is off."""
+    if not params.get("hf_enable"):
+        return None
+    strategy = params.get("hf_strategy") or "model"
+    if strategy not in HIRES_STRATEGIES:
+        print(f"WARN: Unknown hf_strategy '{strategy}', falling back to 'model'")
+        return "model"
+    return strategy
+
+
+def get_canvas_size(params: Dict[str, Any]) -> Tuple[int, int]:
+    """Base-pass canvas (width, height), after the landscape flip."""
+    width = int(get_param(params, "width"))
+    height = int(get_param(params, "height"))
+    if params.get("api_image_landscape"):
+        width, height = height, width
+    return width, height
+
+
+def get_hires_size(params: Dict[str, Any]) -> Tuple[int, int]:
+    """Final output (width, height) after the hires multiplier, snapped to 8px."""
+    width, height = get_canvas_size(params)
+    scale = float(get_param(params, "hf_scale"))
+    return (
+        max(8, int(round(width * scale / 8)) * 8),
+        max(8, int(round(height * scale / 8)) * 8),
+    )
+
+
+# Token merging ratios by pass size (megapixels). Below the first
+# threshold the attention cost is too small for ToMe to pay for its quality loss.
+TOME_MIN_MEGAPIXELS = 1.0
+TOME_BASE_RATIO = 0.3
+TOME_HIRES_RATIO = 0.4
+TOME_HIRES_LARGE_MEGAPIXELS = 2.5
+TOME_HIRES_LARGE_RATIO = 0.5
+
+
+def get_tome_ratios(params: Dict[str, Any]) -> Tuple[float, float]:
+    """
+    Token merging ratios for the base and hires passes (0.0 = off).
+    Explicit tome_ratio / hf_tome_ratio win over the resolution-based choice.
+    """
+    if not params.get("tome_enabled"):
+        return 0.0, 0.0
+    
+    def _auto(megapixels: float, hires: bool) -> float:
+        if megapixels < TOME_MIN_MEGAPIXELS:
+            return 0.0
+        if not hires:
+            return TOME_BASE_RATIO
+        return TOME_HIRES_LARGE_RATIO if megapixels >= TOME_HIRES_LARGE_MEGAPIXELS else TOME_HIRES_RATIO
+    
+    strategy = get_hires_strategy(params)
+    single_pass = strategy in SINGLE_PASS_HIRES_STRATEGIES
+    width, height = get_hires_size(params) if single_pass else get_canvas_size(params)
+    base = params.get("tome_ratio")
+    if base is None:
+        base = _auto(width * height / 1_000_000, hires=False)
+    
+    hires = 0.0
+    if strategy and not single_pass:
+        hires = params.get("hf_tome_ratio")
+        if hires is None:
+            hf_width, hf_height = get_hires_size(params)
+            hires = _auto(hf_width * hf_height / 1_000_000, hires=True)
+    
+    # TomePatchModel accepts 0.0-1.0
+    return min(max(float(base), 0.0), 1.0), min(max(float(hires), 0.0), 1.0)
+
+
+def get_draft_params(params: Dict[str, Any], draft_lora: str) -> Dict[str, Any]:
+    """
+    Parameters for the fast draft of a job: same seed, canvas, prompts and
+    references, sampled in a few LCM steps at cfg ~1 with no hires pass.
+    
+    The draft LoRA is loaded model-only, so the CLIP chain and every
+    conditioning node match the full job and stay in ComfyUI's cache.
+    """
+    draft = dict(params)
+    loras = list(params.get("loras_config") or []) if params.get("loras_enabled") else []
+    loras.append({
+        "name": draft_lora,
+        "strength": float(get_param(params, "draft_lora_strength")),
+        "model_only": True,
+    })
+    draft.update({
+        "loras_enabled": True,
+        "loras_config": loras,
+        "sampling_discrete_enabled": True,
+        "sampling_type": "lcm",
+        "zsnr_enabled": False,
+        "steps": int(get_param(params, "draft_steps")),
+        "cfg": float(get_param(params, "draft_cfg")),
+        "sampler_name": get_param(params, "draft_sampler"),
+        "scheduler": get_param(params, "draft_scheduler"),
+        "hf_enable": False,
+        "tome_enabled": False,
+        "persist_latent": False,
+    })
+    return draft
+
+
+# Preprocessor -> its resolution param (fixed, non-auto defaults in DEFAULTS)
+CN_PREPROCESSOR_RESOLUTION = {
+    "anyLine": "cn_anyline_resolution",
+    "depth": "cn_depth_resolution",
+    "openPose": "cn_openpose_resolution",
+    "canny": "cn_canny_resolution",
+}
+CN_RESOLUTION_PARAMS = tuple(CN_PREPROCESSOR_RESOLUTION.values())
+
+
+def get_controlnet_hints(params: Dict[str, Any]) -> List[Tuple[str, Optional[int]]]:
+    """
+    (preprocessor, per-unit resolution or None) for every hint the request
+    builds; "none" is the raw reference used as the hint.
+    """
+    units = params.get("controlnet_units") or []
+    if units:
+        return [(unit.get("preprocessor") or "none", unit.get("resolution")) for unit in units]
+    enabled = [name for name, on in (params.get("controlnet_preprocessors") or {}).items() if on]
+    return [(name, None) for name in enabled] or [("none", None)]
+
+
+def get_sampled_size(params: Dict[str, Any]) -> Tuple[int, int]:
+    """Largest (width, height) the conditioning is sampled at: hires output if enabled, else the canvas."""
+    return get_hires_size(params) if get_hires_strategy(params) else get_canvas_size(params)
+
+
+def upscale_model_factor(model_name: str) -> int:
+    """Native scale of an upscale model from its name (RealESRGAN_x4, 4x-UltraSharp); 4 if unknown."""
+    match = re.search(r"(?:^|[^a-z0-9])x(\d)(?:[^0-9]|$)|(\d)x(?:[^a-z0-9]|$)", model_name.lower())
+    return int(match.group(1) or match.group(2)) if match else 4
+
+
+def plan_controlnet_resolution(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Derive ControlNet preprocessor resolutions and the reference upscale
+    from the sampled size, for cn_resolution_mode="auto".
+    
+    Preprocessors resize their input so the short side equals `resolution`,
+    and the hint is resized to the latent afterwards, so nothing above the
+    sampled short side reaches the model. Each resolution becomes that short
+    side (snapped up to 64), capped at its fixed default. A requested
+    reference upscale model is rescaled back down to the largest resolution
+    the built hints need; without one, a reference that is already large
+    enough is passed through unscaled. Values already set in params are kept.
+    
+    Returns:
+        Dict of the parameters to override
+    """
+    width, height = get_sampled_size(params)
+    target = max(64, math.ceil(min(width, height) / 64) * 64)
+    
+    plan: Dict[str, Any] = {}
+    for key in CN_RESOLUTION_PARAMS:
+        if params.get(key) is None:
+            plan[key] = min(DEFAULTS[key], target)
+    
+    # Only the hints actually built; a raw reference is resized to the sampled size
+    needed = max(
+        (resolution or params.get(CN_PREPROCESSOR_RESOLUTION[name]) or plan[CN_PREPROCESSOR_RESOLUTION[name]])
+        if name in CN_PREPROCESSOR_RESOLUTION else min(width, height)
+        for name, resolution in get_controlnet_hints(params)
+    )
+    ref_size = params.get("controlnet_ref_image_size")
+    upscale_model = params.get("controlnet_upscale_model")
+    if ref_size and params.get("controlnet_upscale_factor") is None:
+        ref_short = min(ref_size)
+        if upscale_model and upscale_model != "None":
+            # An explicit upscale model is kept; its output is rescaled back to what is needed
+            upscaled_short = ref_short * upscale_model_factor(upscale_model)
+            plan["controlnet_upscale_factor"] = round(min(1.0, needed / upscaled_short), 4)
+        elif ref_short >= needed:
+            # Already large enough: the preprocessors downscale it themselves
+            plan["controlnet_upscale_factor"] = 1.0
+    
+    print(f"[Params] Auto ControlNet resolution for {width}x{height}: {plan}")
+    return plan
+
+
+HYPERTILE_MIN_TILE = 256
+HYPERTILE_MAX_TILE = 1024
+
+
+def get_hypertile_size(params: Dict[str, Any]) -> int:
+    """
+    HyperTile tile size (px) for the hires pass, from the region the hires
+    KSampler actually samples: the whole output, or one padded tile for the
+    "tiled" strategy. Aims for ~4 attention tiles along the short side.
+    """
+    explicit = params.get("hf_hypertile_tile_size")
+    if explicit:
+        return int(explicit)
+    width, height = get_hires_size(params)
+    if get_hires_strategy(params) == "tiled":
+        max_tile = int(get_param(params, "hf_tile_size"))
+        width, height = min(width, max_tile), min(height, max_tile)
+    tile = (min(width, height) // 4 // 64) * 64
+    return min(max(tile, HYPERTILE_MIN_TILE), HYPERTILE_MAX_TILE)
+
+
+def plan_tiles(
+    target_width: int, target_height: int, max_tile: int, overlap: int
+) -> Tuple[int, int, int]:
+    """
+    Choose tile dimensions for tiled upscaling.
+    
+    Each sampled region is a tile plus `overlap` padding on every side, so
+    tiles are sized to keep that region within max_tile x max_tile no matter
+    how large the target is. Tiles are spread evenly over the target and
+    snapped up to multiples of 64.
+    
+    Returns:
+        Tuple of (tile_width, tile_height, overlap)
+    """
+    overlap = max(0, int(overlap))
+    usable = max(64, int(max_tile) - 2 * overlap)
+    
+    def _axis(length: int) -> int:
+        count = max(1, math.ceil(length / usable))
+        tile = math.ceil(length / count / 64) * 64
+        return min(tile, max(64, (usable // 64) * 64)) if count > 1 else tile
+    
+    return _axis(target_width), _axis(target_height), overlap
+
+
+# Parameters that may vary along a matrix (X/Y grid) axis
+MATRIX_AXIS_PARAMS = (
+    "positive_prompt",
+    "negative_prompt",
+    "random_seed",
+    "sampler_name",
+    "scheduler",
+    "cfg",
+    "steps",
+    "denoise",
+)
+
+MATRIX_MAX_CELLS = 64
+
+
+def expand_matrix(
+    x_param: str,
+    x_values: List[Any],
+    y_param: Optional[str] = None,
+    y_values: Optional[List[Any]] = None,
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Expand one or two axes into matrix cells, row by row.
+    
+    Returns:
+        List of ("x,y", param_overrides)
+    """
+    axes = [(x_param, x_values)]
+    if y_param:
+        axes.append((y_param, y_values or []))
+    for param, values in axes:
+        if param not in MATRIX_AXIS_PARAMS:
+            raise ValueError(f"Matrix axis '{param}' is not supported. Use one of: {', '.join(MATRIX_AXIS_PARAMS)}")
+        if not values:
+            raise ValueError(f"Matrix axis '{param}' has no values")
+    if y_param and y_param == x_param:
+        raise ValueError("Matrix axes must vary different parameters")
+    
+    y_values = y_values if y_param else [None]
+    if len(x_values) * len(y_values) > MATRIX_MAX_CELLS:
+        raise ValueError(f"Matrix has {len(x_values) * len(y_values)} cells, maximum is {MATRIX_MAX_CELLS}")
+    
+    cells = []
+    for y, y_value in enumerate(y_values):
+        for x, x_value in enumerate(x_values):
+            overrides = {x_param: x_value}
+            if y_param:
+                overrides[y_param] = y_value
+            cells.append((f"{x},{y}", overrides))
+    return cells
@@ -0,0 +1,221 @@
+"""
+Workflow templates - externally authored ComfyUI API graphs with bound parameters.
+
+A template is declared by a manifest (*.template.json) next to, or pointing
+at, a ComfyUI API-format workflow:
+
+    {
+        "name": "hires_color_transfer",
+        "description": "...",
+        "workflow": "../../comfyui-model-api/workflow_api.json",
+        "output_node": "10",
+        "bindings": {
+            "positive_prompt": {"path": "30.inputs.text", "type": "string", "required": true},
+            "seed": {"path": ["4.inputs.seed", "20.inputs.seed"], "type": "int"}
+        }
+    }
+
+Manifests are parsed and validated once at load time. Instantiating a
+template only copies the nodes whose inputs are patched; all other nodes
+are shared with the compiled graph and must never be mutated.
+"""
+import json
+import pathlib
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Tuple
+
+
+BINDING_TYPES = ("string", "int", "float", "bool", "image", "any")
+
+# Title the gateway looks for when picking the final image (see comfyui.get_images)
+FINAL_OUTPUT_TITLE = "FINAL_IMAGE_SAVER_NODE"
+
+
+@dataclass
+class TemplateBinding:
+    """A request parameter bound to one or more node inputs."""
+    name: str
+    type: str
+    targets: List[Tuple[str, str]]  # (node_id, input_name)
+    required: bool = False
+    description: str = ""
+
+
+@dataclass
+class WorkflowTemplate:
+    """A compiled, immutable workflow template."""
+    name: str
+    description: str
+    nodes: Dict[str, Any]
+    bindings: Dict[str, TemplateBinding] = field(default_factory=dict)
+
+    def describe(self) -> Dict[str, Any]:
+        """Public description of the template and its parameters."""
+        return {
+            "name": self.name,
+            "description": self.description,
+            "parameters": {
+                name: {
+                    "type": binding.type,
+                    "required": binding.required,
+                    "description": binding.description,
+                    "default": self._default_for(binding),
+                }
+                for name, binding in self.bindings.items()
+            },
+        }
+
+    def _default_for(self, binding: TemplateBinding) -> Any:
+        node_id, input_name = binding.targets[0]
+        value = self.nodes[node_id]["inputs"][input_name]
+        return None if isinstance(value, list) else value
+
+    def image_bindings(self) -> List[str]:
+        return [name for name, binding in self.bindings.items() if binding.type == "image"]
+
+    def instantiate(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Build a workflow for one request by patching bound values into a copy.
+        Image bindings must already be resolved to uploaded filenames.
+
+        Raises:
+            ValueError: on unknown, missing or mistyped parameters
+        """
+        unknown = set(values) - set(self.bindings)
+        if unknown:
+            raise ValueError(f"Unknown parameter(s) for template '{self.name}': {', '.join(sorted(unknown))}")
+        missing = [name for name, b in self.bindings.items() if b.required and values.get(name) is None]
+        if missing:
+            raise ValueError(f"Missing required parameter(s) for template '{self.name}': {', '.join(missing)}")
+
+        nodes = dict(self.nodes)  # Shallow: untouched nodes are shared
+        copied = set()
+        for name, value in values.items():
+            if value is None:
+                continue
+            binding = self.bindings[name]
+            coerced = _coerce(binding, value)
+            for node_id, input_name in binding.targets:
+                if node_id not in copied:
+                    node = nodes[node_id]
+                    nodes[node_id] = {**node, "inputs": dict(node["inputs"])}
+                    copied.add(node_id)
+                nodes[node_id]["inputs"][input_name] = coerced
+        return nodes
+
+
+def _coerce(binding: TemplateBinding, value: Any) -> Any:
+    try:
+        if binding.type == "int":
+            return int(value)
+        if binding.type == "float":
+            return float(value)
+        if binding.type == "bool":
+            if isinstance(value, str):
+                return value.strip().lower() in ("1", "true", "yes", "on")
+            return bool(value)
+        if binding.type in ("string", "image"):
+            return str(value)
+        return value
+    except (TypeError, ValueError):
+        raise ValueError(f"Parameter '{binding.name}' expects {binding.type}, got {value!r}")
+
+
+def compile_template(manifest: Dict[str, Any], base_dir: pathlib.Path) -> WorkflowTemplate:
+    """
+    Parse a manifest and its workflow, validating every binding path.
+
+    Raises:
+        ValueError: if the manifest or workflow is invalid
+    """
+    name = manifest.get("name")
+    if not name:
+        raise ValueError("Template manifest has no 'name'")
+
+    workflow = manifest.get("workflow")
+    if isinstance(workflow, str):
+        with open(base_dir / workflow, "r", encoding="utf-8") as f:
+            nodes = json.load(f)
+    elif isinstance(workflow, dict):
+        nodes = workflow
+    else:
+        raise ValueError(f"Template '{name}' has no 'workflow' (path or inline graph)")
+
+    if not nodes or not all(isinstance(n, dict) and "class_type" in n for n in nodes.values()):
+        raise ValueError(f"Template '{name}' is not a ComfyUI API-format workflow")
+
+    output_node = manifest.get("output_node")
+    if output_node is not None:
+        output_node = str(output_node)
+        if output_node not in nodes:
+            raise ValueError(f"Template '{name}': output_node '{output_node}' does not exist")
+        nodes[output_node] = {**nodes[output_node], "_meta": {"title": FINAL_OUTPUT_TITLE}}
+
+    bindings: Dict[str, TemplateBinding] = {}
+    for param_name, spec in manifest.get("bindings", {}).items():
+        if isinstance(spec, str):
+            spec = {"path": spec}
+        binding_type = spec.get("type", "any")
+        if binding_type not in BINDING_TYPES:
+            raise ValueError(f"Template '{name}': binding '{param_name}' has unknown type '{binding_type}'")
+        paths = spec.get("path")
+        paths = [paths] if isinstance(paths, str) else list(paths or [])
+        if not paths:
+            raise ValueError(f"Template '{name}': binding '{param_name}' has no path")
+
+        targets = []
+        for path in paths:
+            parts = path.split(".")
+            if len(parts) != 3 or parts[1] != "inputs":
+                raise ValueError(f"Template '{name}': binding path '{path}' must look like '<node_id>.inputs.<input>'")
+            node_id, _, input_name = parts
+            if node_id not in nodes or input_name not in nodes[node_id].get("inputs", {}):
+                raise ValueError(f"Template '{name}': binding path '{path}' does not exist in the workflow")
+            targets.append((node_id, input_name))
+
+        bindings[param_name] = TemplateBinding(
+            name=param_name,
+            type=binding_type,
+            targets=targets,
+            required=bool(spec.get("required", False)),
+            description=spec.get("description", ""),
+        )
+
+    return WorkflowTemplate(
+        name=name,
+        description=manifest.get("description", ""),
+        nodes=nodes,
+        bindings=bindings,
+    )
+
+
+# Registry of compiled templates, filled once at startup
+_templates: Dict[str, WorkflowTemplate] = {}
+
+
+def load_templates(directory: str) -> Dict[str, WorkflowTemplate]:
+    """Compile every *.template.json manifest in directory into the registry."""
+    template_dir = pathlib.Path(directory)
+    if not template_dir.is_dir():
+        print(f"[Templates] Template directory not found: {template_dir}")
+        return _templates
+
+    for manifest_path in sorted(template_dir.glob("*.template.json")):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            template = compile_template(manifest, manifest_path.parent)
+            _templates[template.name] = template
+            print(f"[Templates] Loaded '{template.name}' ({len(template.nodes)} nodes, {len(template.bindings)} bindings)")
+        except Exception as e:
+            print(f"[Templates] ERROR loading {manifest_path.name}: {e}")
+
+    return _templates
+
+
+def get_template(name: str) -> Optional[WorkflowTemplate]:
+    return _templates.get(name)
+
+
+def list_templates() -> List[WorkflowTemplate]:
+    return list(_templates.values())
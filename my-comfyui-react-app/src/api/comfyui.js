@@ -4,6 +4,15 @@ import axios from "axios";
 // Uses window.location.hostname to support access from specific IPs or localhost
 export const GENERATE_API_BASE = `http://${window.location.hostname}:8000/api`;
 
+// Per-tab id for the gateway's Gemini chat sessions (kept across reloads of the same tab)
+export const CHAT_SESSION_ID = (() => {
+  const existing = sessionStorage.getItem("chatSessionId");
+  if (existing) return existing;
+  const id = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+  sessionStorage.setItem("chatSessionId", id);
+  return id;
+})();
+
 // Base URL for the Node.js server that lists models, LoRAs, etc.
 const MODEL_LIST_API_BASE = `http://${window.location.hostname}:3001/api`;
 
@@ -1,7 +1,7 @@
 
 import React, { useState, useRef, useEffect, useMemo } from 'react';
 import { Wand2, Upload, Eraser, Move, Download, RefreshCw, PanelRightOpen, PanelRightClose, Palette, Box, Folder, PenTool, Sparkles, Image as ImageIcon, Loader2, BrainCircuit, RefreshCcw, Plus, X, Clipboard } from 'lucide-react';
-import { GENERATE_API_BASE } from '../api/comfyui';
+import { GENERATE_API_BASE, CHAT_SESSION_ID } from '../api/comfyui';
 import GalleryPickerModal from './GalleryPickerModal';
 import DrawingCanvas from './DrawingCanvas';
 import SciFiButton from './SciFiButton';
@@ -263,6 +263,7 @@ const EditorView = () => {
                 return {
                     prompt,
                     model: modelToSend,
+                    session_id: CHAT_SESSION_ID,
                     images: imagesToSend.length > 0 ? imagesToSend : undefined,
                     parameters: {
                         aspectRatio,
@@ -405,7 +406,11 @@ const EditorView = () => {
                         <button
                             onClick={async () => {
                                 try {
-                                    await fetch('http://localhost:8000/api/external/reset', { method: 'POST' });
+                                    await fetch(`${GENERATE_API_BASE}/external/reset`, {
+                                        method: 'POST',
+                                        headers: { 'Content-Type': 'application/json' },
+                                        body: JSON.stringify({ session_id: CHAT_SESSION_ID })
+                                    });
                                     // Optional: Toast notification here
                                     console.log("Chat history reset");
                                 } catch (e) {